@@ -0,0 +1,74 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Common setup for the benchmark scripts."""
+
+import os
+import time
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from mailman.config import config
+from mailman.core.initialize import initialize
+
+
+CONFIG_TEMPLATE = """\
+[mailman]
+layout: benchmark
+
+[paths.benchmark]
+var_dir: {var_dir}
+"""
+
+
+@contextmanager
+def temporary_mailman(extra_config=''):
+    """Initialize Mailman in a temporary var directory.
+
+    :param extra_config: Additional configuration to push on top of the
+        minimal benchmark configuration.
+    :type extra_config: str
+    """
+    var_dir = tempfile.mkdtemp(prefix='mailman-benchmark-')
+    try:
+        config_file = os.path.join(var_dir, 'mailman.cfg')
+        with open(config_file, 'w') as fp:
+            fp.write(CONFIG_TEMPLATE.format(var_dir=var_dir))
+            fp.write(extra_config)
+        initialize(config_file)
+        yield config
+    finally:
+        shutil.rmtree(var_dir)
+
+
+@contextmanager
+def timer(results, name):
+    """Record the wall clock time of the block in `results[name]`."""
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
+
+
+def report(title, results, count, unit):
+    """Print a table of timings and rates."""
+    print(title)
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        print('  {:{}}  {:9.3f}s  {:12.1f} {}/s'.format(
+            name, width, seconds, count / seconds, unit))
@@ -0,0 +1,91 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure looking up the sender of a message among the members.
+
+Processing one post looks the sender up in the list's members several
+times: for the language, in the moderation rules, and in several handlers.
+The lookups are remembered for the transaction, and by the process until
+the membership of the list changes.
+"""
+
+import argparse
+
+from collections import OrderedDict
+from common import report, temporary_mailman, timer
+
+
+# Don't try to update the MTA's aliases when creating the mailing list.
+CONFIG = """
+[mta]
+incoming: mailman.mta.null.NullMTA
+"""
+
+# The number of sender lookups for each post.
+LOOKUPS_PER_POST = 5
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--members', type=int, default=1000,
+                        help='Number of members of the mailing list.')
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='Number of posts.')
+    args = parser.parse_args()
+    with temporary_mailman(CONFIG) as config:
+        from mailman.app.lifecycle import create_list
+        from mailman.interfaces.domain import IDomainManager
+        from mailman.interfaces.usermanager import IUserManager
+        from mailman.model.roster import member_cache
+        from zope.component import getUtility
+        getUtility(IDomainManager).add('example.com')
+        mlist = create_list('test@example.com')
+        user_manager = getUtility(IUserManager)
+        senders = []
+        for i in range(args.members):
+            email = 'member{}@example.org'.format(i)
+            mlist.subscribe(user_manager.create_address(email))
+            senders.append(email)
+        config.db.commit()
+        results = OrderedDict()
+        # Every lookup runs the query, as before the caches.
+        with timer(results, 'no cache'):
+            for i in range(args.count):
+                sender = senders[i % len(senders)]
+                for lookup in range(LOOKUPS_PER_POST):
+                    mlist.members._get_member(sender)
+                config.db.commit()
+        for name, size in (('transaction', 0), ('process', 10000)):
+            member_cache.clear()
+            config.push(name, """
+            [mailman]
+            member_cache_size: {}
+            """.format(size))
+            with timer(results, name):
+                for i in range(args.count):
+                    sender = senders[i % len(senders)]
+                    for lookup in range(LOOKUPS_PER_POST):
+                        mlist.members.get_member(sender)
+                    # Every post is processed in its own transaction.
+                    config.db.commit()
+            config.pop(name)
+    report('Sender lookups, {} members, {} per post'.format(
+        args.members, LOOKUPS_PER_POST), results, args.count, 'posts')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the individual delivery agents.
+
+A message is delivered to every member of a personalized mailing list, with
+a footer naming the member, by copying, decorating and flattening it for
+every recipient, and by splicing the recipients into a message flattened
+once.  Nothing is actually sent; the agents stop at the flattened text.
+"""
+
+import os
+import argparse
+
+from collections import OrderedDict
+from common import report, temporary_mailman, timer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: A benchmark
+Message-ID: <benchmark@example.com>
+
+{}
+"""
+
+# Don't try to update the MTA's aliases when creating the mailing list.
+CONFIG = """
+[mta]
+incoming: mailman.mta.null.NullMTA
+"""
+
+FOOTER = """\
+You are subscribed as $user_address ($user_name).
+"""
+
+
+def sendmail(self, sender, recipients, message_id, msgtext):
+    # Deliver nothing; nothing gets refused.
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='Number of list members.')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='Approximate message body size in bytes.')
+    parser.add_argument('-m', '--multipart', action='store_true',
+                        help='Send a multipart message.')
+    args = parser.parse_args()
+    with temporary_mailman(CONFIG) as config:
+        from mailman.app.lifecycle import create_list
+        from mailman.app.membership import add_member
+        from mailman.email.message import Message
+        from mailman.interfaces.domain import IDomainManager
+        from mailman.interfaces.mailinglist import Personalization
+        from mailman.interfaces.subscriptions import RequestRecord
+        from mailman.interfaces.template import ITemplateManager
+        from mailman.mta.deliver import Deliver, SplicingDeliver
+        from email import message_from_string
+        from email.mime.text import MIMEText
+        from zope.component import getUtility
+        getUtility(IDomainManager).add('example.com')
+        mlist = create_list('test@example.com')
+        mlist.personalize = Personalization.individual
+        recipients = []
+        for i in range(args.count):
+            email = 'member{}@example.com'.format(i)
+            add_member(mlist, RequestRecord(email, 'Member {}'.format(i)))
+            recipients.append(email)
+        path = os.path.join(config.TEMPLATE_DIR, 'site', 'en', 'footer.txt')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(FOOTER)
+        getUtility(ITemplateManager).set(
+            'list:member:regular:footer', mlist.list_id,
+            'mailman:///footer.txt')
+        config.db.commit()
+        msg = message_from_string(MESSAGE.format('x' * args.size), Message)
+        if args.multipart:
+            # Move the body into the first part of a multipart message.
+            msg.set_payload([MIMEText(msg.get_payload()),
+                             MIMEText('y' * args.size)])
+            msg['Content-Type'] = 'multipart/mixed'
+        Deliver._sendmail = sendmail
+        results = OrderedDict()
+        for agent_class in (Deliver, SplicingDeliver):
+            with timer(results, agent_class.__name__):
+                agent_class().deliver(
+                    mlist, msg, dict(recipients=recipients))
+    report('Individual delivery, {} recipients'.format(args.count),
+           results, args.count, 'recipients')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the throughput of the switchboard backends.
+
+A backlog of messages is enqueued to a queue stored as one file per message
+and to one stored in an SQLite database, then drained the way a runner does,
+by listing the queue and dequeuing and finishing every entry.
+"""
+
+import os
+import argparse
+
+from collections import OrderedDict
+from common import report, temporary_mailman, timer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: A benchmark
+Message-ID: <{}>
+
+{}
+"""
+
+
+def run(switchboard, msg, args, results):
+    name = type(switchboard).__name__
+    with timer(results, '{} enqueue'.format(name)):
+        for i in range(args.count):
+            switchboard.enqueue(msg, listid='test.example.com')
+    with timer(results, '{} drain'.format(name)):
+        while True:
+            files = switchboard.files
+            if not files:
+                break
+            for filebase in files[:args.batch]:
+                switchboard.dequeue(filebase)
+                switchboard.finish(filebase)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help='Number of messages in the backlog.')
+    parser.add_argument('-b', '--batch', type=int, default=100,
+                        help='Number of entries dequeued per queue listing.')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='Approximate message body size in bytes.')
+    args = parser.parse_args()
+    with temporary_mailman() as config:
+        from mailman.core.sqliteswitchboard import SQLiteSwitchboard
+        from mailman.core.switchboard import Switchboard
+        from mailman.email.message import Message
+        from email import message_from_string
+        msg = message_from_string(
+            MESSAGE.format('benchmark@example.com', 'x' * args.size),
+            Message)
+        results = OrderedDict()
+        for switchboard_class in (Switchboard, SQLiteSwitchboard):
+            directory = os.path.join(
+                config.QUEUE_DIR, switchboard_class.__name__.lower())
+            run(switchboard_class('benchmark', directory), msg, args,
+                results)
+    report('Switchboard backends, {} messages'.format(args.count),
+           results, args.count, 'messages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the calculation of a mailing list's regular recipients.
+
+The member-recipients handler used to look up the enabled regular members of
+the mailing list for every post.  The recipient cache only looks them up
+again when the membership generation of the list changes.
+"""
+
+import argparse
+
+from collections import OrderedDict
+from common import report, temporary_mailman, timer
+
+
+# Don't try to update the MTA's aliases when creating the mailing list.
+CONFIG = """
+[mta]
+incoming: mailman.mta.null.NullMTA
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--members', type=int, default=5000,
+                        help='Number of members of the mailing list.')
+    parser.add_argument('-n', '--count', type=int, default=100,
+                        help='Number of posts.')
+    args = parser.parse_args()
+    with temporary_mailman(CONFIG) as config:
+        from mailman.app.lifecycle import create_list
+        from mailman.interfaces.domain import IDomainManager
+        from mailman.interfaces.member import DeliveryStatus
+        from mailman.interfaces.recipients import IRecipientCache
+        from mailman.interfaces.usermanager import IUserManager
+        from zope.component import getUtility
+        getUtility(IDomainManager).add('example.com')
+        mlist = create_list('test@example.com')
+        user_manager = getUtility(IUserManager)
+        for i in range(args.members):
+            mlist.subscribe(user_manager.create_address(
+                'member{}@example.org'.format(i)))
+        config.db.commit()
+        cache = getUtility(IRecipientCache)
+        results = OrderedDict()
+        with timer(results, 'roster query'):
+            for i in range(args.count):
+                queried = set(mlist.regular_members.find_emails(
+                    delivery_status=DeliveryStatus.enabled))
+        with timer(results, 'recipient cache'):
+            for i in range(args.count):
+                cached = set(cache.get_recipients(mlist))
+        assert cached == queried, 'The recipients differ'
+    report('Regular recipients, {} members'.format(args.members),
+           results, args.count, 'posts')
+
+
+if __name__ == '__main__':
+    main()
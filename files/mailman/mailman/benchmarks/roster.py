@@ -0,0 +1,84 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure walking the members of a large mailing list.
+
+Iterating over `IRoster.members` loads every member, and their addresses,
+into the session.  `IRoster.find_entries()` streams the members' addresses
+and delivery preferences in batches, without loading any objects.
+"""
+
+import argparse
+import tracemalloc
+
+from collections import OrderedDict
+from common import report, temporary_mailman, timer
+
+
+# Don't try to update the MTA's aliases when creating the mailing list.
+CONFIG = """
+[mta]
+incoming: mailman.mta.null.NullMTA
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--members', type=int, default=10000,
+                        help='Number of members of the mailing list.')
+    args = parser.parse_args()
+    with temporary_mailman(CONFIG) as config:
+        from mailman.app.lifecycle import create_list
+        from mailman.interfaces.domain import IDomainManager
+        from mailman.interfaces.listmanager import IListManager
+        from mailman.interfaces.usermanager import IUserManager
+        from zope.component import getUtility
+        getUtility(IDomainManager).add('example.com')
+        mlist = create_list('test@example.com')
+        list_manager = getUtility(IListManager)
+        user_manager = getUtility(IUserManager)
+        for i in range(args.members):
+            mlist.subscribe(user_manager.create_address(
+                'member{}@example.org'.format(i)))
+        config.db.commit()
+        results = OrderedDict()
+        peaks = OrderedDict()
+        for name, walk in (
+                ('members', lambda mlist: [
+                    (member.address.original_email, member.delivery_mode)
+                    for member in mlist.members.members]),
+                ('find_entries', lambda mlist: [
+                    (entry.original_email, entry.delivery_mode)
+                    for entry in mlist.members.find_entries()]),
+                ):
+            # Start from an empty session, as a runner would.
+            config.db.commit()
+            config.db.store.expunge_all()
+            mlist = list_manager.get('test@example.com')
+            tracemalloc.start()
+            with timer(results, name):
+                walk(mlist)
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    report('Roster walk, {} members'.format(args.members),
+           results, args.members, 'members')
+    for name, peak in peaks.items():
+        print('  {:12}  peak {:8.1f} MiB'.format(name, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measure the enqueue rate of the switchboard.
+
+Compares enqueuing with a sync per queue file against group commits, where
+every --group enqueues, spread over several queues like the pipeline runner
+does, are synced together.
+"""
+
+import os
+import argparse
+
+from collections import OrderedDict
+from common import report, temporary_mailman, timer
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: A benchmark
+Message-ID: <{}>
+
+{}
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help='Number of messages to enqueue per run.')
+    parser.add_argument('-g', '--group', type=int, default=10,
+                        help='Number of enqueues per group commit.')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='Approximate message body size in bytes.')
+    args = parser.parse_args()
+    with temporary_mailman() as config:
+        from mailman.core.switchboard import group_commit
+        from mailman.email.message import Message
+        from email import message_from_string
+        queues = [config.switchboards[name]
+                  for name in ('out', 'archive', 'digest', 'nntp')]
+        msg = message_from_string(
+            MESSAGE.format('benchmark@example.com', 'x' * args.size),
+            Message)
+
+        def clear():
+            for switchboard in queues:
+                for filename in os.listdir(switchboard.queue_directory):
+                    os.remove(os.path.join(
+                        switchboard.queue_directory, filename))
+
+        results = OrderedDict()
+        with timer(results, 'fsync per enqueue'):
+            for i in range(args.count):
+                queues[i % len(queues)].enqueue(msg, listid='test.example.com')
+        clear()
+        with timer(results, 'group commit of {}'.format(args.group)):
+            for start in range(0, args.count, args.group):
+                with group_commit():
+                    for i in range(start, min(start + args.group, args.count)):
+                        queues[i % len(queues)].enqueue(
+                            msg, listid='test.example.com')
+        clear()
+    report('Switchboard.enqueue(), {} messages'.format(args.count),
+           results, args.count, 'enqueues')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the VERP encoding of envelope senders.
+
+The envelope sender of every recipient of a VERP'd message is computed by
+expanding the VERP format with all the list substitutions for every
+recipient, and by the VERP delivery agent, which compiles the format once
+per delivery.
+"""
+
+import argparse
+
+from collections import OrderedDict
+from common import report, temporary_mailman, timer
+
+
+# Don't try to update the MTA's aliases when creating the mailing list.
+CONFIG = """
+[mta]
+incoming: mailman.mta.null.NullMTA
+"""
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: A benchmark
+Message-ID: <benchmark@example.com>
+
+Hello.
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help='Number of recipients.')
+    args = parser.parse_args()
+    with temporary_mailman(CONFIG) as config:
+        from mailman.app.lifecycle import create_list
+        from mailman.email.message import Message
+        from mailman.interfaces.domain import IDomainManager
+        from mailman.mta.verp import VERPDelivery
+        from mailman.utilities.email import split_email
+        from mailman.utilities.string import expand
+        from email import message_from_string
+        from zope.component import getUtility
+        getUtility(IDomainManager).add('example.com')
+        mlist = create_list('test@example.com')
+        config.db.commit()
+        msg = message_from_string(MESSAGE, Message)
+        recipients = ['member{}@example{}.org'.format(i, i % 100)
+                      for i in range(args.count)]
+        sender = mlist.bounces_address
+        results = OrderedDict()
+        expanded = []
+        with timer(results, 'expand'):
+            sender_mailbox, sender_domain = split_email(sender)
+            for recipient in recipients:
+                recipient_mailbox, recipient_domain = split_email(recipient)
+                expanded.append('{}@{}'.format(
+                    expand(config.mta.verp_format, mlist, dict(
+                        bounces=sender_mailbox,
+                        local=recipient_mailbox,
+                        domain='.'.join(recipient_domain))),
+                    '.'.join(sender_domain)))
+        compiled = []
+        with timer(results, 'VERPDelivery'):
+            agent = VERPDelivery()
+            msgdata = dict(verp=True)
+            for recipient in recipients:
+                msgdata['recipient'] = recipient
+                compiled.append(agent._get_sender(mlist, msg, msgdata))
+        assert compiled == expanded, 'The envelope senders differ'
+    report('VERP envelope senders, {} recipients'.format(args.count),
+           results, args.count, 'recipients')
+
+
+if __name__ == '__main__':
+    main()
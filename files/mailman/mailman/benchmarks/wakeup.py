@@ -0,0 +1,108 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how long an idle runner takes to pick up a new message.
+
+Messages are enqueued one at a time to an otherwise empty queue, while a
+thread drains it the way a runner does.  When it finds nothing to do, the
+thread either sleeps for --sleep seconds, or waits for the queue to change.
+The latency is the time from each enqueue to the dequeue of that message.
+"""
+
+import os
+import time
+import argparse
+import threading
+
+from common import temporary_mailman
+
+
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Subject: A benchmark
+Message-ID: <benchmark@example.com>
+
+A benchmark.
+"""
+
+
+def drain(switchboard, args, events, latencies, done):
+    while not done.is_set():
+        files = switchboard.files
+        for filebase in files:
+            msg, msgdata = switchboard.dequeue(filebase)
+            latencies.append(time.perf_counter() - msgdata['sent'])
+            switchboard.finish(filebase)
+        if len(files) > 0:
+            continue
+        if not (events and switchboard.wait(args.sleep * 10)):
+            time.sleep(args.sleep)
+
+
+def run(switchboard, msg, args, events):
+    latencies = []
+    done = threading.Event()
+    thread = threading.Thread(
+        target=drain, args=(switchboard, args, events, latencies, done))
+    thread.start()
+    try:
+        for i in range(args.count):
+            # Give the runner time to go idle.
+            time.sleep(args.gap)
+            switchboard.enqueue(
+                msg, listid='test.example.com', sent=time.perf_counter())
+            while len(latencies) <= i:
+                time.sleep(0.001)
+    finally:
+        done.set()
+        thread.join()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=20,
+                        help='Number of messages to enqueue.')
+    parser.add_argument('-s', '--sleep', type=float, default=1.0,
+                        help='The runner sleep time in seconds.')
+    parser.add_argument('-g', '--gap', type=float, default=0.3,
+                        help='Seconds between enqueues.')
+    args = parser.parse_args()
+    with temporary_mailman() as config:
+        from mailman.core.sqliteswitchboard import SQLiteSwitchboard
+        from mailman.core.switchboard import Switchboard
+        from mailman.email.message import Message
+        from email import message_from_string
+        msg = message_from_string(MESSAGE, Message)
+        print('Latency of an idle runner, {} messages'.format(args.count))
+        for switchboard_class in (Switchboard, SQLiteSwitchboard):
+            for events in (False, True):
+                directory = os.path.join(
+                    config.QUEUE_DIR, '{}-{}'.format(
+                        switchboard_class.__name__.lower(), events))
+                switchboard = switchboard_class('benchmark', directory)
+                latencies = run(switchboard, msg, args, events)
+                print('  {:18}  {:7}  mean {:8.2f}ms  max {:8.2f}ms'.format(
+                    switchboard_class.__name__,
+                    'events' if events else 'polling',
+                    1000 * sum(latencies) / len(latencies),
+                    1000 * max(latencies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -405,11 +405,10 @@ class Loop:
             runner_config = getattr(config, section_name)
             if not as_boolean(runner_config.start):
                 continue
-            # Find out how many runners to instantiate.  This must be a power
-            # of 2.
+            # Find out how many runners to instantiate.
             count = int(runner_config.instances)
-            assert (count & (count - 1)) == 0, (
-                'Runner "{0}", not a power of 2: {1}'.format(name, count))
+            assert count > 0, (
+                'Runner "{0}", not a positive number: {1}'.format(name, count))
             for slice_number in range(count):
                 # runner name, slice #, # of slices, restart count
                 info = (name, slice_number, count, 0)
@@ -29,7 +29,6 @@ from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.member import (
     AlreadySubscribedError, DeliveryMode, DeliveryStatus, MemberRole)
 from mailman.interfaces.subscriptions import RequestRecord
-from operator import attrgetter
 from public import public
 from zope.component import getUtility
 from zope.interface import implementer
@@ -179,25 +178,26 @@ class Members:
             else:
                 fp = resources.enter_context(
                     open(args.output_filename, 'w', encoding='utf-8'))
-            addresses = list(roster.addresses)
-            if len(addresses) == 0:
+            if roster.member_count == 0:
                 print(_('$mlist.list_id has no members'), file=fp)
                 return
-            for address in sorted(addresses, key=attrgetter('email')):
-                if args.regular:
-                    member = roster.get_member(address.email)
-                    if member.delivery_mode != DeliveryMode.regular:
-                        continue
-                if args.digest is not None:
-                    member = roster.get_member(address.email)
-                    if member.delivery_mode not in digest_types:
-                        continue
-                if args.nomail is not None:
-                    member = roster.get_member(address.email)
-                    if member.delivery_status not in status_types:
-                        continue
+            # Filter the members in the database, and only stream their
+            # addresses, so that large mailing lists can be listed.
+            preferences = {}
+            if args.regular:
+                preferences['delivery_mode'] = [DeliveryMode.regular]
+            if args.digest is not None:
+                # Both filters apply, so no member matches --regular and
+                # --digest together.
+                preferences['delivery_mode'] = [
+                    mode for mode in preferences.get(
+                        'delivery_mode', digest_types)
+                    if mode in digest_types]
+            if args.nomail is not None:
+                preferences['delivery_status'] = status_types
+            for entry in roster.find_entries(**preferences):
                 print(
-                    formataddr((address.display_name, address.original_email)),
+                    formataddr((entry.display_name, entry.original_email)),
                     file=fp)
 
     @transactional
@@ -0,0 +1,79 @@
+# Copyright (C) 2015-2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `preferences` subcommand."""
+
+import sys
+
+from mailman.core.i18n import _
+from mailman.database.transaction import transactional
+from mailman.interfaces.command import ICLISubCommand
+from mailman.interfaces.listmanager import IListManager
+from mailman.interfaces.preferences import IEffectivePreferencesManager
+from public import public
+from zope.component import getUtility
+from zope.interface import implementer
+
+
+@public
+@implementer(ICLISubCommand)
+class Preferences:
+    """Operate on the members' effective preferences."""
+
+    name = 'preferences'
+
+    def add(self, parser, command_parser):
+        """See `ICLISubCommand`."""
+        self.parser = parser
+        command_parser.add_argument(
+            '-r', '--rebuild',
+            default=False, action='store_true',
+            help=_("""Recompute the table of the members' effective
+                   preferences.  The table is kept current as the
+                   preferences change, so this is only needed if the database
+                   was changed by other means."""))
+        command_parser.add_argument(
+            '-l', '--list',
+            default=[], dest='lists', metavar='list', action='append',
+            help=_("""Operate on this mailing list.  Multiple --list
+                   options can be given.  The argument can either be a List-ID
+                   or a fully qualified list name.  Without this option,
+                   operate on the members of all mailing lists."""))
+
+    @transactional
+    def process(self, args):
+        """See `ICLISubCommand`."""
+        if not args.rebuild:
+            self.parser.error(_('Nothing to do; try --rebuild'))
+        manager = getUtility(IEffectivePreferencesManager)
+        if not args.lists:
+            count = manager.rebuild()
+            print(_('Rebuilt the effective preferences of $count members'))
+            return
+        list_manager = getUtility(IListManager)
+        for spec in args.lists:
+            # We'll accept list-ids or fqdn list names.
+            if '@' in spec:
+                mlist = list_manager.get(spec)
+            else:
+                mlist = list_manager.get_by_list_id(spec)
+            if mlist is None:
+                print(_('No such list found: $spec'), file=sys.stderr)
+                continue
+            count = manager.rebuild(mlist)                     # noqa: F841
+            print(_('$mlist.list_id: rebuilt the effective preferences of '
+                    '$count members'))
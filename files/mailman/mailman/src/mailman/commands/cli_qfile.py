@@ -17,9 +17,8 @@
 
 """Getting information out of a qfile."""
 
-import pickle
-
 from mailman.core.i18n import _
+from mailman.core.switchboard import read_queue_file
 from mailman.interfaces.command import ICLISubCommand
 from mailman.utilities.interact import interact
 from pprint import PrettyPrinter
@@ -65,11 +64,7 @@ class QFile:
         printer = PrettyPrinter(indent=4)
         assert len(args.qfile) == 1, 'Wrong number of positional arguments'
         with open(args.qfile[0], 'rb') as fp:
-            while True:
-                try:
-                    m.append(pickle.load(fp))
-                except EOFError:
-                    break
+            m.extend(read_queue_file(fp))
         if args.doprint:
             print(_('[----- start pickle -----]'))
             for i, obj in enumerate(m):
@@ -24,7 +24,7 @@ from functools import partial
 from io import StringIO
 from mailman.app.lifecycle import create_list
 from mailman.commands.cli_members import Members
-from mailman.interfaces.member import MemberRole
+from mailman.interfaces.member import DeliveryMode, MemberRole
 from mailman.testing.helpers import subscribe
 from mailman.testing.layers import ConfigLayer
 from tempfile import NamedTemporaryFile
@@ -123,6 +123,38 @@ class TestCLIMembers(unittest.TestCase):
         self.assertEqual(len(lines), 1)
         self.assertEqual(lines[0], 'Bart Person <bperson@example.com>\n')
 
+    def test_regular_and_digest(self):
+        # Each of --regular and --digest filters the members, so together
+        # they match nobody.
+        subscribe(self._mlist, 'Anne')
+        member = subscribe(self._mlist, 'Bart')
+        member.preferences.delivery_mode = DeliveryMode.mime_digests
+        self.args.list = ['ant.example.com']
+        self.args.regular = True
+        self.args.digest = 'any'
+        with NamedTemporaryFile('w', encoding='utf-8') as outfp:
+            self.args.output_filename = outfp.name
+            self.command.process(self.args)
+            with open(outfp.name, 'r', encoding='utf-8') as infp:
+                lines = infp.readlines()
+        self.assertEqual(lines, [])
+        # Each filter alone matches one member.
+        self.args.digest = None
+        with NamedTemporaryFile('w', encoding='utf-8') as outfp:
+            self.args.output_filename = outfp.name
+            self.command.process(self.args)
+            with open(outfp.name, 'r', encoding='utf-8') as infp:
+                lines = infp.readlines()
+        self.assertEqual(lines, ['Anne Person <aperson@example.com>\n'])
+        self.args.regular = None
+        self.args.digest = 'any'
+        with NamedTemporaryFile('w', encoding='utf-8') as outfp:
+            self.args.output_filename = outfp.name
+            self.command.process(self.args)
+            with open(outfp.name, 'r', encoding='utf-8') as infp:
+                lines = infp.readlines()
+        self.assertEqual(lines, ['Bart Person <bperson@example.com>\n'])
+
     def test_bad_role(self):
         self.args.list = ['ant.example.com']
         self.args.role = 'bogus'
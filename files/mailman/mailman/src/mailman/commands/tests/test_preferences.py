@@ -0,0 +1,101 @@
+# Copyright (C) 2015-2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the `mailman preferences` subcommand."""
+
+import sys
+import unittest
+
+from contextlib import suppress
+from io import StringIO
+from mailman.app.lifecycle import create_list
+from mailman.commands.cli_preferences import Preferences
+from mailman.config import config
+from mailman.interfaces.member import DeliveryMode
+from mailman.interfaces.preferences import IEffectivePreferencesManager
+from mailman.model.effectivepreferences import EffectivePreferences
+from mailman.testing.helpers import subscribe
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+from zope.component import getUtility
+
+
+class FakeArgs:
+    def __init__(self):
+        self.rebuild = False
+        self.lists = []
+
+
+class FakeParser:
+    def __init__(self):
+        self.message = None
+
+    def error(self, message):
+        self.message = message
+        sys.exit(1)
+
+
+class TestPreferences(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._ant = create_list('ant@example.com')
+        self._bee = create_list('bee@example.com')
+        self._anne = subscribe(self._ant, 'Anne')
+        subscribe(self._bee, 'Bart')
+        self._command = Preferences()
+        self._command.parser = FakeParser()
+        self._args = FakeArgs()
+        # Lose the table, as if the database were changed by other means.
+        config.db.store.query(EffectivePreferences).delete()
+
+    def _count(self):
+        return config.db.store.query(EffectivePreferences).count()
+
+    def test_rebuild_required(self):
+        with suppress(SystemExit):
+            self._command.process(self._args)
+        self.assertIn('--rebuild', self._command.parser.message)
+
+    def test_rebuild_all(self):
+        self._args.rebuild = True
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            self._command.process(self._args)
+        self.assertEqual(
+            stdout.getvalue(),
+            'Rebuilt the effective preferences of 2 members\n')
+        self.assertEqual(self._count(), 2)
+        preferences = getUtility(IEffectivePreferencesManager).get(self._anne)
+        self.assertEqual(preferences.email, 'aperson@example.com')
+        self.assertEqual(preferences.delivery_mode, DeliveryMode.regular)
+
+    def test_rebuild_lists(self):
+        self._args.rebuild = True
+        self._args.lists = ['ant.example.com', 'missing@example.com']
+        with patch('sys.stdout', new_callable=StringIO) as stdout, \
+                patch('sys.stderr', new_callable=StringIO) as stderr:
+            self._command.process(self._args)
+        self.assertEqual(
+            stdout.getvalue(),
+            'ant.example.com: rebuilt the effective preferences of 1 '
+            'members\n')
+        self.assertEqual(
+            stderr.getvalue(), 'No such list found: missing@example.com\n')
+        self.assertEqual(
+            [row.list_id for row in
+             config.db.store.query(EffectivePreferences)],
+            ['ant.example.com'])
@@ -80,6 +80,8 @@ class Configuration:
 
     def _clear(self):
         """Clear the cached configuration variables."""
+        for switchboard in self.switchboards.values():
+            switchboard.close()
         self.switchboards.clear()
         getUtility(ILanguageManager).clear()
 
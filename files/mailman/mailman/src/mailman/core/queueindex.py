@@ -0,0 +1,333 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An incrementally maintained index of the files in a queue directory.
+
+Listing, parsing and sorting a whole queue directory on every runner pass gets
+expensive when the queue backs up.  The index keeps the set of pending queue
+file bases in FIFO order and only updates it with the changes reported by
+inotify.  A full rescan of the directory is still done periodically, and on
+every refresh when inotify is not available.
+
+Files in higher priority lanes are ordered as if they had been received
+earlier, by a fixed boost per lane.  This lets them jump ahead of a backlog
+of ordinary files without starving it.
+
+Files may also carry the time before which they must not be processed.  Such
+files are held back in a heap ordered by that time, and only join the queue
+once they are due, so a backlog of delayed files costs nothing per pass.
+"""
+
+import os
+import time
+import select
+import logging
+
+from bisect import bisect_left, insort
+from heapq import heappop, heappush
+from mailman.utilities.inotify import (
+    DirectoryWatcher, IN_CLOSE_WRITE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO,
+    IN_RESET)
+from public import public
+
+
+# By default, do a full rescan of a watched directory this often (in seconds)
+# just in case an event was missed.
+DEFAULT_RESCAN_INTERVAL = 300
+
+dlog = logging.getLogger('mailman.debug')
+
+
+@public
+def parse_filebase(filebase):
+    """Split a queue file base into its parts.
+
+    File bases are of the form `time+digest`, optionally followed by
+    `+pN` for files in priority lane N and `+dT` for files which are not
+    due until time T.
+
+    :param filebase: The queue file base.
+    :type filebase: str
+    :return: A 4-tuple of the time the message was received, the sha1 hex
+        digest, the priority lane and the time the file is due, or None if it
+        is due immediately.
+    :rtype: (float, str, int, float or None)
+    """
+    when, digest, *extra = filebase.split('+')
+    priority = 0
+    due = None
+    for part in extra:
+        if part.startswith('p'):
+            priority = int(part[1:])
+        elif part.startswith('d'):
+            due = float(part[1:])
+    return float(when), digest, priority, due
+
+
+@public
+class QueueIndex:
+    """The FIFO ordered set of queue files with a given extension."""
+
+    def __init__(self, directory, extension='.pck', accept=None,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL, watch=True,
+                 priority_boost=0, clock=None):
+        """Create a queue index.
+
+        :param directory: The queue directory.
+        :type directory: str
+        :param extension: Only files with this extension are indexed.
+        :type extension: str
+        :param accept: Optional predicate which is passed the digest part of
+            a file base and returns whether the file belongs in this index.
+            This is how queue slices are implemented.
+        :type accept: callable
+        :param rescan_interval: Number of seconds between full rescans of the
+            directory when it is being watched.
+        :type rescan_interval: float
+        :param watch: Whether to try to watch the directory with inotify.
+        :type watch: bool
+        :param priority_boost: Number of seconds per priority lane by which
+            files are ordered ahead of files received at the same time.
+        :type priority_boost: float
+        :param clock: Optional function returning the current time, against
+            which the times files are due are compared.  Without it, all
+            files are due immediately.
+        :type clock: callable
+        """
+        self.directory = directory
+        self.extension = extension
+        self.rescan_interval = rescan_interval
+        self.priority_boost = priority_boost
+        self._clock = clock
+        self._accept = accept
+        self._watch = watch
+        self._watcher = None
+        self._pid = None
+        self._last_scan = None
+        # The live file bases, the sorted (when, filebase) keys which may
+        # include stale entries for file bases no longer in the queue, and
+        # the file bases outside of our slice so we don't parse them again.
+        self._live = set()
+        self._order = []
+        self._stale = 0
+        self._ignored = set()
+        # The file bases which aren't due yet, mapped to the time they are
+        # due, and a heap of (due, filebase) which may include stale entries.
+        self._delayed = {}
+        self._heap = []
+
+    @property
+    def watching(self):
+        """True if the index is being kept current by inotify."""
+        return self._watcher is not None
+
+    def fileno(self):
+        """The watcher's file descriptor, or None when not watching."""
+        return None if self._watcher is None else self._watcher.fileno()
+
+    @property
+    def files(self):
+        """The file bases in the queue, in FIFO order."""
+        self.refresh()
+        self._release()
+        if self._stale > len(self._order) // 2:
+            self._order = [key for key in self._order if key[1] in self._live]
+            self._stale = 0
+        live = self._live
+        return [filebase for when, filebase in self._order
+                if filebase in live]
+
+    @property
+    def delayed(self):
+        """The file bases which are not due yet, in the order they are due."""
+        self.refresh()
+        self._release()
+        return sorted(self._delayed, key=self._delayed.get)
+
+    @property
+    def next_due(self):
+        """The time the next delayed file is due, or None if there are none.
+        """
+        self.refresh()
+        self._release()
+        return self._next_due()
+
+    def __len__(self):
+        self.refresh()
+        self._release()
+        return len(self._live)
+
+    def wait(self, timeout, wakeup=None):
+        """Wait for the queue directory to change.
+
+        The wait ends when an event for the directory is pending, when the
+        next delayed file falls due, when `wakeup` becomes readable or when
+        `timeout` seconds have passed, whichever comes first.  Pending events
+        are left for the next refresh, so changes which happened since the
+        last one end the wait right away.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        :param wakeup: Optional file descriptor which also ends the wait when
+            it becomes readable.
+        :type wakeup: int
+        :return: True after waiting, or False without waiting if the
+            directory isn't being watched.
+        :rtype: bool
+        """
+        if self._watcher is None or self._pid != os.getpid():
+            return False
+        due = self._next_due()
+        if due is not None:
+            timeout = max(0, min(timeout, due - self._clock()))
+        fds = [self._watcher.fileno()]
+        if wakeup is not None:
+            fds.append(wakeup)
+        select.select(fds, [], [], timeout)
+        return True
+
+    def refresh(self):
+        """Bring the index up to date with the queue directory."""
+        pid = os.getpid()
+        if self._pid != pid:
+            # Either this is the first refresh, or we've been forked and the
+            # watcher belongs to the parent.  Start over.
+            self._pid = pid
+            self.close()
+            self._start_watching()
+            self.rescan()
+            return
+        if self._watcher is None:
+            self.rescan()
+            return
+        events = self._watcher.read_events()
+        for mask, name in events:
+            if mask & IN_RESET:
+                # Events were dropped or the directory went away, so the index
+                # can't be trusted any more.  Try to watch again then rescan.
+                dlog.debug('Queue index reset: %s', self.directory)
+                self.close()
+                self._start_watching()
+                self.rescan()
+                return
+            if name is None:
+                continue
+            filebase, ext = os.path.splitext(name)
+            if ext != self.extension:
+                continue
+            if mask & (IN_MOVED_TO | IN_CLOSE_WRITE):
+                self._add(filebase)
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self._discard(filebase)
+        if time.monotonic() - self._last_scan >= self.rescan_interval:
+            self.rescan()
+
+    def rescan(self):
+        """Reconcile the index with a full listing of the queue directory."""
+        seen = set()
+        for filename in os.listdir(self.directory):
+            # By ignoring anything that doesn't end in the extension, we
+            # ignore tempfiles and avoid a race condition.
+            filebase, ext = os.path.splitext(filename)
+            if ext != self.extension:
+                continue
+            seen.add(filebase)
+            if (filebase not in self._live and filebase not in self._delayed
+                    and filebase not in self._ignored):
+                self._add(filebase)
+        for filebase in (self._live | self._delayed.keys()) - seen:
+            self._discard(filebase)
+        self._ignored &= seen
+        self._last_scan = time.monotonic()
+
+    def close(self):
+        """Stop watching the queue directory."""
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    def _start_watching(self):
+        if not self._watch:
+            return
+        try:
+            # The watch must be in place before the rescan that follows it,
+            # otherwise files arriving in between would be missed.
+            self._watcher = DirectoryWatcher(self.directory)
+        except OSError as error:
+            dlog.debug('Not watching queue directory %s: %s',
+                       self.directory, error)
+            self._watcher = None
+
+    def _add(self, filebase):
+        if filebase in self._live or filebase in self._delayed:
+            return
+        when, digest, priority, due = parse_filebase(filebase)
+        if self._accept is not None and not self._accept(digest):
+            self._ignored.add(filebase)
+            return
+        if (due is not None and self._clock is not None
+                and due > self._clock()):
+            self._delayed[filebase] = due
+            heappush(self._heap, (due, filebase))
+            return
+        self._insert(filebase, when - priority * self.priority_boost)
+
+    def _next_due(self):
+        heap = self._heap
+        while heap and heap[0][1] not in self._delayed:
+            heappop(heap)
+        return heap[0][0] if heap else None
+
+    def _release(self):
+        # Move the delayed files which have become due into the queue.  They
+        # keep their place by the time they were received.
+        heap = self._heap
+        if not heap:
+            return
+        now = self._clock()
+        while heap and heap[0][0] <= now:
+            due, filebase = heappop(heap)
+            if self._delayed.pop(filebase, None) is not None:
+                when, digest, priority, _ = parse_filebase(filebase)
+                self._insert(filebase, when - priority * self.priority_boost)
+
+    def _insert(self, filebase, when):
+        self._live.add(filebase)
+        key = (when, filebase)
+        order = self._order
+        # Files almost always arrive in FIFO order, so appending is the
+        # common case unless priority lanes are in use.  A file that was
+        # dequeued and then recovered may still have its stale key in the
+        # list, so revive that instead of adding a duplicate.
+        if not order or key > order[-1]:
+            order.append(key)
+            return
+        i = bisect_left(order, key)
+        if i < len(order) and order[i] == key:
+            self._stale -= 1
+        else:
+            insort(order, key, i)
+
+    def _discard(self, filebase):
+        if filebase in self._live:
+            self._live.remove(filebase)
+            self._stale += 1
+        elif filebase in self._delayed:
+            # Its heap entry is dropped when it reaches the top.
+            del self._delayed[filebase]
+        else:
+            self._ignored.discard(filebase)
@@ -17,21 +17,26 @@
 
 """The process runner base class."""
 
+import os
 import time
 import signal
 import logging
 import traceback
 
-from contextlib import suppress
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import ExitStack, suppress
+from functools import partial
 from io import StringIO
 from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.core.logging import reopen
-from mailman.core.switchboard import Switchboard
+from mailman.core.queueindex import parse_filebase
+from mailman.core.switchboard import group_commit
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.runner import IRunner, RunnerCrashEvent
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 from public import public
 from zope.component import getUtility
@@ -48,6 +53,9 @@ rlog = logging.getLogger('mailman.runner')
 @implementer(IRunner)
 class Runner:
     is_queue_runner = True
+    # Seconds between checks for higher priority files arriving while a
+    # batch of files is being processed.
+    preempt_interval = 1
 
     def __init__(self, name, slice=None):
         """Create a runner.
@@ -67,18 +75,40 @@ class Runner:
         # should not have queue_directory or switchboard instance.
         if self.is_queue_runner:
             self.queue_directory = expand(section.path, None, substitutions)
-            self.switchboard = Switchboard(
-                name, self.queue_directory, slice, numslices, True)
+            rescan_interval = as_timedelta(
+                section.queue_rescan_interval).total_seconds()
+            priority_boost = as_timedelta(
+                section.priority_boost).total_seconds()
+            switchboard_class = find_name(section.switchboard)
+            self.switchboard = switchboard_class(
+                name, self.queue_directory, slice, numslices, True,
+                rescan_interval, priority_boost)
+            self.wakeup_timeout = rescan_interval
         else:
             self.queue_directory = None
             self.switchboard = None
+            self.wakeup_timeout = None
         self.sleep_time = as_timedelta(section.sleep_time)
         # sleep_time is a timedelta; turn it into a float for time.sleep().
         self.sleep_float = (86400 * self.sleep_time.days +
                             self.sleep_time.seconds +
                             self.sleep_time.microseconds / 1.0e6)
         self.max_restarts = int(section.max_restarts)
+        self.group_commit = as_boolean(section.group_commit)
+        self.batch_commit_size = int(section.batch_commit_size)
+        self.batch_commit_interval = as_timedelta(
+            section.batch_commit_interval).total_seconds()
+        self.concurrency = int(section.concurrency)
+        # The files processed in the current database transaction, which are
+        # finished when it is committed, and when the first was added.
+        self._batch = []
+        self._batch_start = None
+        self.work_stealing = as_boolean(section.work_stealing)
+        self.event_wakeup = as_boolean(section.event_wakeup)
         self.start = as_boolean(section.start)
+        # Becomes readable when a signal arrives; see set_signals().
+        self._wakeup_fd = None
+        self._wakeup_write_fd = None
         self._stop = False
         self.status = 0
 
@@ -105,6 +135,17 @@ class Runner:
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGUSR1, self.signal_handler)
+        # Python retries system calls interrupted by signals, so have signals
+        # end any wait for new files too.  Otherwise stopping the runner
+        # would be delayed until the wait times out.
+        if (self.event_wakeup and self.switchboard is not None and
+                self._wakeup_fd is None):
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(read_fd, False)
+            os.set_blocking(write_fd, False)
+            signal.set_wakeup_fd(write_fd)
+            self._wakeup_fd = read_fd
+            self._wakeup_write_fd = write_fd
 
     def stop(self):
         """See `IRunner`."""
@@ -128,6 +169,18 @@ class Runner:
                 # work now or not.
                 self._snooze(filecnt)
         self._clean_up()
+        self._close()
+
+    def _close(self):
+        # Stop watching the queue, and close the signal wakeup pipe.
+        if self.switchboard is not None:
+            self.switchboard.close()
+        if self._wakeup_fd is not None:
+            signal.set_wakeup_fd(-1)
+            os.close(self._wakeup_fd)
+            os.close(self._wakeup_write_fd)
+            self._wakeup_fd = None
+            self._wakeup_write_fd = None
 
     def _one_iteration(self):
         """See `IRunner`."""
@@ -136,12 +189,28 @@ class Runner:
         # List all the files in our queue directory.  The switchboard is
         # guaranteed to hand us the files in FIFO order.
         files = self.switchboard.files
-        for filebase in files:
+        self._last_listing = time.time()
+        if len(files) == 0 and self.work_stealing:
+            # Our slice is empty, so help out with the others.
+            files = self.switchboard.steal_files()
+            if len(files) > 0:
+                dlog.debug('[%s] stealing %d files', me, len(files))
+        # When batching, the database changes for each file are made in a
+        # savepoint, and several files are committed together.
+        batching = self.batch_commit_size > 1
+        # The files whose _dispose() returned a future, and which will be
+        # finished once it is done.
+        in_flight = []
+        for index, filebase in enumerate(files):
             dlog.debug('[%s] processing filebase: %s', me, filebase)
             try:
                 # Ask the switchboard for the message and metadata objects
                 # associated with this queue file.
                 msg, msgdata = self.switchboard.dequeue(filebase)
+            except FileNotFoundError:
+                # Another runner dequeued it first.
+                dlog.debug('[%s] already dequeued: %s', me, filebase)
+                continue
             except Exception as error:
                 # This used to just catch email.Errors.MessageParseError, but
                 # other problems can occur in message parsing, e.g.
@@ -152,53 +221,149 @@ class Runner:
                 elog.error('Skipping and preserving unparseable message: %s',
                            filebase)
                 self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
+                if not batching:
+                    config.db.abort()
                 continue
-            try:
-                dlog.debug('[%s] processing onefile', me)
-                self._process_one_file(msg, msgdata)
-                dlog.debug('[%s] finishing filebase: %s', me, filebase)
-                self.switchboard.finish(filebase)
-            except Exception as error:
-                # All runners that implement _dispose() must guarantee that
-                # exceptions are caught and dealt with properly.  Still, there
-                # may be a bug in the infrastructure, and we do not want those
-                # to cause messages to be lost.  Any uncaught exceptions will
-                # cause the message to be stored in the shunt queue for human
-                # intervention.
-                self._log(error)
-                # Put a marker in the metadata for unshunting.
-                msgdata['whichq'] = self.switchboard.name
-                # It is possible that shunting can throw an exception, e.g. a
-                # permissions problem or a MemoryError due to a really large
-                # message.  Try to be graceful.
-                try:
-                    shunt = config.switchboards['shunt']
-                    new_filebase = shunt.enqueue(msg, msgdata)
-                    elog.error('SHUNTING: %s', new_filebase)
-                    self.switchboard.finish(filebase)
-                except Exception as error:
-                    # The message wasn't successfully shunted.  Log the
-                    # exception and try to preserve the original queue entry
-                    # for possible analysis.
-                    self._log(error)
-                    elog.error(
-                        'SHUNTING FAILED, preserving original entry: %s',
-                        filebase)
-                    self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
+            future = self._handle_one_file(
+                filebase, msg, msgdata, batching,
+                partial(self._process_one_file, msg, msgdata))
+            if future is not None:
+                in_flight.append((filebase, msg, msgdata, future))
             # Other work we want to do each time through the loop.
             dlog.debug('[%s] doing periodic', me)
             self._do_periodic()
-            dlog.debug('[%s] committing transaction', me)
-            config.db.commit()
+            if not batching:
+                dlog.debug('[%s] committing transaction', me)
+                config.db.commit()
+            # Complete the files whose work is done, waiting for one of them
+            # when there's no room for another.
+            self._complete(
+                in_flight, batching, len(in_flight) >= self.concurrency)
+            if batching and (
+                    len(self._batch) >= self.batch_commit_size or
+                    (len(self._batch) > 0 and
+                     time.monotonic() - self._batch_start >=
+                     self.batch_commit_interval)):
+                self._commit_batch()
             dlog.debug('[%s] checking short circuit', me)
             if self._short_circuit():
                 dlog.debug('[%s] short circuiting', me)
                 break
+            if self._preempted(files[index + 1:]):
+                dlog.debug('[%s] preempted by higher priority files', me)
+                break
+        while len(in_flight) > 0:
+            self._complete(in_flight, batching, True)
+        if len(self._batch) > 0:
+            self._commit_batch()
         dlog.debug('[%s] ending oneloop: %s', me, len(files))
         return len(files)
 
+    def _handle_one_file(self, filebase, msg, msgdata, batching, process):
+        # Call process(), then finish the file, or shunt it if that fails.
+        # If process() returns a future, it is returned instead, and the file
+        # is left alone until the future is done.
+        me = self.__class__.__name__
+        try:
+            dlog.debug('[%s] processing onefile', me)
+            # With group commit, everything this file enqueues must be
+            # durable before its backup file is finished.
+            with ExitStack() as resources:
+                if batching:
+                    resources.enter_context(config.db.savepoint())
+                if self.group_commit:
+                    resources.enter_context(group_commit())
+                future = process()
+            if future is not None:
+                return future
+            if batching:
+                # The backup file must outlive the uncommitted changes,
+                # so that the file is processed again if they are lost.
+                if len(self._batch) == 0:
+                    self._batch_start = time.monotonic()
+                self._batch.append(filebase)
+            else:
+                dlog.debug('[%s] finishing filebase: %s', me, filebase)
+                self.switchboard.finish(filebase)
+        except Exception as error:
+            # All runners that implement _dispose() must guarantee that
+            # exceptions are caught and dealt with properly.  Still, there
+            # may be a bug in the infrastructure, and we do not want those
+            # to cause messages to be lost.  Any uncaught exceptions will
+            # cause the message to be stored in the shunt queue for human
+            # intervention.
+            self._log(error)
+            # Put a marker in the metadata for unshunting.
+            msgdata['whichq'] = self.switchboard.name
+            # It is possible that shunting can throw an exception, e.g. a
+            # permissions problem or a MemoryError due to a really large
+            # message.  Try to be graceful.
+            try:
+                shunt = config.switchboards['shunt']
+                new_filebase = shunt.enqueue(msg, msgdata)
+                elog.error('SHUNTING: %s', new_filebase)
+                self.switchboard.finish(filebase)
+            except Exception as error:
+                # The message wasn't successfully shunted.  Log the
+                # exception and try to preserve the original queue entry
+                # for possible analysis.
+                self._log(error)
+                elog.error(
+                    'SHUNTING FAILED, preserving original entry: %s',
+                    filebase)
+                self.switchboard.finish(filebase, preserve=True)
+            # When batching, only this file's savepoint has been rolled
+            # back, leaving the rest of the batch alone.
+            if not batching:
+                config.db.abort()
+        return None
+
+    def _complete(self, in_flight, batching, block):
+        # Complete and finish the in-flight files whose futures are done.
+        # When blocking, first wait for at least one of them to be done.
+        if block and len(in_flight) > 0:
+            wait([item[3] for item in in_flight], return_when=FIRST_COMPLETED)
+        for item in [item for item in in_flight if item[3].done()]:
+            in_flight.remove(item)
+            filebase, msg, msgdata, future = item
+            self._handle_one_file(
+                filebase, msg, msgdata, batching,
+                partial(self._complete_one_file, msg, msgdata, future))
+            if not batching:
+                config.db.commit()
+
+    def _complete_one_file(self, msg, msgdata, future):
+        # The future's result completes the disposition in this thread.
+        if future.result()():
+            self.switchboard.enqueue(msg, msgdata)
+
+    def _commit_batch(self):
+        me = self.__class__.__name__
+        dlog.debug('[%s] committing batch of %d files', me, len(self._batch))
+        # If the commit fails, the exception propagates and the backup files
+        # are left to be recovered, like any other failed commit.
+        config.db.commit()
+        for filebase in self._batch:
+            dlog.debug('[%s] finishing filebase: %s', me, filebase)
+            self.switchboard.finish(filebase)
+        self._batch = []
+        self._batch_start = None
+
+    def _preempted(self, remaining):
+        # Every so often, look at the head of the queue.  If files in a
+        # higher priority lane than the rest of this batch have arrived, stop
+        # processing the batch so that the next iteration picks them up first.
+        if len(remaining) == 0:
+            return False
+        now = time.time()
+        if now - self._last_listing < self.preempt_interval:
+            return False
+        self._last_listing = now
+        files = self.switchboard.files
+        if len(files) == 0 or files[0] == remaining[0]:
+            return False
+        return parse_filebase(files[0])[2] > parse_filebase(remaining[0])[2]
+
     def _process_one_file(self, msg, msgdata):
         """See `IRunner`."""
         # Do some common sanity checking on the message metadata.  It's got to
@@ -254,8 +419,11 @@ class Runner:
                 # Trigger the Zope event and re-raise
                 notify(RunnerCrashEvent(self, mlist, msg, msgdata, error))
                 raise
+        if isinstance(keepqueued, Future):
+            return keepqueued
         if keepqueued:
             self.switchboard.enqueue(msg, msgdata)
+        return None
 
     def _log(self, exc):
         elog.error('Uncaught runner exception: %s', exc)
@@ -279,7 +447,25 @@ class Runner:
         """See `IRunner`."""
         if filecnt or self.sleep_float <= 0:
             return
-        time.sleep(self.sleep_float)
+        self._sleep()
+
+    def _sleep(self, limit=None):
+        # Sleep for the sleep time, or with event wakeup, until new files
+        # arrive.  Either way, wake up after at most `limit` seconds.
+        sleep_float = self.sleep_float
+        wakeup_timeout = self.wakeup_timeout
+        if limit is not None:
+            limit = max(0, limit)
+            sleep_float = min(sleep_float, limit)
+            if wakeup_timeout is not None:
+                wakeup_timeout = min(wakeup_timeout, limit)
+        if (self.event_wakeup and self.switchboard is not None and
+                self.switchboard.wait(wakeup_timeout, self._wakeup_fd)):
+            if self._wakeup_fd is not None:
+                with suppress(BlockingIOError):
+                    os.read(self._wakeup_fd, 512)
+            return
+        time.sleep(sleep_float)
 
     def _short_circuit(self):
         """See `IRunner`."""
@@ -0,0 +1,419 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A switchboard which keeps its queue in an SQLite database.
+
+Instead of one file per message, every queue entry is a row in a database
+kept in the queue directory.  The rows hold exactly what a queue file would,
+along with the entry's state, which is named after the extension the file
+would have: .pck for pending entries, .bak for entries which have been
+dequeued but not yet finished, and .psv for preserved entries.  Each state
+change is a single transaction, so a dequeue atomically claims its entry.
+Delayed entries record when they are due, and are only listed from then on.
+Backup entries record the process which claimed them, by its pid and its
+start time, so that they are only recovered once that process is gone, even
+if another process has since been given the same pid.
+
+The database is used in write-ahead logging mode, so runners reading the
+queue don't block the processes enqueuing to it.  After committing new
+pending entries, a wakeup file in the queue directory is written to, so that
+on Linux, idle runners can wait for it with inotify.
+"""
+
+import os
+import errno
+import select
+import logging
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from io import BytesIO
+from mailman.config import config
+from mailman.core.queueindex import parse_filebase
+from mailman.core.switchboard import (
+    MAX_BAK_COUNT, count_recovery, defer_commit, deserialize, digest_slice,
+    due_clock, serialize, steal)
+from mailman.interfaces.switchboard import ISwitchboard
+from mailman.utilities.filesystem import makedirs
+from mailman.utilities.inotify import DirectoryWatcher, IN_CLOSE_WRITE
+from public import public
+from zope.interface import implementer
+
+
+# The name of the database file in the queue directory.
+DATABASE = 'queue.sqlite'
+# The name of the file written to when pending entries are added.
+WAKEUP = 'queue.wakeup'
+# Seconds to wait for another process to release its lock on the database.
+LOCK_TIMEOUT = 60
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS entry (
+    filebase TEXT PRIMARY KEY,
+    extension TEXT NOT NULL,
+    received REAL NOT NULL,
+    priority INTEGER NOT NULL,
+    due REAL,
+    claimant INTEGER,
+    claimant_start INTEGER,
+    contents BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS entry_order ON entry (extension, received);
+"""
+INSERT = """\
+INSERT INTO entry (filebase, extension, received, priority, due, contents)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+# Pending entries which are due.
+DUE = "extension = '.pck' AND (due IS NULL OR due <= ?)"
+# Entries in higher priority lanes are ordered as if they had been received
+# earlier, just like queue files.
+ORDER = 'ORDER BY received - priority * ?, filebase'
+
+dlog = logging.getLogger('mailman.debug')
+elog = logging.getLogger('mailman.error')
+
+
+def _start_time(pid):
+    # Return the start time of the process, which tells it apart from any
+    # later process with the same pid, or None if it isn't known.
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as fp:
+            stat = fp.read()
+    except OSError:
+        return None
+    # The command name may contain spaces and parentheses, so count the
+    # fields from after it.  The start time is the 22nd field.
+    return int(stat[stat.rindex(b')') + 2:].split()[19])
+
+
+def _alive(pid, start_time=None):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to another user.
+        pass
+    # Without a start time, e.g. on systems without /proc, a process which
+    # reused the pid can't be told apart.
+    return start_time is None or _start_time(pid) == start_time
+
+
+def _row(filebase, extension, contents):
+    received, digest, priority, due = parse_filebase(filebase)
+    return filebase, extension, received, priority, due, contents
+
+
+@public
+@implementer(ISwitchboard)
+class SQLiteSwitchboard:
+    """See `ISwitchboard`."""
+
+    def __init__(self, name, queue_directory,
+                 slice=None, numslices=1, recover=False,
+                 rescan_interval=None, priority_boost=0):
+        """Create a switchboard object.
+
+        :param name: The queue name.
+        :type name: str
+        :param queue_directory: The queue directory, which holds the
+            database.
+        :type queue_directory: str
+        :param slice: The slice number for this switchboard, or None.  If not
+            None, it must be [0..`numslices`).
+        :type slice: int or None
+        :param numslices: The total number of slices to split this queue
+            into.
+        :type numslices: int
+        :param recover: True if backup entries should be recovered.
+        :type recover: bool
+        :param rescan_interval: Ignored, since there is no directory to scan.
+        :param priority_boost: Seconds per priority lane by which entries are
+            ordered ahead of entries received at the same time.
+        :type priority_boost: float
+        """
+        self.name = name
+        self.queue_directory = queue_directory
+        # If configured to, create the directory if it doesn't yet exist.
+        if config.create_paths:
+            makedirs(self.queue_directory, 0o770)
+        self.database = os.path.join(queue_directory, DATABASE)
+        self._wakeup = os.path.join(queue_directory, WAKEUP)
+        self._slice = None if numslices == 1 else slice
+        self._numslices = numslices
+        self._priority_boost = priority_boost
+        # The connection and any enqueues deferred by a group commit, per
+        # thread.
+        self._local = threading.local()
+        # The watcher of the queue directory, and the process it belongs to.
+        self._watcher = None
+        self._watcher_pid = None
+        if recover:
+            self.recover_backup_files()
+
+    @property
+    def _connection(self):
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            # Either this is the first use in this thread, or we've been
+            # forked and the connection belongs to the parent.
+            connection = sqlite3.connect(
+                self.database, timeout=LOCK_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            # Be as durable as a synced queue file.
+            connection.execute('PRAGMA synchronous = FULL')
+            connection.executescript(SCHEMA)
+            local.connection = connection
+            local.pid = pid
+        return local.connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection
+        # Take the write lock up front, so that reading and then updating an
+        # entry can't race with another runner doing the same.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def enqueue(self, _msg, _metadata=None, **_kws):
+        """See `ISwitchboard`."""
+        filebase, contents = serialize(_msg, _metadata, _kws)
+        row = _row(filebase, '.pck', contents)
+        # Inside a group commit, all the entries enqueued to this queue are
+        # inserted in one transaction when the group is committed.
+        pending = getattr(self._local, 'pending', None)
+        if pending is None and defer_commit(self._commit):
+            pending = self._local.pending = []
+        if pending is None:
+            with self._transaction() as connection:
+                connection.execute(INSERT, row)
+            self._wake_up()
+        else:
+            pending.append(row)
+        return filebase
+
+    def _commit(self):
+        rows = self._local.pending
+        self._local.pending = None
+        with self._transaction() as connection:
+            connection.executemany(INSERT, rows)
+        self._wake_up()
+
+    def _wake_up(self):
+        # Tell the runners waiting for new entries.  This must only be done
+        # once the entries have been committed, otherwise they might look
+        # before the entries are visible to them.
+        with open(self._wakeup, 'wb'):
+            pass
+
+    def dequeue(self, filebase):
+        """See `ISwitchboard`."""
+        # Claim the entry by moving it to the backup state.  If this process
+        # crashes uncleanly, the backup entry will be recovered in order to
+        # try again.
+        with self._transaction() as connection:
+            row = connection.execute("""
+                SELECT contents FROM entry
+                WHERE filebase = ? AND extension = '.pck'
+                """, (filebase,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, 'No such queue entry', filebase)
+            pid = os.getpid()
+            connection.execute("""
+                UPDATE entry
+                SET extension = '.bak', claimant = ?, claimant_start = ?
+                WHERE filebase = ?
+                """, (pid, _start_time(pid), filebase))
+        return deserialize(BytesIO(row[0]))
+
+    def finish(self, filebase, preserve=False):
+        """See `ISwitchboard`."""
+        try:
+            with self._transaction() as connection:
+                row = connection.execute("""
+                    SELECT contents FROM entry
+                    WHERE filebase = ? AND extension = '.bak'
+                    """, (filebase,)).fetchone()
+                if row is None:
+                    raise FileNotFoundError(
+                        errno.ENOENT, 'No such backup entry', filebase)
+                bad = config.switchboards['bad'] if preserve else None
+                if getattr(bad, 'database', None) == self.database:
+                    connection.execute("""
+                        UPDATE entry SET extension = '.psv'
+                        WHERE filebase = ?
+                        """, (filebase,))
+                    return
+                if bad is not None:
+                    bad.preserve(filebase, row[0])
+                connection.execute(
+                    'DELETE FROM entry WHERE filebase = ?', (filebase,))
+        except (EnvironmentError, sqlite3.Error):
+            elog.exception(
+                'Failed to remove/preserve backup entry: %s', filebase)
+
+    def preserve(self, filebase, contents):
+        """See `ISwitchboard`."""
+        with self._transaction() as connection:
+            connection.execute(
+                'DELETE FROM entry WHERE filebase = ?', (filebase,))
+            connection.execute(INSERT, _row(filebase, '.psv', contents))
+
+    @property
+    def files(self):
+        """See `ISwitchboard`."""
+        return self.get_files()
+
+    def get_files(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        if extension == '.pck':
+            # Start watching before listing, so that a wait which follows
+            # won't miss entries added in between.
+            self._get_watcher()
+            rows = self._connection.execute(
+                'SELECT filebase FROM entry WHERE ' + DUE + ' ' + ORDER,
+                (due_clock(), self._priority_boost))
+        else:
+            rows = self._connection.execute(
+                'SELECT filebase FROM entry WHERE extension = ? ' + ORDER,
+                (extension, self._priority_boost))
+        return self._sliced(rows)
+
+    @property
+    def delayed_files(self):
+        """See `ISwitchboard`."""
+        rows = self._connection.execute("""
+            SELECT filebase FROM entry
+            WHERE extension = '.pck' AND due > ?
+            ORDER BY due, filebase
+            """, (due_clock(),))
+        return self._sliced(rows)
+
+    def _sliced(self, rows):
+        if self._slice is None:
+            return [filebase for (filebase,) in rows]
+        return [filebase for (filebase,) in rows
+                if self._in_slice(parse_filebase(filebase)[1])]
+
+    def steal_files(self):
+        """See `ISwitchboard`."""
+        if self._slice is None:
+            return []
+        rows = self._connection.execute(
+            'SELECT filebase FROM entry WHERE ' + DUE + ' ' + ORDER,
+            (due_clock(), self._priority_boost))
+        return steal([filebase for (filebase,) in rows
+                      if not self._in_slice(parse_filebase(filebase)[1])])
+
+    def wait(self, timeout, wakeup=None):
+        """See `ISwitchboard`."""
+        watcher = self._get_watcher()
+        if watcher is None:
+            return False
+        # Fetch all the rows, so that the statement is finished and doesn't
+        # keep a stale read transaction open.
+        [(due,)] = self._connection.execute("""
+            SELECT MIN(due) FROM entry WHERE extension = '.pck' AND due > ?
+            """, (due_clock(),)).fetchall()
+        if due is not None:
+            timeout = max(0, min(timeout, due - due_clock()))
+        fds = [watcher.fileno()]
+        if wakeup is not None:
+            fds.append(wakeup)
+        select.select(fds, [], [], timeout)
+        # Only whether new entries were added matters, not how many times.
+        watcher.read_events()
+        return True
+
+    def _get_watcher(self):
+        pid = os.getpid()
+        if self._watcher_pid != pid:
+            # Don't use a watcher inherited from the parent process.
+            self._watcher_pid = pid
+            self._watcher = None
+            try:
+                self._watcher = DirectoryWatcher(
+                    self.queue_directory, IN_CLOSE_WRITE)
+            except OSError as error:
+                dlog.debug('Not watching queue directory %s: %s',
+                           self.queue_directory, error)
+        return self._watcher
+
+    def _in_slice(self, digest):
+        return digest_slice(digest, self._numslices) == self._slice
+
+    def close(self):
+        """See `ISwitchboard`."""
+        if self._watcher is not None:
+            self._watcher.close()
+        self._watcher = None
+        self._watcher_pid = None
+
+    def recover_backup_files(self):
+        """See `ISwitchboard`."""
+        # Move all backup entries in our slice back to the pending state,
+        # counting the number of times each has been recovered in its
+        # metadata.  When the count reaches MAX_BAK_COUNT, the entry is
+        # preserved in the bad queue instead.
+        backups = self.get_files('.bak')
+        for filebase in backups:
+            with self._transaction() as connection:
+                row = connection.execute("""
+                    SELECT claimant, claimant_start, contents FROM entry
+                    WHERE filebase = ? AND extension = '.bak'
+                    """, (filebase,)).fetchone()
+                if row is None:
+                    # Another runner got to it first.
+                    continue
+                claimant, claimant_start, contents = row
+                # Skip entries which are being processed by another live
+                # process, e.g. one which stole them from our slice.
+                if (claimant is not None and claimant != os.getpid()
+                        and _alive(claimant, claimant_start)):
+                    continue
+                fp = BytesIO(contents)
+                try:
+                    data = count_recovery(fp)
+                except Exception as error:
+                    # If unpickling throws any exception, just log and
+                    # preserve this entry
+                    elog.error('Unpickling .bak exception: %s\n'
+                               'Preserving entry: %s', error, filebase)
+                    preserve = True
+                else:
+                    preserve = (data['_bak_count'] >= MAX_BAK_COUNT)
+                    if preserve:
+                        elog.error('.bak entry max count, preserving: %s',
+                                   filebase)
+                    connection.execute("""
+                        UPDATE entry SET contents = ?, extension = ?
+                        WHERE filebase = ?
+                        """, (fp.getvalue(), '.bak' if preserve else '.pck',
+                              filebase))
+            if preserve:
+                self.finish(filebase, preserve=True)
+        if len(backups) > 0:
+            self._wake_up()
@@ -15,45 +15,76 @@
 # You should have received a copy of the GNU General Public License along with
 # GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Queuing and dequeuing message/metadata pickle files.
+"""Queuing and dequeuing message/metadata queue files.
 
 Messages are represented as email.message.Message objects (or an instance ofa
 subclass).  Metadata is represented as a Python dictionary.  For every
-message/metadata pair in a queue, a single file containing two pickles is
-written.  First, the message is written to the pickle, then the metadata
-dictionary is written.
+message/metadata pair in a queue, a single file is written.  It starts with a
+small fixed header, followed by the raw RFC 5322 bytes of the message and then
+the pickled metadata dictionary.  Dequeued messages are `LazyMessage`s, which
+only parse the message body when it is needed.
+
+Older queue files, and messages which can't be flattened to bytes, contain
+two pickles instead: first the message object, then the metadata dictionary.
 """
 
 import os
 import time
 import email
+import errno
+import fcntl
 import pickle
+import struct
 import hashlib
 import logging
+import threading
 
+from contextlib import contextmanager, suppress
+from datetime import timezone
+from email.policy import compat32
+from lazr.config import as_timedelta
 from mailman.config import config
-from mailman.email.message import Message
+from mailman.core.queueindex import DEFAULT_RESCAN_INTERVAL, QueueIndex
+from mailman.email.message import LazyMessage, Message
 from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 from mailman.interfaces.switchboard import ISwitchboard
 from mailman.utilities.filesystem import makedirs
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 from public import public
 from zope.interface import implementer
 
 
-# 20 bytes of all bits set, maximum hashlib.sha.digest() value.  We do it this
-# way for Python 2/3 compatibility.
-shamax = int('0xffffffffffffffffffffffffffffffffffffffff', 16)
-# Small increment to add to time in case two entries have the same time.  This
-# prevents skipping one of two entries with the same time until the next pass.
-DELTA = .0001
+# The number of bits in the sha1 hex digests of queue file names.
+DIGEST_BITS = 160
 # We count the number of times a file has been moved to .bak and recovered.
 # In order to prevent loops and a message flood, when the count reaches this
 # value, we move the file to the bad queue as a .psv.
 MAX_BAK_COUNT = 3
+# Queue files in the raw format start with this magic and a header giving the
+# schema version, the length of the raw message and the message's original
+# size, or NO_SIZE if it has none.
+QFILE_MAGIC = b'MMQF'
+QFILE_HEADER = struct.Struct('>4sBQQ')
+NO_SIZE = 2 ** 64 - 1
+# The instance attributes of messages which can be stored as raw bytes.
+FLAT_ATTRIBUTES = frozenset((
+    'policy', 'preamble', 'epilogue', 'defects', 'original_size',
+    '_headers', '_unixfrom', '_payload', '_charset', '_default_type',
+    '_raw', '_raw_headers', '_raw_unixfrom', '_body'))
+# The instance attributes of messages which only cache what can be computed
+# from the others, and are not stored.
+CACHE_ATTRIBUTES = frozenset(('_wire',))
+# Flatten messages just like they are flattened for delivery, i.e. without
+# folding headers.
+QFILE_POLICY = compat32.clone(max_line_length=0)
 
+dlog = logging.getLogger('mailman.debug')
 elog = logging.getLogger('mailman.error')
 
+# Enqueues inside a group_commit() context, per thread.
+_local = threading.local()
+
 
 @public
 @implementer(ISwitchboard)
@@ -61,7 +92,8 @@ class Switchboard:
     """See `ISwitchboard`."""
 
     def __init__(self, name, queue_directory,
-                 slice=None, numslices=1, recover=False):
+                 slice=None, numslices=1, recover=False,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL, priority_boost=0):
         """Create a switchboard object.
 
         :param name: The queue name.
@@ -72,73 +104,54 @@ class Switchboard:
             None, it must be [0..`numslices`).
         :type slice: int or None
         :param numslices: The total number of slices to split this queue
-            directory into.  It must be a power of 2.
+            directory into.
         :type numslices: int
         :param recover: True if backup files should be recovered.
         :type recover: bool
+        :param rescan_interval: Seconds between full rescans of the queue
+            directory when its index is kept current by inotify.
+        :type rescan_interval: float
+        :param priority_boost: Seconds per priority lane by which files are
+            ordered ahead of files received at the same time.
+        :type priority_boost: float
         """
-        assert (numslices & (numslices - 1)) == 0, (
-            'Not a power of 2: {}'.format(numslices))
         self.name = name
         self.queue_directory = queue_directory
         # If configured to, create the directory if it doesn't yet exist.
         if config.create_paths:
             makedirs(self.queue_directory, 0o770)
-        # Fast track for no slices
-        self._lower = None
-        self._upper = None
-        # BAW: test performance and end-cases of this algorithm
-        if numslices != 1:
-            self._lower = ((shamax + 1) * slice) / numslices
-            self._upper = (((shamax + 1) * (slice + 1)) / numslices) - 1
+        self._slice = None if numslices == 1 else slice
+        self._numslices = numslices
+        # The indexes of .pck files are created on first use, since most
+        # switchboards are only ever enqueued to, and most runners never
+        # need to steal files.
+        self._rescan_interval = rescan_interval
+        self._priority_boost = priority_boost
+        self._index = None
+        self._steal_index = None
+        # The open, locked backup files of the dequeued but unfinished files.
+        self._claims = {}
         if recover:
             self.recover_backup_files()
 
     def enqueue(self, _msg, _metadata=None, **_kws):
         """See `ISwitchboard`."""
-        if _metadata is None:
-            _metadata = {}
-        # Calculate the SHA hexdigest of the message to get a unique base
-        # filename.  We're also going to use the digest as a hash into the set
-        # of parallel runner processes.
-        data = _metadata.copy()
-        data.update(_kws)
-        list_id = data.get('listid', '--nolist--')
-        # Get some data for the input to the sha hash.
-        now = repr(time.time())
-        if data.get('_plaintext'):
-            protocol = 0
-            msgsave = pickle.dumps(str(_msg), protocol)
-        else:
-            protocol = pickle.HIGHEST_PROTOCOL
-            msgsave = pickle.dumps(_msg, protocol)
-        # The list-id field is a string but the input to the hash function must
-        # be bytes.
-        hashfood = msgsave + list_id.encode('utf-8') + now.encode('utf-8')
-        # Encode the current time into the file name for FIFO sorting.  The
-        # file name consists of two parts separated by a '+': the received
-        # time for this message (i.e. when it first showed up on this system)
-        # and the sha hex digest.
-        filebase = now + '+' + hashlib.sha1(hashfood).hexdigest()
+        filebase, contents = serialize(_msg, _metadata, _kws)
         filename = os.path.join(self.queue_directory, filebase + '.pck')
         tmpfile = filename + '.tmp'
-        # Always add the metadata schema version number
-        data['version'] = config.QFILE_SCHEMA_VERSION
-        # Filter out volatile entries.  Use .keys() so that we can mutate the
-        # dictionary during the iteration.
-        for k in list(data):
-            if k.startswith('_'):
-                del data[k]
-        # We have to tell the dequeue() method whether to parse the message
-        # object or not.
-        data['_parsemsg'] = (protocol == 0)
-        # Write to the pickle file the message object and metadata.
+        # Write the message and metadata to the queue file.  Inside a
+        # group commit, the file is only synced and renamed into place when
+        # the group is committed.
+        pending = getattr(_local, 'pending', None)
         with open(tmpfile, 'wb') as fp:
-            fp.write(msgsave)
-            pickle.dump(data, fp, protocol)
+            fp.write(contents)
             fp.flush()
-            os.fsync(fp.fileno())
-        os.rename(tmpfile, filename)
+            if pending is None:
+                os.fsync(fp.fileno())
+        if pending is None:
+            os.rename(tmpfile, filename)
+        else:
+            pending.append((tmpfile, filename))
         return filebase
 
     def dequeue(self, filebase):
@@ -146,37 +159,66 @@ class Switchboard:
         # Calculate the filename from the given filebase.
         filename = os.path.join(self.queue_directory, filebase + '.pck')
         backfile = os.path.join(self.queue_directory, filebase + '.bak')
-        # Read the message object and metadata.
-        with open(filename, 'rb') as fp:
+        # Read the message object and metadata.  When several runners try
+        # to dequeue the same file, e.g. because one of them is stealing
+        # work, only the first one to rename it gets it.  The others get a
+        # FileNotFoundError.
+        fp = open(filename, 'rb+')
+        try:
+            # Keep the file locked until it is finished, so that it isn't
+            # recovered by another process while it is being processed.
+            try:
+                fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as error:
+                if error.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                raise FileNotFoundError(
+                    errno.ENOENT, 'Queue file is being recovered',
+                    filename) from None
             # Move the file to the backup file name for processing.  If this
             # process crashes uncleanly the .bak file will be used to
             # re-instate the .pck file in order to try again.
             os.rename(filename, backfile)
-            msg = pickle.load(fp)
-            data = pickle.load(fp)
-        if data.get('_parsemsg'):
-            # Calculate the original size of the text now so that we won't
-            # have to generate the message later when we do size restriction
-            # checking.
-            original_size = len(msg)
-            msg = email.message_from_string(msg, Message)
-            msg.original_size = original_size
-            data['original_size'] = original_size
-        return msg, data
+        except BaseException:
+            fp.close()
+            raise
+        self._claims[filebase] = fp
+        return deserialize(fp)
 
     def finish(self, filebase, preserve=False):
         """See `ISwitchboard`."""
         bakfile = os.path.join(self.queue_directory, filebase + '.bak')
+        claim = self._claims.pop(filebase, None)
         try:
             if preserve:
-                bad_dir = config.switchboards['bad'].queue_directory
-                psvfile = os.path.join(bad_dir, filebase + '.psv')
-                os.rename(bakfile, psvfile)
+                bad = config.switchboards['bad']
+                if isinstance(bad, Switchboard):
+                    psvfile = os.path.join(
+                        bad.queue_directory, filebase + '.psv')
+                    os.rename(bakfile, psvfile)
+                else:
+                    # The bad queue uses another backend.
+                    with open(bakfile, 'rb') as fp:
+                        bad.preserve(filebase, fp.read())
+                    os.unlink(bakfile)
             else:
                 os.unlink(bakfile)
         except EnvironmentError:
             elog.exception(
                 'Failed to unlink/preserve backup file: %s', bakfile)
+        finally:
+            if claim is not None:
+                claim.close()
+
+    def preserve(self, filebase, contents):
+        """See `ISwitchboard`."""
+        psvfile = os.path.join(self.queue_directory, filebase + '.psv')
+        tmpfile = psvfile + '.tmp'
+        with open(tmpfile, 'wb') as fp:
+            fp.write(contents)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmpfile, psvfile)
 
     @property
     def files(self):
@@ -185,26 +227,62 @@ class Switchboard:
 
     def get_files(self, extension='.pck'):
         """See `ISwitchboard`."""
-        times = {}
-        lower = self._lower
-        upper = self._upper
-        for f in os.listdir(self.queue_directory):
-            # By ignoring anything that doesn't end in .pck, we ignore
-            # tempfiles and avoid a race condition.
-            filebase, ext = os.path.splitext(f)
-            if ext != extension:
-                continue
-            when, digest = filebase.split('+', 1)
-            # Throw out any files which don't match our bitrange.  BAW: test
-            # performance and end-cases of this algorithm.  MAS: both
-            # comparisons need to be <= to get complete range.
-            if lower is None or (lower <= int(digest, 16) <= upper):
-                key = float(when)
-                while key in times:
-                    key += DELTA
-                times[key] = filebase
-        # FIFO sort
-        return [times[k] for k in sorted(times)]
+        accept = None if self._slice is None else self._in_slice
+        if extension != '.pck':
+            # Other extensions are only listed occasionally, e.g. when
+            # recovering backup files, so they aren't worth watching.
+            index = QueueIndex(
+                self.queue_directory, extension, accept, watch=False)
+            return index.files
+        if self._index is None:
+            self._index = QueueIndex(
+                self.queue_directory, extension, accept,
+                self._rescan_interval, priority_boost=self._priority_boost,
+                clock=due_clock)
+        return self._index.files
+
+    @property
+    def delayed_files(self):
+        """See `ISwitchboard`."""
+        self.get_files()
+        return self._index.delayed
+
+    def wait(self, timeout, wakeup=None):
+        """See `ISwitchboard`."""
+        if self._index is None:
+            # The queue hasn't been listed yet, so there's nothing to wait
+            # for.  Refreshing the index here would consume the events which
+            # should end the wait.
+            self.get_files()
+            return True
+        # Files in other slices wake us up too, since they may be stolen.
+        return self._index.wait(timeout, wakeup)
+
+    def steal_files(self):
+        """See `ISwitchboard`."""
+        if self._slice is None:
+            return []
+        if self._steal_index is None:
+            self._steal_index = QueueIndex(
+                self.queue_directory, '.pck', self._not_in_slice,
+                self._rescan_interval, priority_boost=self._priority_boost,
+                clock=due_clock)
+        return steal(self._steal_index.files)
+
+    def _in_slice(self, digest):
+        # Throw out any files which don't match our slice.
+        return digest_slice(digest, self._numslices) == self._slice
+
+    def _not_in_slice(self, digest):
+        return digest_slice(digest, self._numslices) != self._slice
+
+    def close(self):
+        """See `ISwitchboard`."""
+        for index in (self._index, self._steal_index):
+            if index is not None:
+                index.close()
+        self._index = None
+        self._steal_index = None
 
     def recover_backup_files(self):
         """See `ISwitchboard`."""
@@ -217,35 +295,360 @@ class Switchboard:
         for filebase in self.get_files('.bak'):
             src = os.path.join(self.queue_directory, filebase + '.bak')
             dst = os.path.join(self.queue_directory, filebase + '.pck')
-            with open(src, 'rb+') as fp:
+            # Files we dequeued ourselves are ours to recover.
+            claim = self._claims.pop(filebase, None)
+            if claim is not None:
+                claim.close()
+            try:
+                fp = open(src, 'rb+')
+            except FileNotFoundError:
+                # Another process finished or recovered it.
+                continue
+            with fp:
                 try:
-                    # Throw away the message object.
-                    pickle.load(fp)
-                    data_pos = fp.tell()
-                    data = pickle.load(fp)
+                    # Skip files which are being processed by another live
+                    # process, e.g. one which stole them from our slice.
+                    fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError as error:
+                    if error.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    continue
+                try:
+                    data = count_recovery(fp)
+                    fp.flush()
+                    os.fsync(fp.fileno())
                 except Exception as error:
                     # If unpickling throws any exception, just log and
                     # preserve this entry
                     elog.error('Unpickling .bak exception: %s\n'
                                'Preserving file: %s', error, filebase)
                     self.finish(filebase, preserve=True)
+                    continue
+                if data['_bak_count'] >= MAX_BAK_COUNT:
+                    elog.error('.bak file max count, preserving file: %s',
+                               filebase)
+                    self.finish(filebase, preserve=True)
                 else:
-                    data['_bak_count'] = data.get('_bak_count', 0) + 1
-                    fp.seek(data_pos)
-                    if data.get('_parsemsg'):
-                        protocol = 0
-                    else:
-                        protocol = 1
-                    pickle.dump(data, fp, protocol)
-                    fp.truncate()
-                    fp.flush()
-                    os.fsync(fp.fileno())
-                    if data['_bak_count'] >= MAX_BAK_COUNT:
-                        elog.error('.bak file max count, preserving file: %s',
-                                   filebase)
-                        self.finish(filebase, preserve=True)
-                    else:
-                        os.rename(src, dst)
+                    os.rename(src, dst)
+
+
+@public
+def digest_slice(digest, numslices):
+    """Return the slice of a queue which a queue file belongs to.
+
+    The hash space of the digests is split into `numslices` equal ranges,
+    which can be any number of slices.
+
+    :param digest: The sha1 hex digest part of the file base.
+    :type digest: str
+    :param numslices: The total number of slices.
+    :type numslices: int
+    :return: The slice number, in [0..`numslices`).
+    :rtype: int
+    """
+    return (int(digest, 16) * numslices) >> DIGEST_BITS
+
+
+@public
+def steal(files):
+    """Choose which files from other slices an idle runner may process.
+
+    The runners owning the slices work through their files from the front,
+    so stealing the newer half of the backlog keeps the runners from
+    contending for the same files until the backlog is nearly gone.
+
+    :param files: The files in the other slices, in FIFO order.
+    :type files: list
+    :return: The files to steal, in FIFO order.
+    :rtype: list
+    """
+    return files[len(files) // 2:]
+
+
+@public
+def serialize(_msg, _metadata, _kws):
+    """Serialize a message and its metadata for a queue.
+
+    :param _msg: The message, or its text if the `_plaintext` metadata key is
+        true.
+    :param _metadata: The metadata dictionary, or None.
+    :param _kws: Additional metadata, which takes precedence over
+        `_metadata`.
+    :type _kws: dict
+    :return: A 2-tuple of the new queue entry's file base and contents.
+    """
+    if _metadata is None:
+        _metadata = {}
+    # Calculate the SHA hexdigest of the message to get a unique base
+    # filename.  We're also going to use the digest as a hash into the set
+    # of parallel runner processes.
+    data = _metadata.copy()
+    data.update(_kws)
+    list_id = data.get('listid', '--nolist--')
+    # Get some data for the input to the sha hash.
+    now = repr(time.time())
+    plaintext = bool(data.get('_plaintext'))
+    if plaintext:
+        text = str(_msg)
+        raw = text.encode('utf-8', 'surrogateescape')
+        original_size = len(text)
+    else:
+        raw = _flatten(_msg)
+        original_size = getattr(_msg, 'original_size', None)
+    if raw is None:
+        # Fall back to pickling the message object.
+        msgsave = pickle.dumps(_msg, pickle.HIGHEST_PROTOCOL)
+    else:
+        msgsave = QFILE_HEADER.pack(
+            QFILE_MAGIC, config.QFILE_SCHEMA_VERSION, len(raw),
+            NO_SIZE if original_size is None else original_size) + raw
+    # The list-id field is a string but the input to the hash function must
+    # be bytes.
+    hashfood = msgsave + list_id.encode('utf-8') + now.encode('utf-8')
+    # Encode the current time into the file name for FIFO sorting.  The
+    # file name consists of two parts separated by a '+': the received
+    # time for this message (i.e. when it first showed up on this system)
+    # and the sha hex digest.  Messages in a priority lane other than the
+    # default get a third part giving the lane, so that the queue can be
+    # ordered without reading the files.  Likewise, messages which must not
+    # be processed before a certain time get a part giving that time.
+    filebase = now + '+' + hashlib.sha1(hashfood).hexdigest()
+    priority = int(data.get('priority', 0))
+    if priority != 0:
+        filebase += '+p{}'.format(priority)
+    deliver_after = data.get('deliver_after')
+    if deliver_after is not None:
+        filebase += '+d{!r}'.format(timestamp(deliver_after))
+    # Always add the metadata schema version number
+    data['version'] = config.QFILE_SCHEMA_VERSION
+    # Filter out volatile entries.  Use .keys() so that we can mutate the
+    # dictionary during the iteration.
+    for k in list(data):
+        if k.startswith('_'):
+            del data[k]
+    # We have to tell the dequeue() method whether the message was given
+    # as plain text or not.
+    data['_parsemsg'] = plaintext
+    return filebase, msgsave + pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+
+@public
+def timestamp(when):
+    """Convert a metadata time to seconds since the epoch.
+
+    :param when: A naive UTC datetime, as returned by
+        `mailman.utilities.datetime.now()`.
+    :type when: datetime.datetime
+    :return: The time in seconds since the epoch.
+    :rtype: float
+    """
+    return when.replace(tzinfo=timezone.utc).timestamp()
+
+
+@public
+def due_clock():
+    """The current time, for deciding whether delayed entries are due.
+
+    :return: The current time in seconds since the epoch.
+    :rtype: float
+    """
+    # Not imported at module scope to avoid import loop
+    from mailman.utilities.datetime import now
+    return timestamp(now())
+
+
+@public
+def deserialize(fp):
+    """Read a queue entry written by `serialize()`.
+
+    :param fp: The queue entry, opened for reading in binary mode.
+    :return: A 2-tuple of the message and the metadata dictionary.
+    """
+    msg, data = read_queue_file(fp)
+    if data.get('_parsemsg'):
+        if isinstance(msg, str):
+            # Calculate the original size of the text now so that we won't
+            # have to generate the message later when we do size restriction
+            # checking.
+            original_size = len(msg)
+            msg = email.message_from_string(msg, Message)
+            msg.original_size = original_size
+        data['original_size'] = msg.original_size
+    return msg, data
+
+
+@public
+def count_recovery(fp):
+    """Increment the recovery count in the metadata of a queue entry.
+
+    :param fp: The queue entry, opened for reading and writing in binary
+        mode.  The metadata is rewritten in place.
+    :return: The updated metadata dictionary, whose `_bak_count` key is the
+        number of times the entry has been recovered.
+    """
+    # Skip over the message.
+    legacy = _skip_message(fp)
+    data_pos = fp.tell()
+    data = pickle.load(fp)
+    data['_bak_count'] = data.get('_bak_count', 0) + 1
+    fp.seek(data_pos)
+    if not legacy:
+        protocol = pickle.HIGHEST_PROTOCOL
+    elif data.get('_parsemsg'):
+        protocol = 0
+    else:
+        protocol = 1
+    pickle.dump(data, fp, protocol)
+    fp.truncate()
+    return data
+
+
+def _flatten(msg):
+    # Return the raw bytes for the message, or None if it can only be
+    # pickled.  Unchanged dequeued messages are written back as they were.
+    if isinstance(msg, LazyMessage) and msg.raw is not None:
+        return msg.raw
+    # Only messages which come back unchanged from their bytes can be stored
+    # as bytes.  Subclasses and extra attributes (e.g. the recipients of a
+    # UserNotification) would be lost, and so would Header instances and
+    # non-ASCII header strings, which only get encoded on the way out.
+    if type(msg) not in (Message, LazyMessage):
+        return None
+    if not set(msg.__dict__) - CACHE_ATTRIBUTES <= FLAT_ATTRIBUTES:
+        return None
+    for name, value in msg._headers:
+        if not isinstance(value, str):
+            return None
+        try:
+            value.encode('ascii', 'surrogateescape')
+        except UnicodeError:
+            return None
+    try:
+        return msg.as_bytes(
+            unixfrom=(msg.get_unixfrom() is not None), policy=QFILE_POLICY)
+    except (AttributeError, LookupError, TypeError, UnicodeError) as error:
+        # E.g. a header was set to a non-ASCII string instead of a Header.
+        dlog.debug('Pickling unflattenable message %s: %s',
+                   msg.get('message-id', 'n/a'), error)
+        return None
+
+
+def _skip_message(fp):
+    # Position the file after the message, just before the metadata pickle.
+    # Return whether the file is in the legacy two pickle format.
+    header = fp.read(QFILE_HEADER.size)
+    if header[:len(QFILE_MAGIC)] == QFILE_MAGIC:
+        magic, version, size, original_size = QFILE_HEADER.unpack(header)
+        fp.seek(size, os.SEEK_CUR)
+        return False
+    fp.seek(0)
+    pickle.load(fp)
+    return True
+
+
+@public
+def read_queue_file(fp):
+    """Read the message and metadata from an open queue file.
+
+    :param fp: The queue file, opened for reading in binary mode.
+    :return: A 2-tuple of the message and the metadata dictionary.  The
+        message is a `LazyMessage`, unless it was pickled, in which case it is
+        whatever was pickled, e.g. a string for legacy plain text messages.
+    """
+    header = fp.read(QFILE_HEADER.size)
+    if header[:len(QFILE_MAGIC)] == QFILE_MAGIC:
+        magic, version, size, original_size = QFILE_HEADER.unpack(header)
+        msg = LazyMessage.from_bytes(fp.read(size))
+        if original_size != NO_SIZE:
+            msg.original_size = original_size
+    else:
+        fp.seek(0)
+        msg = pickle.load(fp)
+    data = pickle.load(fp)
+    return msg, data
+
+
+@public
+@contextmanager
+def group_commit():
+    """Commit all the enqueues made in this context together.
+
+    Within the context, `ISwitchboard.enqueue()` only writes the queue files.
+    When the context exits, the file data is synced, the files are renamed
+    into their queues and each queue directory is synced once.  Until then,
+    the enqueued files are invisible to the runners, just as they are before
+    the rename of an unbatched enqueue, so the rules for recovering from a
+    crash are the same.  The caller must not consider the messages safely
+    queued, e.g. by finishing the queue file they came from, before the
+    context has exited.  The enqueues are committed even if the context
+    exits with an exception, just as they would have been without it.
+
+    Nested contexts join the outermost one.
+    """
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+    pending = _local.pending = []
+    deferred = _local.deferred = []
+    try:
+        yield
+    finally:
+        _local.pending = _local.deferred = None
+        try:
+            _commit(pending)
+        finally:
+            for function in deferred:
+                function()
+
+
+@public
+def defer_commit(function):
+    """Call a function when the current group commit is committed.
+
+    This is how switchboards which don't store their queues as files take
+    part in a `group_commit()`.
+
+    :param function: A function taking no arguments, which commits the
+        enqueues that the switchboard deferred.
+    :return: True if the function was deferred, or False if there is no
+        group commit in progress, in which case the caller should commit its
+        enqueues immediately.
+    """
+    deferred = getattr(_local, 'deferred', None)
+    if deferred is None:
+        return False
+    deferred.append(function)
+    return True
+
+
+def _commit(pending):
+    directories = set()
+    try:
+        # Sync all the data first, so that no file can show up in a queue
+        # after a crash without its contents.
+        for tmpfile, filename in pending:
+            fd = os.open(tmpfile, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        while pending:
+            tmpfile, filename = pending[0]
+            os.rename(tmpfile, filename)
+            directories.add(os.path.dirname(filename))
+            del pending[0]
+        # And make the renames themselves durable.
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    finally:
+        # Don't leave orphaned temporary files behind if anything failed.
+        for tmpfile, filename in pending:
+            with suppress(OSError):
+                os.unlink(tmpfile)
 
 
 @public
@@ -264,4 +667,11 @@ def handle_ConfigurationUpdatedEvent(event):
             substitutions = config.paths
             substitutions['name'] = name
             path = expand(conf.path, None, substitutions)
-            config.switchboards[name] = Switchboard(name, path)
+            rescan_interval = as_timedelta(
+                conf.queue_rescan_interval).total_seconds()
+            priority_boost = as_timedelta(
+                conf.priority_boost).total_seconds()
+            switchboard_class = find_name(conf.switchboard)
+            config.switchboards[name] = switchboard_class(
+                name, path, rescan_interval=rescan_interval,
+                priority_boost=priority_boost)
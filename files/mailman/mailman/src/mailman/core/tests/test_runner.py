@@ -17,13 +17,19 @@
 
 """Test some Runner base class behavior."""
 
+import os
+import time
 import unittest
+import threading
 
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.core.runner import Runner
+from mailman.core.sqliteswitchboard import SQLiteSwitchboard
+from mailman.core.switchboard import Switchboard
 from mailman.interfaces.member import DeliveryMode
 from mailman.interfaces.runner import RunnerCrashEvent
+from mailman.interfaces.usermanager import IUserManager
 from mailman.runners.virgin import VirginRunner
 from mailman.testing.helpers import (
     LogFileMark, configuration, event_subscribers, get_queue_messages,
@@ -31,6 +37,8 @@ from mailman.testing.helpers import (
     specialized_message_from_string as mfs,
     subscribe)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+from zope.component import getUtility
 
 
 class CrashingRunner(Runner):
@@ -38,6 +46,19 @@ class CrashingRunner(Runner):
         raise RuntimeError('borked')
 
 
+class ForwardingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        config.switchboards['out'].enqueue(msg, msgdata)
+        config.switchboards['archive'].enqueue(msg, msgdata)
+
+
+class UserCreatingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        getUtility(IUserManager).create_user(msgdata['email'])
+        if msgdata.get('fail'):
+            raise RuntimeError('borked')
+
+
 class TestRunner(unittest.TestCase):
     """Test the Runner base class behavior."""
 
@@ -118,3 +139,286 @@ Message-ID: <ant>
         # The list's -request address is the original sender.
         self.assertEqual(item.msgdata['original_sender'],
                          'test-request@example.com')
+
+    @configuration('runner.in', group_commit='yes')
+    def test_group_commit(self):
+        # With group commit, the enqueued messages are committed before the
+        # original queue file is finished.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        self.assertTrue(runner.group_commit)
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        seen = []
+        finish = runner.switchboard.finish
+
+        def check_finish(filebase, preserve=False):
+            seen.append((len(config.switchboards['out'].files),
+                         len(config.switchboards['archive'].files)))
+            finish(filebase, preserve)
+
+        with patch.object(runner.switchboard, 'finish', check_finish):
+            runner.run()
+        self.assertEqual(seen, [(1, 1)])
+        get_queue_messages('out', expected_count=1)
+        get_queue_messages('archive', expected_count=1)
+        get_queue_messages('in', expected_count=0)
+
+    @configuration('runner.in',
+                   switchboard='mailman.core.sqliteswitchboard.'
+                               'SQLiteSwitchboard')
+    def test_sqlite_switchboard(self):
+        # Runners use the switchboard configured for their queue.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        self.assertIsInstance(runner.switchboard, SQLiteSwitchboard)
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        runner.run()
+        items = get_queue_messages('out', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<ant>')
+        get_queue_messages('archive', expected_count=1)
+        self.assertEqual(runner.switchboard.files, [])
+        self.assertEqual(runner.switchboard.get_files('.bak'), [])
+
+    @configuration('runner.in', work_stealing='yes')
+    def test_work_stealing(self):
+        # A runner whose slice is empty processes the files in other slices.
+        runner = make_testable_runner(
+            ForwardingRunner, 'in',
+            predicate=lambda runner: len(config.switchboards['in'].files) == 0)
+        self.assertTrue(runner.work_stealing)
+        runner.switchboard = Switchboard(
+            'in', runner.queue_directory, slice=0, numslices=2)
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        inq = config.switchboards['in']
+        for n in range(10):
+            inq.enqueue(msg, listid='test.example.com', n=n)
+        self.assertLess(len(runner.switchboard.files), 10)
+        runner.run()
+        get_queue_messages('out', expected_count=10)
+        get_queue_messages('archive', expected_count=10)
+        self.assertEqual(inq.files, [])
+        self.assertEqual(inq.get_files('.bak'), [])
+
+    def test_no_work_stealing(self):
+        # By default, a runner only processes the files in its own slice.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        self.assertFalse(runner.work_stealing)
+        runner.switchboard = Switchboard(
+            'in', runner.queue_directory, slice=0, numslices=2)
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        inq = config.switchboards['in']
+        for n in range(10):
+            inq.enqueue(msg, listid='test.example.com', n=n)
+        mine = len(runner.switchboard.files)
+        self.assertLess(mine, 10)
+        runner.run()
+        get_queue_messages('out', expected_count=mine)
+        self.assertEqual(len(inq.files), 10 - mine)
+
+    def test_preemption(self):
+        # Higher priority files arriving while a batch is being processed
+        # are handled before the rest of the batch.
+        seen = []
+
+        class OrderingRunner(Runner):
+            preempt_interval = 0
+
+            def _dispose(self, mlist, msg, msgdata):
+                seen.append(msgdata['n'])
+                if msgdata['n'] == 0:
+                    self.switchboard.enqueue(
+                        msg, listid='test.example.com', n='urgent',
+                        priority=1)
+
+        runner = make_testable_runner(OrderingRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        for n in range(3):
+            config.switchboards['in'].enqueue(
+                msg, listid='test.example.com', n=n)
+        runner.run()
+        self.assertEqual(seen, [0, 'urgent', 1, 2])
+
+    @configuration('runner.in', event_wakeup='yes')
+    def test_event_wakeup(self):
+        # An idle runner waits for new files instead of sleeping.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        self.assertTrue(runner.event_wakeup)
+        self.assertEqual(runner.switchboard.files, [])
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        timer = threading.Timer(0.1, config.switchboards['in'].enqueue,
+                                (msg,), dict(listid='test.example.com'))
+        timer.start()
+        self.addCleanup(timer.join)
+        runner.wakeup_timeout = 30
+        start = time.monotonic()
+        with patch('mailman.core.runner.time.sleep') as sleep:
+            runner._snooze(0)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertFalse(sleep.called)
+        self.assertEqual(len(runner.switchboard.files), 1)
+
+    @configuration('runner.in', event_wakeup='yes')
+    def test_signal_ends_wait(self):
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.set_blocking(read_fd, False)
+        runner._wakeup_fd = read_fd
+        runner.wakeup_timeout = 30
+        # This is what the C signal handler does.
+        os.write(write_fd, b'\x0f')
+        start = time.monotonic()
+        runner._snooze(0)
+        self.assertLess(time.monotonic() - start, 10)
+        # The pipe has been drained.
+        with self.assertRaises(BlockingIOError):
+            os.read(read_fd, 1)
+
+    def test_polling(self):
+        # By default, an idle runner sleeps.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        self.assertFalse(runner.event_wakeup)
+        with patch('mailman.core.runner.time.sleep') as sleep:
+            runner._snooze(0)
+        sleep.assert_called_once_with(runner.sleep_float)
+
+    def test_sleep_limit(self):
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        with patch('mailman.core.runner.time.sleep') as sleep:
+            runner._sleep(runner.sleep_float / 2)
+            runner._sleep(runner.sleep_float * 2)
+            runner._sleep(-1)
+        self.assertEqual([args[0] for args, kws in sleep.call_args_list],
+                         [runner.sleep_float / 2, runner.sleep_float, 0])
+
+    @configuration('runner.in', event_wakeup='yes')
+    def test_wait_limit(self):
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        with patch.object(runner.switchboard, 'wait',
+                          return_value=True) as wait:
+            runner._sleep(0.5)
+        wait.assert_called_once_with(0.5, runner._wakeup_fd)
+
+    @configuration('runner.in', event_wakeup='yes')
+    def test_polling_without_inotify(self):
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        with patch.object(runner.switchboard, 'wait', return_value=False):
+            with patch('mailman.core.runner.time.sleep') as sleep:
+                runner._snooze(0)
+        sleep.assert_called_once_with(runner.sleep_float)
+
+
+class TestBatchCommit(unittest.TestCase):
+    """Test committing the database changes for several files at once."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        create_list('test@example.com')
+        config.db.commit()
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._inq = config.switchboards['in']
+
+    def _enqueue(self, count, failing=()):
+        for n in range(count):
+            self._inq.enqueue(
+                self._msg, listid='test.example.com',
+                email='user{}@example.com'.format(n),
+                fail=(n in failing))
+
+    def _emails(self):
+        return sorted(str(user.addresses[0].email)
+                      for user in getUtility(IUserManager).users)
+
+    @configuration('runner.in', batch_commit_size=3)
+    def test_batches(self):
+        self._enqueue(5)
+        runner = make_testable_runner(UserCreatingRunner, 'in')
+        events = []
+        commit = config.db.commit
+        finish = runner.switchboard.finish
+
+        def record_commit():
+            events.append('commit')
+            commit()
+
+        def record_finish(filebase, preserve=False):
+            events.append('finish')
+            finish(filebase, preserve)
+
+        with patch.object(config.db, 'commit', record_commit), \
+                patch.object(runner.switchboard, 'finish', record_finish):
+            runner.run()
+        self.assertEqual(events, ['commit'] + ['finish'] * 3 +
+                                 ['commit'] + ['finish'] * 2)
+        self.assertEqual(len(self._emails()), 5)
+        self.assertEqual(self._inq.get_files('.bak'), [])
+
+    @configuration('runner.in', batch_commit_size=10,
+                   batch_commit_interval='0s')
+    def test_interval(self):
+        self._enqueue(3)
+        runner = make_testable_runner(UserCreatingRunner, 'in')
+        with patch.object(config.db, 'commit',
+                          wraps=config.db.commit) as commit:
+            runner.run()
+        self.assertEqual(commit.call_count, 3)
+
+    @configuration('runner.in', batch_commit_size=10)
+    def test_failure_rolls_back_only_its_savepoint(self):
+        self._enqueue(3, failing=(1,))
+        runner = make_testable_runner(UserCreatingRunner, 'in')
+        runner.run()
+        self.assertEqual(self._emails(),
+                         ['user0@example.com', 'user2@example.com'])
+        items = get_queue_messages('shunt', expected_count=1)
+        self.assertEqual(items[0].msgdata['email'], 'user1@example.com')
+        self.assertEqual(self._inq.get_files('.bak'), [])
+
+    @configuration('runner.in', batch_commit_size=10)
+    def test_failed_commit_keeps_backup_files(self):
+        self._enqueue(3)
+        runner = make_testable_runner(UserCreatingRunner, 'in')
+        with patch.object(config.db, 'commit',
+                          side_effect=RuntimeError('Oops!')):
+            with self.assertRaises(RuntimeError):
+                runner.run()
+        config.db.abort()
+        self.assertEqual(len(self._inq.get_files('.bak')), 3)
+        self.assertEqual(self._emails(), [])
@@ -0,0 +1,301 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""SQLite switchboard tests."""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from datetime import timedelta
+from mailman.config import config
+from mailman.core.sqliteswitchboard import (
+    DATABASE, SQLiteSwitchboard, _start_time)
+from mailman.core.switchboard import MAX_BAK_COUNT, group_commit
+from mailman.email.message import UserNotification
+from mailman.interfaces.switchboard import ISwitchboard
+from mailman.testing.helpers import (
+    LogFileMark, configuration, get_queue_messages,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import factory, now
+from unittest.mock import patch
+from zope.interface.verify import verifyObject
+
+
+SQLITE = 'mailman.core.sqliteswitchboard.SQLiteSwitchboard'
+
+
+class TestSQLiteSwitchboard(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._queue_directory = os.path.join(self._tempdir, 'test')
+        self._switchboard = self._make_switchboard()
+
+    def _make_switchboard(self, **kws):
+        switchboard = SQLiteSwitchboard('test', self._queue_directory, **kws)
+        self.addCleanup(switchboard.close)
+        return switchboard
+
+    def test_interface(self):
+        verifyObject(ISwitchboard, self._switchboard)
+
+    def test_database(self):
+        self._switchboard.enqueue(self._msg)
+        self.assertEqual(
+            self._switchboard.database,
+            os.path.join(self._queue_directory, DATABASE))
+        self.assertTrue(os.path.exists(self._switchboard.database))
+
+    def test_round_trip(self):
+        filebase = self._switchboard.enqueue(self._msg, foo=1)
+        self.assertEqual(self._switchboard.files, [filebase])
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['foo'], 1)
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        self._switchboard.finish(filebase)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+
+    def test_pickled_message(self):
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'Hi', 'Hello')
+        filebase = self._switchboard.enqueue(msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.recipients, {'anne@example.com'})
+
+    def test_fifo(self):
+        filebases = [self._switchboard.enqueue(self._msg, n=n)
+                     for n in range(5)]
+        self.assertEqual(self._switchboard.files, filebases)
+
+    def test_priority_lanes(self):
+        switchboard = self._make_switchboard(priority_boost=600)
+        normal = [switchboard.enqueue(self._msg, n=n) for n in range(3)]
+        urgent = switchboard.enqueue(self._msg, priority=1)
+        self.assertEqual(switchboard.files, [urgent] + normal)
+        # Without a boost, the queue is strictly FIFO.
+        self.assertEqual(self._switchboard.files, normal + [urgent])
+
+    def test_delayed_entries(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(days=1))
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.delayed_files, [filebase])
+        factory.fast_forward()
+        self.assertEqual(self._switchboard.files, [filebase])
+        self.assertEqual(self._switchboard.delayed_files, [])
+
+    def test_wait_for_new_entries(self):
+        self.assertEqual(self._switchboard.files, [])
+        timer = threading.Timer(
+            0.1, self._make_switchboard().enqueue, (self._msg,))
+        timer.start()
+        self.addCleanup(timer.join)
+        # Other writes to the database may end a wait early too.
+        start = time.monotonic()
+        while len(self._switchboard.files) == 0:
+            self.assertTrue(self._switchboard.wait(30))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_wait_timeout(self):
+        self.assertEqual(self._switchboard.files, [])
+        self.assertTrue(self._switchboard.wait(0.01))
+
+    def test_no_wait_without_inotify(self):
+        with patch('mailman.core.sqliteswitchboard.DirectoryWatcher',
+                   side_effect=OSError('No inotify')):
+            self.assertFalse(self._switchboard.wait(30))
+
+    def test_dequeue_claims_entry(self):
+        # Only one dequeue can claim an entry, even through another
+        # switchboard for the same queue.
+        filebase = self._switchboard.enqueue(self._msg)
+        other = self._make_switchboard()
+        other.dequeue(filebase)
+        with self.assertRaises(FileNotFoundError):
+            self._switchboard.dequeue(filebase)
+
+    def test_shared_between_switchboards(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._make_switchboard().files, [filebase])
+
+    def test_slices(self):
+        filebases = set(self._switchboard.enqueue(self._msg, n=n)
+                        for n in range(20))
+        slices = [self._make_switchboard(slice=i, numslices=4)
+                  for i in range(4)]
+        found = [set(switchboard.files) for switchboard in slices]
+        self.assertEqual(set.union(*found), filebases)
+        self.assertEqual(sum(len(files) for files in found), 20)
+
+    def test_any_number_of_slices(self):
+        filebases = set(self._switchboard.enqueue(self._msg, n=n)
+                        for n in range(30))
+        found = set()
+        for i in range(3):
+            found.update(self._make_switchboard(slice=i, numslices=3).files)
+        self.assertEqual(found, filebases)
+
+    def test_steal_files(self):
+        filebases = [self._switchboard.enqueue(self._msg, n=n)
+                     for n in range(20)]
+        mine = self._make_switchboard(slice=1, numslices=2)
+        others = [filebase for filebase in filebases
+                  if filebase not in mine.files]
+        self.assertEqual(mine.steal_files(), others[len(others) // 2:])
+        self.assertEqual(self._switchboard.steal_files(), [])
+
+    def _set_claimant(self, filebase, pid, start_time=None):
+        with self._switchboard._transaction() as connection:
+            connection.execute("""
+                UPDATE entry SET claimant = ?, claimant_start = ?
+                WHERE filebase = ?
+                """, (pid, start_time, filebase))
+
+    def test_recovery_skips_entries_being_processed(self):
+        # Entries claimed by another live process are not recovered.
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self._set_claimant(filebase, os.getppid())
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        # But they are once that process is gone.
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self._set_claimant(filebase, pid)
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    @unittest.skipIf(_start_time(os.getpid()) is None, 'No /proc')
+    def test_recovery_with_reused_pid(self):
+        # An entry claimed by a process which is gone is recovered even if
+        # another process has been given the same pid since.
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        with self._switchboard._transaction() as connection:
+            claimant_start = connection.execute(
+                'SELECT claimant_start FROM entry WHERE filebase = ?',
+                (filebase,)).fetchone()[0]
+        self.assertEqual(claimant_start, _start_time(os.getpid()))
+        parent = os.getppid()
+        self._set_claimant(filebase, parent, _start_time(parent))
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        # The live process with the claimant's pid started at another time,
+        # so it only reused the pid.
+        self._set_claimant(filebase, parent, _start_time(parent) + 1)
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    def test_preserve_in_file_bad_queue(self):
+        # The default bad queue keeps its entries as files.
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase, preserve=True)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+        bad = config.switchboards['bad']
+        self.assertEqual(bad.get_files('.psv'), [filebase])
+        os.remove(os.path.join(bad.queue_directory, filebase + '.psv'))
+
+    def test_preserve_in_sqlite_bad_queue(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        with configuration('runner.bad', switchboard=SQLITE):
+            bad = config.switchboards['bad']
+            self._switchboard.finish(filebase, preserve=True)
+            self.assertEqual(bad.get_files('.psv'), [filebase])
+            self.assertEqual(self._switchboard.get_files('.bak'), [])
+            os.remove(bad.database)
+
+    def test_preserve_file_in_sqlite_bad_queue(self):
+        # The file switchboards preserve into an SQLite bad queue too.
+        shunt = config.switchboards['shunt']
+        filebase = shunt.enqueue(self._msg)
+        shunt.dequeue(filebase)
+        with configuration('runner.bad', switchboard=SQLITE):
+            bad = config.switchboards['bad']
+            shunt.finish(filebase, preserve=True)
+            self.assertEqual(bad.get_files('.psv'), [filebase])
+            os.remove(bad.database)
+        self.assertEqual(shunt.get_files('.bak'), [])
+
+    def test_finish_missing_entry(self):
+        error_log = LogFileMark('mailman.error')
+        self._switchboard.finish('1234567890.1+' + 'a' * 40)
+        self.assertIn('Failed to remove/preserve backup entry',
+                      error_log.read())
+
+    def test_recover_backup_files(self):
+        filebase = self._switchboard.enqueue(self._msg, foo=1)
+        self._switchboard.dequeue(filebase)
+        # Recovery happens when a switchboard is created for a runner.
+        switchboard = self._make_switchboard(recover=True)
+        self.assertEqual(switchboard.files, [filebase])
+        msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['_bak_count'], 1)
+        self.assertEqual(msgdata['foo'], 1)
+
+    def test_recover_max_count(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        for i in range(MAX_BAK_COUNT):
+            self._switchboard.dequeue(filebase)
+            self._switchboard.recover_backup_files()
+        # The entry has been recovered too many times, so it was preserved.
+        self.assertEqual(self._switchboard.files, [])
+        bad = config.switchboards['bad']
+        self.assertEqual(bad.get_files('.psv'), [filebase])
+        os.remove(os.path.join(bad.queue_directory, filebase + '.psv'))
+
+    def test_group_commit(self):
+        with group_commit():
+            filebase_1 = self._switchboard.enqueue(self._msg, foo=1)
+            filebase_2 = self._switchboard.enqueue(self._msg, foo=2)
+            self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.files, [filebase_1, filebase_2])
+
+    def test_group_commit_one_transaction(self):
+        with patch.object(self._switchboard, '_transaction',
+                          wraps=self._switchboard._transaction) as txn:
+            with group_commit():
+                for i in range(3):
+                    self._switchboard.enqueue(self._msg)
+        self.assertEqual(txn.call_count, 1)
+        self.assertEqual(len(self._switchboard.files), 3)
+
+    @configuration('runner.virgin', switchboard=SQLITE)
+    def test_configuration(self):
+        virgin = config.switchboards['virgin']
+        self.assertIsInstance(virgin, SQLiteSwitchboard)
+        virgin.enqueue(self._msg)
+        items = get_queue_messages('virgin', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<ant>')
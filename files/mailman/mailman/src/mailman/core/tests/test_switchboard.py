@@ -17,13 +17,26 @@
 
 """Switchboard tests."""
 
+import os
+import time
+import pickle
+import shutil
+import tempfile
 import unittest
+import threading
 
+from contextlib import suppress
+from datetime import timedelta
 from mailman.config import config
+from mailman.core.queueindex import parse_filebase
+from mailman.core.switchboard import (
+    QFILE_MAGIC, Switchboard, digest_slice, group_commit, timestamp)
+from mailman.email.message import LazyMessage, UserNotification
 from mailman.testing.helpers import (
     LogFileMark,
     specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import factory, now
 from unittest.mock import patch
 
 
@@ -51,3 +64,532 @@ Message-ID: <ant>
         traceback = error_log.read().splitlines()
         self.assertEqual(traceback[1], 'Traceback (most recent call last):')
         self.assertEqual(traceback[-1], 'OSError: Oops!')
+
+
+class TestQueueIndex(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._queue_directory = os.path.join(self._tempdir, 'test')
+
+    def _switchboard(self, **kws):
+        switchboard = Switchboard('test', self._queue_directory, **kws)
+        self.addCleanup(switchboard.close)
+        return switchboard
+
+    def test_files_enqueued_elsewhere(self):
+        # Files enqueued through another switchboard on the same directory
+        # show up in the index.
+        reader = self._switchboard()
+        self.assertEqual(reader.files, [])
+        writer = self._switchboard()
+        filebases = [writer.enqueue(self._msg, foo=i) for i in range(3)]
+        self.assertEqual(reader.files, filebases)
+
+    def test_dequeued_files_leave_the_index(self):
+        reader = self._switchboard()
+        writer = self._switchboard()
+        filebases = [writer.enqueue(self._msg, foo=i) for i in range(3)]
+        self.assertEqual(reader.files, filebases)
+        writer.dequeue(filebases[1])
+        self.assertEqual(reader.files, [filebases[0], filebases[2]])
+        # Recovering the backup file puts it back in its FIFO position.
+        writer.recover_backup_files()
+        self.assertEqual(reader.files, filebases)
+
+    def test_index_is_watched(self):
+        switchboard = self._switchboard()
+        switchboard.files
+        self.assertTrue(switchboard._index.watching)
+
+    def test_no_inotify(self):
+        # Without inotify, the directory is rescanned on every pass.
+        with patch('mailman.core.queueindex.DirectoryWatcher',
+                   side_effect=OSError('No inotify')):
+            reader = self._switchboard()
+            self.assertEqual(reader.files, [])
+        self.assertFalse(reader._index.watching)
+        filebase = self._switchboard().enqueue(self._msg)
+        self.assertEqual(reader.files, [filebase])
+
+    def test_close(self):
+        switchboard = self._switchboard()
+        switchboard.files
+        index = switchboard._index
+        self.assertTrue(index.watching)
+        switchboard.close()
+        self.assertFalse(index.watching)
+        # The switchboard watches the queue again when it's next used.
+        filebase = self._switchboard().enqueue(self._msg)
+        self.assertEqual(switchboard.files, [filebase])
+        self.assertTrue(switchboard._index.watching)
+
+    def test_periodic_rescan(self):
+        # Events that are somehow missed are picked up by the next rescan.
+        reader = self._switchboard(rescan_interval=0)
+        self.assertEqual(reader.files, [])
+        filebase = self._switchboard().enqueue(self._msg)
+        reader._index._watcher.read_events()
+        self.assertEqual(reader.files, [filebase])
+
+    def test_wait_for_new_files(self):
+        reader = self._switchboard()
+        self.assertEqual(reader.files, [])
+        timer = threading.Timer(
+            0.1, self._switchboard().enqueue, (self._msg,))
+        timer.start()
+        self.addCleanup(timer.join)
+        # Other changes to the directory may end a wait early too.
+        start = time.monotonic()
+        while len(reader.files) == 0:
+            self.assertTrue(reader.wait(30))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_wait_timeout(self):
+        reader = self._switchboard()
+        self.assertEqual(reader.files, [])
+        self.assertTrue(reader.wait(0.01))
+        self.assertEqual(reader.files, [])
+
+    def test_wait_for_changes_since_listing(self):
+        # Files enqueued between listing the queue and waiting end the wait
+        # right away.
+        reader = self._switchboard()
+        self.assertEqual(reader.files, [])
+        self._switchboard().enqueue(self._msg)
+        start = time.monotonic()
+        self.assertTrue(reader.wait(30))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_wait_for_wakeup_fd(self):
+        reader = self._switchboard()
+        self.assertEqual(reader.files, [])
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.write(write_fd, b'x')
+        start = time.monotonic()
+        self.assertTrue(reader.wait(30, read_fd))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_wait_for_delayed_file(self):
+        # The wait ends when the next delayed file falls due.
+        reader = self._switchboard()
+        filebase = reader.enqueue(
+            self._msg, deliver_after=now() + timedelta(seconds=5))
+        self.assertEqual(reader.files, [])
+        with patch('mailman.core.queueindex.select.select') as select:
+            self.assertTrue(reader.wait(30))
+        self.assertEqual(select.call_args[0][3], 5)
+        factory.fast_forward()
+        self.assertEqual(reader.files, [filebase])
+
+    def test_no_wait_without_inotify(self):
+        with patch('mailman.core.queueindex.DirectoryWatcher',
+                   side_effect=OSError('No inotify')):
+            reader = self._switchboard()
+            self.assertEqual(reader.files, [])
+            self.assertFalse(reader.wait(30))
+
+    def test_slices(self):
+        # Each slice only sees the files in its part of the hash space, and
+        # together they see all of them.
+        writer = self._switchboard()
+        filebases = [writer.enqueue(self._msg, foo=i) for i in range(20)]
+        slices = [self._switchboard(slice=i, numslices=4) for i in range(4)]
+        seen = []
+        for switchboard in slices:
+            files = switchboard.files
+            self.assertEqual(files, sorted(files, key=lambda f: (
+                float(f.split('+')[0]), f)))
+            seen.extend(files)
+        self.assertEqual(sorted(seen), sorted(filebases))
+
+
+class TestPriorityLanes(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._queue_directory = os.path.join(self._tempdir, 'test')
+
+    def _switchboard(self, **kws):
+        switchboard = Switchboard('test', self._queue_directory, **kws)
+        self.addCleanup(switchboard.close)
+        return switchboard
+
+    def test_filebase(self):
+        # The lane is only recorded in the file name outside the default lane.
+        switchboard = self._switchboard()
+        filebase = switchboard.enqueue(self._msg)
+        self.assertEqual(len(filebase.split('+')), 2)
+        self.assertEqual(parse_filebase(filebase)[2], 0)
+        filebase = switchboard.enqueue(self._msg, priority=2)
+        self.assertTrue(filebase.endswith('+p2'))
+        self.assertEqual(parse_filebase(filebase)[2], 2)
+        msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['priority'], 2)
+
+    def test_higher_lanes_first(self):
+        switchboard = self._switchboard(priority_boost=600)
+        normal = [switchboard.enqueue(self._msg, n=n) for n in range(3)]
+        urgent = switchboard.enqueue(self._msg, priority=1)
+        self.assertEqual(switchboard.files, [urgent] + normal)
+
+    def test_no_boost_is_fifo(self):
+        switchboard = self._switchboard()
+        filebases = [switchboard.enqueue(self._msg, priority=n % 2)
+                     for n in range(4)]
+        self.assertEqual(switchboard.files, filebases)
+
+    def test_no_starvation(self):
+        # A file in the default lane which has waited longer than the boost
+        # is still processed before newly arrived higher priority files.
+        switchboard = self._switchboard(priority_boost=600)
+        with patch('mailman.core.switchboard.time.time',
+                   return_value=1000000000.0):
+            old = switchboard.enqueue(self._msg)
+        urgent = switchboard.enqueue(self._msg, priority=1)
+        self.assertEqual(switchboard.files, [old, urgent])
+
+
+class TestDelayedFiles(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard(
+            'test', os.path.join(self._tempdir, 'test'))
+        self.addCleanup(self._switchboard.close)
+
+    def test_filebase(self):
+        deliver_after = now() + timedelta(hours=1)
+        filebase = self._switchboard.enqueue(
+            self._msg, deliver_after=deliver_after)
+        self.assertEqual(parse_filebase(filebase)[3],
+                         timestamp(deliver_after))
+        self.assertIsNone(parse_filebase(self._switchboard.enqueue(
+            self._msg))[3])
+
+    def test_held_back_until_due(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(days=1))
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.delayed_files, [filebase])
+        self.assertEqual(self._switchboard._index.next_due,
+                         timestamp(now() + timedelta(days=1)))
+        factory.fast_forward()
+        self.assertEqual(self._switchboard.files, [filebase])
+        self.assertEqual(self._switchboard.delayed_files, [])
+        self.assertIsNone(self._switchboard._index.next_due)
+
+    def test_past_due(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, deliver_after=now() - timedelta(days=1))
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    def test_due_in_fifo_order(self):
+        # Delayed files take their place by the time they were received.
+        delayed = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(days=1))
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._switchboard.files, [filebase])
+        factory.fast_forward()
+        self.assertEqual(self._switchboard.files, [delayed, filebase])
+
+    def test_delayed_in_due_order(self):
+        later = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(days=2))
+        sooner = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(days=1))
+        self.assertEqual(self._switchboard.delayed_files, [sooner, later])
+
+    def test_removed_while_delayed(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(days=1))
+        self.assertEqual(self._switchboard.delayed_files, [filebase])
+        self._switchboard.dequeue(filebase)
+        self.assertEqual(self._switchboard.delayed_files, [])
+        self.assertIsNone(self._switchboard._index.next_due)
+        # Recovered backup files are still held back until they are due.
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.delayed_files, [filebase])
+
+
+class TestSlices(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._queue_directory = os.path.join(self._tempdir, 'test')
+
+    def _switchboard(self, **kws):
+        switchboard = Switchboard('test', self._queue_directory, **kws)
+        self.addCleanup(switchboard.close)
+        return switchboard
+
+    def test_digest_slice(self):
+        for numslices in (1, 2, 3, 6, 7):
+            self.assertEqual(digest_slice('0' * 40, numslices), 0)
+            self.assertEqual(digest_slice('f' * 40, numslices), numslices - 1)
+        self.assertEqual(digest_slice('7' + 'f' * 39, 2), 0)
+        self.assertEqual(digest_slice('8' + '0' * 39, 2), 1)
+        self.assertEqual(digest_slice('5' * 40, 3), 0)
+        self.assertEqual(digest_slice('5' * 39 + '6', 3), 1)
+
+    def test_any_number_of_slices(self):
+        writer = self._switchboard()
+        filebases = [writer.enqueue(self._msg, foo=i) for i in range(30)]
+        seen = []
+        for i in range(3):
+            seen.extend(self._switchboard(slice=i, numslices=3).files)
+        self.assertEqual(sorted(seen), sorted(filebases))
+
+    def test_steal_files(self):
+        # An idle slice may take the newer half of the other slices' files.
+        writer = self._switchboard()
+        filebases = [writer.enqueue(self._msg, foo=i) for i in range(20)]
+        mine = self._switchboard(slice=0, numslices=2)
+        others = [filebase for filebase in filebases
+                  if filebase not in mine.files]
+        self.assertEqual(mine.steal_files(), others[len(others) // 2:])
+        # Unsliced queues have nothing to steal.
+        self.assertEqual(writer.steal_files(), [])
+
+    def test_only_one_dequeue_wins(self):
+        filebase = self._switchboard().enqueue(self._msg)
+        thief = self._switchboard()
+        owner = self._switchboard()
+        thief.dequeue(filebase)
+        with self.assertRaises(FileNotFoundError):
+            owner.dequeue(filebase)
+        thief.finish(filebase)
+        self.assertEqual(os.listdir(self._queue_directory), [])
+
+    def test_recovery_skips_files_being_processed(self):
+        # Backup files which are locked by another live process are not
+        # recovered.
+        switchboard = self._switchboard()
+        filebase = switchboard.enqueue(self._msg)
+        backfile = os.path.join(self._queue_directory, filebase + '.bak')
+        locked_r, locked_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # The child process plays the runner which stole the file.
+            try:
+                os.close(locked_r)
+                os.close(done_w)
+                thief = self._switchboard()
+                thief.dequeue(filebase)
+                os.write(locked_w, b'x')
+                os.read(done_r, 1)
+            finally:
+                os._exit(0)
+        os.close(locked_w)
+        os.close(done_r)
+        self.addCleanup(os.close, locked_r)
+        self.assertEqual(os.read(locked_r, 1), b'x')
+        switchboard.recover_backup_files()
+        self.assertTrue(os.path.exists(backfile))
+        os.close(done_w)
+        os.waitpid(pid, 0)
+        # Now that the process is gone, the file is recovered.
+        switchboard.recover_backup_files()
+        self.assertEqual(switchboard.files, [filebase])
+
+
+class TestGroupCommit(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard(
+            'test', os.path.join(self._tempdir, 'test'))
+        self.addCleanup(self._switchboard.close)
+
+    def test_enqueues_are_deferred(self):
+        # Inside a group commit, the queue files are not yet visible.
+        with group_commit():
+            filebase_1 = self._switchboard.enqueue(self._msg, foo=1)
+            filebase_2 = self._switchboard.enqueue(self._msg, foo=2)
+            self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.files, [filebase_1, filebase_2])
+        msg, msgdata = self._switchboard.dequeue(filebase_2)
+        self.assertEqual(msgdata['foo'], 2)
+
+    def test_nested(self):
+        with group_commit():
+            with group_commit():
+                self._switchboard.enqueue(self._msg)
+            # The inner context joined the outer one.
+            self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(len(self._switchboard.files), 1)
+
+    def test_commit_on_exception(self):
+        # Enqueues made before an exception are committed anyway.
+        with suppress(RuntimeError):
+            with group_commit():
+                self._switchboard.enqueue(self._msg)
+                raise RuntimeError
+        self.assertEqual(len(self._switchboard.files), 1)
+
+    def test_cleanup_on_failed_commit(self):
+        # If the commit fails, no temporary files are left behind.
+        with self.assertRaises(OSError):
+            with patch('mailman.core.switchboard.os.fsync',
+                       side_effect=OSError('Oops!')):
+                with group_commit():
+                    self._switchboard.enqueue(self._msg)
+        self.assertEqual(os.listdir(self._switchboard.queue_directory), [])
+
+    def test_fsync_count(self):
+        # Without group commit each enqueue syncs its file, with it there is
+        # one more sync for the directory.
+        with patch('mailman.core.switchboard.os.fsync') as fsync:
+            for i in range(3):
+                self._switchboard.enqueue(self._msg)
+        self.assertEqual(fsync.call_count, 3)
+        with patch('mailman.core.switchboard.os.fsync') as fsync:
+            with group_commit():
+                for i in range(3):
+                    self._switchboard.enqueue(self._msg)
+        self.assertEqual(fsync.call_count, 4)
+
+
+class TestQueueFileFormat(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+Subject: Testing
+
+Body
+""")
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard(
+            'test', os.path.join(self._tempdir, 'test'))
+        self.addCleanup(self._switchboard.close)
+
+    def _path(self, filebase, extension='.pck'):
+        return os.path.join(
+            self._switchboard.queue_directory, filebase + extension)
+
+    def test_raw_bytes(self):
+        # The message is stored as its raw bytes.
+        filebase = self._switchboard.enqueue(self._msg, foo=1)
+        with open(self._path(filebase), 'rb') as fp:
+            contents = fp.read()
+        self.assertTrue(contents.startswith(QFILE_MAGIC))
+        self.assertIn(b'Message-ID: <ant>\n', contents)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, LazyMessage)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msg.get_payload(), 'Body\n')
+        self.assertEqual(msgdata['foo'], 1)
+
+    def test_wire_bytes_are_not_stored(self):
+        # Messages whose wire bytes were cached for delivery, e.g. ones which
+        # are requeued for a retry, are still stored as raw bytes.
+        self._msg.as_wire_bytes()
+        filebase = self._switchboard.enqueue(self._msg, foo=1)
+        with open(self._path(filebase), 'rb') as fp:
+            contents = fp.read()
+        self.assertTrue(contents.startswith(QFILE_MAGIC))
+        self.assertNotIn(b'\r\n', contents)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertNotIn('_wire', msg.__dict__)
+
+    def test_original_size(self):
+        filebase = self._switchboard.enqueue(
+            str(self._msg), _plaintext=True)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.original_size, len(str(self._msg)))
+        self.assertEqual(msgdata['original_size'], msg.original_size)
+        self._switchboard.finish(filebase)
+        # The original size survives requeuing the message.
+        filebase = self._switchboard.enqueue(msg, msgdata)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.original_size, len(str(self._msg)))
+
+    def test_unchanged_message_is_not_reflattened(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase)
+        with patch.object(LazyMessage, 'as_bytes') as as_bytes:
+            self._switchboard.enqueue(msg)
+        self.assertFalse(as_bytes.called)
+
+    def test_notifications_are_pickled(self):
+        # UserNotifications carry extra attributes and Header instances which
+        # don't survive being flattened, so they are still pickled.
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'Hi', 'Hello')
+        filebase = self._switchboard.enqueue(msg)
+        with open(self._path(filebase), 'rb') as fp:
+            self.assertFalse(fp.read().startswith(QFILE_MAGIC))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, UserNotification)
+        self.assertEqual(msg.recipients, {'anne@example.com'})
+
+    def test_legacy_pickle_format(self):
+        # Queue files written by older versions can still be dequeued.
+        filebase = '1234567890.1+' + 'a' * 40
+        with open(self._path(filebase), 'wb') as fp:
+            pickle.dump(self._msg, fp, 1)
+            pickle.dump(dict(foo=1, _parsemsg=False), fp, 1)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['foo'], 1)
+
+    def test_recover_backup_file(self):
+        filebase = self._switchboard.enqueue(self._msg, foo=1)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.files, [filebase])
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['_bak_count'], 1)
+        self.assertEqual(msgdata['foo'], 1)
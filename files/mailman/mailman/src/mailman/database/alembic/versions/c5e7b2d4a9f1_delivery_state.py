@@ -0,0 +1,63 @@
+"""Delivery state of messages with failed recipients.
+
+Revision ID: c5e7b2d4a9f1
+Revises: 3002bac0c25a
+Create Date: 2017-03-14 10:12:41.518276
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+from mailman.database.types import SAUnicode
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e7b2d4a9f1'
+down_revision = '3002bac0c25a'
+
+
+def upgrade():
+    op.create_table(
+        'delivery',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('list_id', SAUnicode(), nullable=True),
+        sa.Column('message_id', SAUnicode(), nullable=True),
+        sa.Column('created_on', sa.DateTime(), nullable=True),
+        sa.Column('deliver_until', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(
+        op.f('ix_delivery_list_id'), 'delivery', ['list_id'], unique=False)
+    op.create_table(
+        'delivery_recipient',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('delivery_id', sa.Integer(), nullable=True),
+        sa.Column('email', SAUnicode(), nullable=True),
+        sa.Column('status', sa.Integer(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('retry_after', sa.DateTime(), nullable=True),
+        sa.Column('updated_on', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['delivery_id'], ['delivery.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(
+        op.f('ix_delivery_recipient_delivery_id'), 'delivery_recipient',
+        ['delivery_id'], unique=False)
+    op.create_index(
+        op.f('ix_delivery_recipient_status'), 'delivery_recipient',
+        ['status'], unique=False)
+    op.create_index(
+        op.f('ix_delivery_recipient_retry_after'), 'delivery_recipient',
+        ['retry_after'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_delivery_recipient_retry_after'),
+                  table_name='delivery_recipient')
+    op.drop_index(op.f('ix_delivery_recipient_status'),
+                  table_name='delivery_recipient')
+    op.drop_index(op.f('ix_delivery_recipient_delivery_id'),
+                  table_name='delivery_recipient')
+    op.drop_table('delivery_recipient')
+    op.drop_index(op.f('ix_delivery_list_id'), table_name='delivery')
+    op.drop_table('delivery')
@@ -0,0 +1,137 @@
+"""The members' effective preferences.
+
+Revision ID: e3a1f08c6b27
+Revises: c5e7b2d4a9f1
+Create Date: 2017-03-21 15:47:03.204815
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+from mailman.core.constants import system_preferences
+from mailman.database.types import SAUnicode
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a1f08c6b27'
+down_revision = 'c5e7b2d4a9f1'
+
+
+# The preferences which resolve to a system default, and their types.  The
+# enums are stored as integers.
+PREFERENCES = (
+    ('acknowledge_posts', sa.Boolean),
+    ('delivery_mode', sa.Integer),
+    ('delivery_status', sa.Integer),
+    ('receive_list_copy', sa.Boolean),
+    ('receive_own_postings', sa.Boolean),
+    )
+
+
+def _default(name):
+    value = getattr(system_preferences, name)
+    return getattr(value, 'value', value)
+
+
+def upgrade():
+    effective_table = op.create_table(
+        'effective_preferences',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('member_id', sa.Integer(), nullable=True),
+        sa.Column('list_id', SAUnicode(), nullable=True),
+        sa.Column('role', sa.Integer(), nullable=True),
+        sa.Column('email', SAUnicode(), nullable=True),
+        sa.Column('acknowledge_posts', sa.Boolean(), nullable=True),
+        sa.Column('delivery_mode', sa.Integer(), nullable=True),
+        sa.Column('delivery_status', sa.Integer(), nullable=True),
+        sa.Column('receive_list_copy', sa.Boolean(), nullable=True),
+        sa.Column('receive_own_postings', sa.Boolean(), nullable=True),
+        sa.Column('preferred_language', SAUnicode(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(
+        op.f('ix_effective_preferences_member_id'), 'effective_preferences',
+        ['member_id'], unique=False)
+    op.create_index(
+        op.f('ix_effective_preferences_list_id'), 'effective_preferences',
+        ['list_id'], unique=False)
+    # Compute the effective preferences of the existing members.
+    member_table = sa.sql.table(
+        'member',
+        sa.sql.column('id', sa.Integer),
+        sa.sql.column('list_id', SAUnicode),
+        sa.sql.column('role', sa.Integer),
+        sa.sql.column('address_id', sa.Integer),
+        sa.sql.column('user_id', sa.Integer),
+        sa.sql.column('preferences_id', sa.Integer),
+        )
+    user_table = sa.sql.table(
+        'user',
+        sa.sql.column('id', sa.Integer),
+        sa.sql.column('_preferred_address_id', sa.Integer),
+        sa.sql.column('preferences_id', sa.Integer),
+        )
+    address_table = sa.sql.table(
+        'address',
+        sa.sql.column('id', sa.Integer),
+        sa.sql.column('email', SAUnicode),
+        sa.sql.column('user_id', sa.Integer),
+        sa.sql.column('preferences_id', sa.Integer),
+        )
+    preferences_table = sa.sql.table(
+        'preferences',
+        sa.sql.column('id', sa.Integer),
+        sa.sql.column('preferred_language', SAUnicode),
+        *[sa.sql.column(name, column_type)
+          for name, column_type in PREFERENCES]
+        )
+    mailinglist_table = sa.sql.table(
+        'mailinglist',
+        sa.sql.column('list_id', SAUnicode),
+        sa.sql.column('preferred_language', SAUnicode),
+        )
+    member_user = user_table.alias('member_user')
+    address = address_table.alias('member_address')
+    address_user = user_table.alias('address_user')
+    chain = (preferences_table.alias('member_preferences'),
+             preferences_table.alias('address_preferences'),
+             preferences_table.alias('user_preferences'))
+    columns = [member_table.c.id, member_table.c.list_id, member_table.c.role,
+               address.c.email]
+    for name, column_type in PREFERENCES:
+        columns.append(sa.func.coalesce(
+            *[preferences.c[name] for preferences in chain],
+            sa.literal(_default(name), column_type)))
+    columns.append(sa.func.coalesce(
+        *[preferences.c.preferred_language for preferences in chain],
+        mailinglist_table.c.preferred_language))
+    joins = member_table.outerjoin(
+        member_user, member_table.c.user_id == member_user.c.id
+        ).join(
+            address, address.c.id == sa.func.coalesce(
+                member_table.c.address_id,
+                member_user.c._preferred_address_id)
+        ).outerjoin(
+            address_user, address.c.user_id == address_user.c.id
+        ).outerjoin(
+            chain[0], member_table.c.preferences_id == chain[0].c.id
+        ).outerjoin(
+            chain[1], address.c.preferences_id == chain[1].c.id
+        ).outerjoin(
+            chain[2], address_user.c.preferences_id == chain[2].c.id
+        ).outerjoin(
+            mailinglist_table,
+            mailinglist_table.c.list_id == member_table.c.list_id)
+    op.execute(effective_table.insert().from_select(
+        ['member_id', 'list_id', 'role', 'email'] +
+        [name for name, column_type in PREFERENCES] +
+        ['preferred_language'],
+        sa.select(columns).select_from(joins)))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_effective_preferences_list_id'),
+                  table_name='effective_preferences')
+    op.drop_index(op.f('ix_effective_preferences_member_id'),
+                  table_name='effective_preferences')
+    op.drop_table('effective_preferences')
@@ -0,0 +1,29 @@
+"""The membership generation of the mailing lists.
+
+Revision ID: f1c9a2e4d837
+Revises: e3a1f08c6b27
+Create Date: 2017-03-24 11:05:52.730164
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+from mailman.database.types import SAUnicode
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c9a2e4d837'
+down_revision = 'e3a1f08c6b27'
+
+
+def upgrade():
+    op.create_table(
+        'membership_generation',
+        sa.Column('list_id', SAUnicode(), nullable=False),
+        sa.Column('generation', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('list_id')
+        )
+
+
+def downgrade():
+    op.drop_table('membership_generation')
@@ -19,12 +19,13 @@
 
 import logging
 
+from contextlib import contextmanager
 from mailman.config import config
 from mailman.interfaces.database import IDatabase
 from mailman.utilities.string import expand
 from public import public
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from zope.interface import implementer
 
 
@@ -55,6 +56,21 @@ class SABaseDatabase:
         """See `IDatabase`."""
         self.store.rollback()
 
+    @contextmanager
+    def savepoint(self):
+        """See `IDatabase`."""
+        nested = self.store.begin_nested()
+        try:
+            yield
+        except BaseException:
+            # The code in the block may have already committed or aborted.
+            if nested.is_active:
+                nested.rollback()
+            raise
+        else:
+            if nested.is_active:
+                nested.commit()
+
     def _pre_reset(self, store):
         """Clean up method for testing.
 
@@ -104,6 +120,7 @@ class SABaseDatabase:
         # half dozen and all...
         self.url = url
         self.engine = create_engine(url, isolation_level='READ UNCOMMITTED')
-        session = sessionmaker(bind=self.engine)
-        self.store = session()
+        # Each thread gets a session of its own, so that runners can do
+        # their work in more than one thread.
+        self.store = scoped_session(sessionmaker(bind=self.engine))
         self.store.commit()
@@ -19,6 +19,7 @@
 
 import os
 
+from contextlib import contextmanager
 from mailman.database.base import SABaseDatabase
 from public import public
 from urllib.parse import urlparse
@@ -42,3 +43,15 @@ class SQLiteDatabase(SABaseDatabase):
         # Ignore errors
         if fd > 0:
             os.close(fd)
+
+    @contextmanager
+    def savepoint(self):
+        """See `IDatabase`."""
+        # pysqlite only begins a transaction right before data is changed.
+        # Outside of one, a savepoint starts its own transaction, which is
+        # committed when the savepoint is released.
+        connection = self.store.connection().connection
+        if not connection.in_transaction:
+            connection.execute('BEGIN')
+        with super().savepoint():
+            yield
@@ -31,9 +31,11 @@ from mailman.database.transaction import transaction
 from mailman.database.types import Enum, SAUnicode
 from mailman.interfaces.action import Action
 from mailman.interfaces.cache import ICacheManager
-from mailman.interfaces.member import MemberRole
+from mailman.interfaces.member import (
+    DeliveryMode, DeliveryStatus, MemberRole)
 from mailman.interfaces.template import ITemplateManager
 from mailman.interfaces.usermanager import IUserManager
+from mailman.testing.helpers import set_preferred
 from mailman.testing.layers import ConfigLayer
 from zope.component import getUtility
 
@@ -484,3 +486,46 @@ class TestMigrations(unittest.TestCase):
         self.assertEqual(
             len(list(config.db.store.execute(mlist_table.select()))),
             0)
+
+    def test_e3a1f08c6b27_effective_preferences(self):
+        # The effective preferences of the existing members are computed.
+        user_manager = getUtility(IUserManager)
+        with transaction():
+            ant = create_list('ant@example.com')
+            anne = ant.subscribe(user_manager.create_address(
+                'anne@example.com'))
+            anne.preferences.delivery_mode = DeliveryMode.mime_digests
+            bart = user_manager.create_user('bart@example.com')
+            set_preferred(bart)
+            bart.preferences.receive_own_postings = False
+            bart.preferences.preferred_language = 'fr'
+            ant.subscribe(bart)
+        alembic.command.downgrade(alembic_cfg, 'c5e7b2d4a9f1')
+        self.assertFalse(exists_in_db(config.db.engine,
+                                      'effective_preferences'))
+        alembic.command.upgrade(alembic_cfg, 'e3a1f08c6b27')
+        effective_table = sa.sql.table(
+            'effective_preferences',
+            sa.sql.column('email', SAUnicode),
+            sa.sql.column('list_id', SAUnicode),
+            sa.sql.column('role', Enum(MemberRole)),
+            sa.sql.column('delivery_mode', Enum(DeliveryMode)),
+            sa.sql.column('delivery_status', Enum(DeliveryStatus)),
+            sa.sql.column('receive_own_postings', sa.Boolean),
+            sa.sql.column('preferred_language', SAUnicode),
+            )
+        rows = config.db.store.execute(sa.select([
+            effective_table.c.email,
+            effective_table.c.list_id,
+            effective_table.c.role,
+            effective_table.c.delivery_mode,
+            effective_table.c.delivery_status,
+            effective_table.c.receive_own_postings,
+            effective_table.c.preferred_language,
+            ]).order_by(effective_table.c.email)).fetchall()
+        self.assertEqual(rows, [
+            ('anne@example.com', 'ant.example.com', MemberRole.member,
+             DeliveryMode.mime_digests, DeliveryStatus.enabled, True, 'en'),
+            ('bart@example.com', 'ant.example.com', MemberRole.member,
+             DeliveryMode.regular, DeliveryStatus.enabled, False, 'fr'),
+            ])
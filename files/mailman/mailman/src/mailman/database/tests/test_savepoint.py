@@ -0,0 +1,62 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test database savepoints."""
+
+import unittest
+
+from contextlib import suppress
+from mailman.config import config
+from mailman.interfaces.usermanager import IUserManager
+from mailman.testing.layers import ConfigLayer
+from zope.component import getUtility
+
+
+class TestSavepoint(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._user_manager = getUtility(IUserManager)
+
+    def _emails(self):
+        return sorted(str(user.addresses[0].email)
+                      for user in self._user_manager.users)
+
+    def test_release(self):
+        with config.db.savepoint():
+            self._user_manager.create_user('anne@example.com')
+        self.assertEqual(self._emails(), ['anne@example.com'])
+        # Releasing the savepoint doesn't commit the transaction.
+        config.db.abort()
+        self.assertEqual(self._emails(), [])
+
+    def test_rollback(self):
+        self._user_manager.create_user('anne@example.com')
+        with suppress(RuntimeError):
+            with config.db.savepoint():
+                self._user_manager.create_user('bart@example.com')
+                raise RuntimeError
+        self.assertEqual(self._emails(), ['anne@example.com'])
+        config.db.commit()
+        self.assertEqual(self._emails(), ['anne@example.com'])
+
+    def test_several_savepoints(self):
+        for email in ('anne@example.com', 'bart@example.com'):
+            with config.db.savepoint():
+                self._user_manager.create_user(email)
+        config.db.abort()
+        self.assertEqual(self._emails(), [])
@@ -23,17 +23,39 @@ safe pickle deserialization, even if the email package adds additional Message
 attributes.
 """
 
+import re
 import email
+import copyreg
 import email.message
 import email.utils
 
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
+from email.parser import BytesParser
 from mailman.config import config
 from public import public
 
 
 COMMASPACE = ', '
+CRLF = '\r\n'
+# Notifications are queued in a higher priority lane than list traffic, so
+# that they aren't stuck behind a large posting backlog.
+NOTIFICATION_PRIORITY = 1
+
+
+def _state(msg):
+    # Everything the flattened message depends on.  Comparing states is cheap
+    # as long as the message is unchanged, since the payloads are then the
+    # very same objects.  Don't parse the raw body of a LazyMessage just to
+    # find out whether it changed.
+    raw = msg.__dict__.get('_raw')
+    if raw is not None:
+        return (msg._unixfrom, tuple(msg._headers), raw)
+    payload = msg._payload
+    if isinstance(payload, list):
+        payload = tuple(_state(part) for part in payload)
+    return (msg._unixfrom, tuple(msg._headers), msg.preamble, msg.epilogue,
+            payload)
 
 
 @public
@@ -45,6 +67,26 @@ class Message(email.message.Message):
     def __setstate__(self, values):
         self.__dict__ = values
 
+    def as_wire_bytes(self):
+        """Return the message as it is sent over SMTP.
+
+        This is `.as_string()` with CRLF line endings, encoded as ASCII.  It
+        is computed once, and then cached until the message changes.
+
+        :return: The flattened message.
+        :rtype: bytes
+        :raises UnicodeEncodeError: if the flattened message isn't ASCII.
+        """
+        state = _state(self)
+        cached = self.__dict__.get('_wire')
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        # This is how smtplib converts line endings.
+        wire = re.sub(r'(?:\r\n|\n|\r(?!\n))', CRLF,
+                      self.as_string()).encode('ascii')
+        self.__dict__['_wire'] = (state, wire)
+        return wire
+
     @property
     def sender(self):
         """The address considered to be the author of the email.
@@ -107,6 +149,110 @@ class Message(email.message.Message):
         return clean_senders
 
 
+@public
+class LazyMessage(Message):
+    """A message which only parses its body when it is needed.
+
+    The headers are parsed eagerly, but the body is kept as the raw bytes it
+    was parsed from until something needs the structure of the message, e.g.
+    by calling `.get_payload()`, `.is_multipart()` or `.walk()`.  Flattening
+    the message before then reuses the raw body as is.
+    """
+
+    # The raw bytes of the message while the body is unparsed.
+    _raw = None
+
+    @classmethod
+    def from_bytes(cls, raw):
+        """Parse the headers of a message given as bytes.
+
+        :param raw: The RFC 5322 message, optionally with a Unix From_ line.
+        :type raw: bytes
+        :return: The message, with its body parsed on demand.
+        :rtype: `LazyMessage`
+        """
+        msg = BytesParser(cls).parsebytes(raw, headersonly=True)
+        msg._raw = raw
+        msg._raw_headers = list(msg._headers)
+        msg._raw_unixfrom = msg._unixfrom
+        return msg
+
+    @property
+    def raw(self):
+        """The bytes the message was parsed from, if it is unchanged.
+
+        This is None once the body has been parsed, or if the headers have
+        been changed since parsing.
+        """
+        if (self._raw is None
+                or self._headers != self._raw_headers
+                or self._unixfrom != self._raw_unixfrom):
+            return None
+        return self._raw
+
+    @property
+    def _payload(self):
+        # Everything in the email package which touches the body goes
+        # through this attribute, so this is where the body gets parsed.
+        if self._raw is not None:
+            self._parse_body()
+        return self.__dict__.get('_body')
+
+    @_payload.setter
+    def _payload(self, value):
+        # A new body replaces the raw one.
+        self.__dict__['_raw'] = None
+        self.__dict__['_body'] = value
+
+    def _parse_body(self):
+        full = BytesParser(Message).parsebytes(self._raw)
+        self._payload = full._payload
+        self.preamble = full.preamble
+        self.epilogue = full.epilogue
+        self.defects = full.defects
+
+    def _header_block(self):
+        # A body-less stand-in for flattening just the headers.
+        msg = Message(policy=self.policy)
+        msg._headers = self._headers
+        msg._unixfrom = self._unixfrom
+        msg.set_payload('')
+        return msg
+
+    def as_string(self, unixfrom=False, maxheaderlen=0, policy=None):
+        """See `email.message.Message`."""
+        if self._raw is not None:
+            # The body is the raw text after the headers, decoded as ASCII
+            # with surrogate escapes by the parser.  8-bit bodies need the
+            # full generator to be converted to text.
+            body = self.__dict__['_body']
+            try:
+                body.encode('ascii')
+            except UnicodeError:
+                pass
+            else:
+                return self._header_block().as_string(
+                    unixfrom, maxheaderlen, policy) + body
+        return super().as_string(unixfrom, maxheaderlen, policy)
+
+    def as_bytes(self, unixfrom=False, policy=None):
+        """See `email.message.Message`."""
+        if self._raw is not None:
+            body = self.__dict__['_body'].encode('ascii', 'surrogateescape')
+            return self._header_block().as_bytes(unixfrom, policy) + body
+        return super().as_bytes(unixfrom, policy)
+
+    def __reduce_ex__(self, protocol):
+        # Pickles and copies are plain, fully parsed messages.
+        if self._raw is not None:
+            self._parse_body()
+        # The cached wire bytes wouldn't match the parsed message anyway.
+        state = {key: value for key, value in self.__dict__.items()
+                 if not key.startswith('_raw') and key != '_wire'}
+        state['_payload'] = state.pop('_body', None)
+        return copyreg._reconstructor, (Message, object, None), state
+
+
 @public
 class MultipartDigestMessage(MIMEMultipart, Message):
     """Mix-in class for MIME digest messages."""
@@ -169,6 +315,7 @@ class UserNotification(Message):
             recipients=self.recipients,
             nodecorate=True,
             reduced_list_headers=True,
+            priority=NOTIFICATION_PRIORITY,
             )
         if mlist is not None:
             enqueue_kws['listid'] = mlist.list_id
@@ -199,10 +346,13 @@ class OwnerNotification(UserNotification):
         # Not imported at module scope to avoid import loop
         virginq = config.switchboards['virgin']
         # The message metadata better have a `recip' attribute
-        virginq.enqueue(self,
-                        listid=mlist.list_id,
-                        recipients=self.recipients,
-                        nodecorate=True,
-                        reduced_list_headers=True,
-                        envsender=self._sender,
-                        **_kws)
+        enqueue_kws = dict(
+            listid=mlist.list_id,
+            recipients=self.recipients,
+            nodecorate=True,
+            reduced_list_headers=True,
+            envsender=self._sender,
+            priority=NOTIFICATION_PRIORITY,
+            )
+        enqueue_kws.update(_kws)
+        virginq.enqueue(self, **enqueue_kws)
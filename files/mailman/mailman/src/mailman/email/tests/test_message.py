@@ -17,14 +17,21 @@
 
 """Test the message API."""
 
+import copy
+import pickle
 import unittest
 
 from email.header import Header
+from email.mime.text import MIMEText
 from email.parser import FeedParser
 from mailman.app.lifecycle import create_list
-from mailman.email.message import Message, UserNotification
-from mailman.testing.helpers import get_queue_messages
+from mailman.config import config
+from mailman.email.message import (
+    LazyMessage, Message, OwnerNotification, UserNotification)
+from mailman.testing.helpers import (
+    get_queue_messages, specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 
 
 class TestMessage(unittest.TestCase):
@@ -51,6 +58,22 @@ class TestMessage(unittest.TestCase):
         self.assertEqual(items[0].msg.get_all('precedence'),
                          ['omg wtf bbq'])
 
+    def test_notification_priority(self):
+        # Notifications are queued ahead of list traffic.
+        self._msg.send(self._mlist)
+        virgin = config.switchboards['virgin']
+        self.assertTrue(virgin.files[0].endswith('+p1'))
+        items = get_queue_messages('virgin', expected_count=1)
+        self.assertEqual(items[0].msgdata['priority'], 1)
+
+    def test_owner_notification_priority(self):
+        msg = OwnerNotification(
+            self._mlist, 'Something you need to know',
+            'I needed to tell you this.')
+        msg.send(self._mlist)
+        items = get_queue_messages('virgin', expected_count=1)
+        self.assertEqual(items[0].msgdata['priority'], 1)
+
 
 class TestMessageSubclass(unittest.TestCase):
     layer = ConfigLayer
@@ -88,3 +111,122 @@ Test content
         msg['From'] = Header('test@example.com')
         # Make sure the senders property does not fail
         self.assertEqual(msg.senders, ['test@example.com'])
+
+
+class TestLazyMessage(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._raw = b"""\
+From: anne@example.com
+To: test@example.com
+Subject: Testing
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain; charset="iso-8859-1"
+Content-Transfer-Encoding: 8bit
+
+caf\xe9
+--BOUNDARY--
+"""
+
+    def test_headers_are_parsed(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        self.assertEqual(msg['subject'], 'Testing')
+        self.assertEqual(msg.get_content_type(), 'multipart/mixed')
+        # The body hasn't been parsed yet.
+        self.assertEqual(msg.raw, self._raw)
+
+    def test_body_is_parsed_on_demand(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        self.assertTrue(msg.is_multipart())
+        self.assertIsNone(msg.raw)
+        part = msg.get_payload(0)
+        self.assertEqual(part.get_payload(decode=True), b'caf\xe9')
+
+    def test_changed_headers(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        msg['X-Foo'] = 'yes'
+        self.assertIsNone(msg.raw)
+        # The unparsed body is reused when flattening.
+        expected = self._raw.replace(b'\n\n--', b'\nX-Foo: yes\n\n--', 1)
+        self.assertEqual(msg.as_bytes(), expected)
+        self.assertIsNotNone(msg._raw)
+
+    def test_pickle(self):
+        msg = LazyMessage.from_bytes(self._raw)
+        copy = pickle.loads(pickle.dumps(msg))
+        self.assertIs(type(copy), Message)
+        self.assertEqual(copy['subject'], 'Testing')
+        self.assertEqual(
+            copy.get_payload(0).get_payload(decode=True), b'caf\xe9')
+
+
+class TestWireBytes(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Subject: Testing
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+Hello.
+--BOUNDARY--
+""")
+
+    def test_crlf(self):
+        self.assertEqual(
+            self._msg.as_wire_bytes(),
+            self._msg.as_string().replace('\n', '\r\n').encode('ascii'))
+
+    def test_cached(self):
+        wire = self._msg.as_wire_bytes()
+        with patch.object(Message, 'as_string', side_effect=AssertionError):
+            self.assertIs(self._msg.as_wire_bytes(), wire)
+
+    def test_changed_header(self):
+        self._msg.as_wire_bytes()
+        self._msg.replace_header('Subject', 'Changed')
+        self.assertIn(b'Subject: Changed\r\n', self._msg.as_wire_bytes())
+
+    def test_changed_part(self):
+        self._msg.as_wire_bytes()
+        self._msg.get_payload(0).set_payload('Goodbye.\n')
+        self.assertIn(b'Goodbye.', self._msg.as_wire_bytes())
+        self._msg.attach(MIMEText('Another part.'))
+        self.assertIn(b'Another part.', self._msg.as_wire_bytes())
+
+    def test_copies(self):
+        wire = self._msg.as_wire_bytes()
+        message_copy = copy.deepcopy(self._msg)
+        message_copy['X-Foo'] = 'yes'
+        self.assertIn(b'X-Foo: yes', message_copy.as_wire_bytes())
+        self.assertEqual(self._msg.as_wire_bytes(), wire)
+
+    def test_pickle(self):
+        # The cached bytes survive the queues, e.g. for retries.
+        wire = self._msg.as_wire_bytes()
+        message_copy = pickle.loads(pickle.dumps(self._msg))
+        with patch.object(Message, 'as_string', side_effect=AssertionError):
+            self.assertEqual(message_copy.as_wire_bytes(), wire)
+
+    def test_lazy(self):
+        msg = LazyMessage.from_bytes(b"""\
+From: anne@example.com
+Subject: Testing
+
+Hello.
+""")
+        self.assertEqual(msg.as_wire_bytes(),
+                         b'From: anne@example.com\r\nSubject: Testing\r\n'
+                         b'\r\nHello.\r\n')
+        # The body wasn't parsed.
+        self.assertIsNotNone(msg.raw)
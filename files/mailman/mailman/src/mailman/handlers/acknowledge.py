@@ -24,6 +24,7 @@ from mailman.core.i18n import _
 from mailman.email.message import UserNotification
 from mailman.interfaces.handler import IHandler
 from mailman.interfaces.languages import ILanguageManager
+from mailman.interfaces.preferences import IEffectivePreferencesManager
 from mailman.interfaces.template import ITemplateLoader
 from mailman.utilities.string import expand, oneline
 from public import public
@@ -44,7 +45,10 @@ class Acknowledge:
         # Extract the sender's address and find them in the user database
         sender = msgdata.get('original_sender', msg.sender)
         member = mlist.members.get_member(sender)
-        if member is None or not member.acknowledge_posts:
+        preferences = (
+            None if member is None
+            else getUtility(IEffectivePreferencesManager).get(member))
+        if preferences is None or not preferences.acknowledge_posts:
             # Either the sender is not a member, in which case we can't know
             # whether they want an acknowlegment or not, or they are a member
             # who definitely does not want an acknowlegment.
@@ -56,9 +60,8 @@ class Acknowledge:
             'origsubj', msg.get('subject', _('(no subject)')))
         # Get the user's preferred language.
         language_manager = getUtility(ILanguageManager)
-        language = (language_manager[msgdata['lang']]
-                    if 'lang' in msgdata
-                    else member.preferred_language)
+        language = language_manager[msgdata.get(
+            'lang', preferences.preferred_language)]
         # Now get the acknowledgement template.
         display_name = mlist.display_name                        # noqa: F841
         template = getUtility(ITemplateLoader).get(
@@ -26,7 +26,9 @@ warning header, or pass it through, depending on the user's preferences.
 from email.utils import getaddresses, formataddr
 from mailman.core.i18n import _
 from mailman.interfaces.handler import IHandler
+from mailman.interfaces.preferences import IEffectivePreferencesManager
 from public import public
+from zope.component import getUtility
 from zope.interface import implementer
 
 
@@ -83,7 +85,11 @@ class AvoidDuplicates:
                 # recipient is not a member at all, they will get a copy.
                 # header.
                 member = mlist.members.get_member(r)
-                if member and not member.receive_list_copy:
+                preferences = (
+                    None if member is None
+                    else getUtility(IEffectivePreferencesManager).get(member))
+                if preferences is not None and (
+                        not preferences.receive_list_copy):
                     send_duplicate = False
                 # We'll send a duplicate unless the user doesn't wish it.  If
                 # personalization is enabled, the add-dupe-header flag will
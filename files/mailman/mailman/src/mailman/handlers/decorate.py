@@ -25,7 +25,9 @@ from email.utils import formataddr
 from mailman.core.i18n import _
 from mailman.email.message import Message
 from mailman.interfaces.handler import IHandler
+from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.mailinglist import IListArchiverSet
+from mailman.interfaces.preferences import IEffectivePreferencesManager
 from mailman.interfaces.template import ITemplateLoader
 from mailman.utilities.string import expand
 from public import public
@@ -39,9 +41,30 @@ alog = logging.getLogger('mailman.archiver')
 
 def process(mlist, msg, msgdata):
     """Decorate the message with headers and footers."""
+    decorations = get_decorations(mlist, msg, msgdata)
+    if decorations is not None:
+        header, footer = decorations
+        add_decorations(mlist, msg, header, footer)
+
+
+@public
+def get_decorations(mlist, msg, msgdata):
+    """Return the header and footer to decorate a message with.
+
+    :param mlist: The mailing list.
+    :type mlist: `IMailingList`
+    :param msg: The message being decorated.
+    :type msg: `Message`
+    :param msgdata: The message metadata, with the recipient's `member` if
+        the decorations are personalized, and optionally the member's
+        effective `preferences`.
+    :type msgdata: dict
+    :return: The header and footer, or None if the message isn't decorated.
+    :rtype: 2-tuple of str, or None
+    """
     # Digests and Mailman-craft messages should not get additional headers.
     if msgdata.get('isdigest') or msgdata.get('nodecorate'):
-        return
+        return None
     d = {}
     member = msgdata.get('member')
     if member is not None:
@@ -51,7 +74,11 @@ def process(mlist, msg, msgdata):
             (member.subscriber.display_name, member.subscriber.email))
         d['user_email'] = recipient
         d['user_delivered_to'] = member.address.original_email
-        d['user_language'] = member.preferred_language.description
+        preferences = msgdata.get('preferences')
+        if preferences is None:
+            preferences = getUtility(IEffectivePreferencesManager).get(member)
+        d['user_language'] = getUtility(ILanguageManager)[
+            preferences.preferred_language].description
         d['user_name'] = member.display_name
         # For backward compatibility.
         d['user_address'] = recipient
@@ -76,7 +103,23 @@ def process(mlist, msg, msgdata):
     footer = decorate('list:member:regular:footer', mlist, d)
     # Escape hatch if both the footer and header are empty or None.
     if len(header) == 0 and len(footer) == 0:
-        return
+        return None
+    return header, footer
+
+
+@public
+def add_decorations(mlist, msg, header, footer):
+    """Add a header and footer to the message.
+
+    :param mlist: The mailing list.
+    :type mlist: `IMailingList`
+    :param msg: The message to decorate, which is changed in place.
+    :type msg: `Message`
+    :param header: The header text.
+    :type header: str
+    :param footer: The footer text.
+    :type footer: str
+    """
     # Be MIME smart here.  We only attach the header and footer by
     # concatenation when the message is a non-multipart of type text/plain.
     # Otherwise, if it is not a multipart, we make it a multipart, and then we
@@ -26,10 +26,12 @@ SendmailDeliver and BulkDeliver modules.
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.interfaces.handler import IHandler
-from mailman.interfaces.member import DeliveryStatus
 from mailman.interfaces.pipeline import RejectMessage
+from mailman.interfaces.preferences import IEffectivePreferencesManager
+from mailman.interfaces.recipients import IRecipientCache
 from mailman.utilities.string import wrap
 from public import public
+from zope.component import getUtility
 from zope.interface import implementer
 
 
@@ -50,7 +52,10 @@ class MemberRecipients:
         # Should the original sender should be included in the recipients list?
         include_sender = True
         member = mlist.members.get_member(msg.sender)
-        if member and not member.receive_own_postings:
+        preferences = (
+            None if member is None
+            else getUtility(IEffectivePreferencesManager).get(member))
+        if preferences is not None and not preferences.receive_own_postings:
             include_sender = False
         # Support for urgent messages, which bypasses digests and disabled
         # delivery and forces an immediate delivery to all members Right Now.
@@ -79,13 +84,12 @@ Your urgent message to the $mlist.display_name mailing list was not authorized
 for delivery.  The original message as received by Mailman is attached.
 """)
                 raise RejectMessage(wrap(text))
-        # Calculate the regular recipients of the message
-        recipients = set(member.address.email
-                         for member in mlist.regular_members.members
-                         if member.delivery_status == DeliveryStatus.enabled)
+        # Calculate the regular recipients of the message.  They are only
+        # looked up when the membership of the list has changed.
+        recipients = set(getUtility(IRecipientCache).get_recipients(mlist))
         # Remove the sender if they don't want to receive their own posts
-        if not include_sender and member.address.email in recipients:
-            recipients.remove(member.address.email)
+        if not include_sender and preferences.email in recipients:
+            recipients.remove(preferences.email)
         # Handle topic classifications
         # XXX: Disabled for now until we fix it properly
         #
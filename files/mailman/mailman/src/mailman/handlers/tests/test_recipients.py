@@ -79,6 +79,20 @@ To: test@example.com
                                                      'bart@example.com',
                                                      'dave@example.com')))
 
+    def test_membership_changes(self):
+        # The recipients are cached, but follow the membership of the list.
+        msgdata = {}
+        self._process(self._mlist, self._msg, msgdata)
+        self.assertEqual(len(msgdata['recipients']), 4)
+        self._anne.preferences.delivery_status = DeliveryStatus.by_user
+        self._bart.unsubscribe()
+        self._mlist.subscribe(self._manager.create_address('elle@example.com'))
+        msgdata = {}
+        self._process(self._mlist, self._msg, msgdata)
+        self.assertEqual(msgdata['recipients'], set(('cris@example.com',
+                                                     'dave@example.com',
+                                                     'elle@example.com')))
+
 
 class TestOwnerRecipients(unittest.TestCase):
     """Test owner recipient calculation."""
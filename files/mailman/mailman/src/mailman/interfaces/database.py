@@ -49,6 +49,15 @@ class IDatabase(Interface):
     def abort():
         """Abort the current transaction."""
 
+    def savepoint():
+        """A context manager for a savepoint in the current transaction.
+
+        When the block exits with an exception, only the changes made since
+        the savepoint are rolled back, and the exception is re-raised.
+        Otherwise the savepoint is released, leaving the changes to be
+        committed with the rest of the transaction.
+        """
+
     store = Attribute(
         """The underlying database object on which you can do queries.""")
 
@@ -0,0 +1,176 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Interfaces for the delivery state of messages with failed recipients."""
+
+from enum import Enum
+from public import public
+from zope.interface import Attribute, Interface
+
+
+@public
+class DeliveryStatus(Enum):
+    """The delivery status of a recipient."""
+
+    # Delivery failed temporarily, and will be retried.
+    deferred = 1
+    # The message has been queued for another delivery attempt.
+    queued = 2
+    # The message has been delivered.
+    delivered = 3
+    # Delivery failed permanently.
+    failed = 4
+    # Delivery kept failing temporarily for too long, so it was given up.
+    expired = 5
+
+
+@public
+class IDeliveryRecipient(Interface):
+    """The delivery state of one recipient of a message."""
+
+    delivery = Attribute("""The `IDelivery` this recipient belongs to.""")
+
+    email = Attribute("""The recipient's email address.""")
+
+    status = Attribute("""The recipient's `DeliveryStatus`.""")
+
+    attempts = Attribute(
+        """The number of times delivery to this recipient was attempted.""")
+
+    retry_after = Attribute(
+        """The time at which a deferred recipient is due for a retry.""")
+
+    updated_on = Attribute("""The time the status was last changed.""")
+
+
+@public
+class IDelivery(Interface):
+    """A message whose delivery failed for some of its recipients.
+
+    Only the recipients which failed at some point are tracked.  The message
+    itself is stored once, for all the delivery attempts.
+    """
+
+    id = Attribute("""The delivery's unique id.""")
+
+    list_id = Attribute("""The List-ID of the mailing list.""")
+
+    message_id = Attribute("""The Message-ID of the message.""")
+
+    created_on = Attribute("""The time of the first failed delivery.""")
+
+    deliver_until = Attribute(
+        """The time after which delivery is given up, unless progress is made.
+        """)
+
+    recipients = Attribute(
+        """The `IDeliveryRecipient` records of the message, in no particular
+        order.""")
+
+    unresolved = Attribute(
+        """The number of recipients which are either deferred or queued.""")
+
+    def get_message():
+        """Return the stored message and metadata.
+
+        :return: The message and its metadata, or None if delivery to every
+            recipient is resolved and the message has been removed.
+        :rtype: 2-tuple of (`Message`, dict), or None
+        """
+
+    def record(temporary_failures, permanent_failures, retry_after,
+               delivered=()):
+        """Record the outcome of a delivery attempt.
+
+        :param temporary_failures: The recipients whose delivery failed
+            temporarily.  They are deferred.
+        :type temporary_failures: sequence of str
+        :param permanent_failures: The recipients whose delivery failed
+            permanently.
+        :type permanent_failures: sequence of str
+        :param retry_after: The time at which the deferred recipients are due
+            for a retry, either as a single time for all of them, or as a
+            dictionary mapping recipients to times.
+        :type retry_after: `datetime.datetime` or dict
+        :param delivered: The recipients which were delivered to.
+        :type delivered: sequence of str
+        """
+
+    def expire():
+        """Give up on delivering to all the deferred and queued recipients."""
+
+
+@public
+class IDeliveryStore(Interface):
+    """The delivery state of messages with failed recipients."""
+
+    deliveries = Attribute(
+        """An iterator over all the `IDelivery` records, oldest first.""")
+
+    def add(mlist, msg, msgdata):
+        """Start tracking the delivery of a message.
+
+        :param mlist: The mailing list the message is delivered for.
+        :type mlist: `IMailingList`
+        :param msg: The message.
+        :type msg: `Message`
+        :param msgdata: The message metadata.  The delivery specific keys,
+            such as the recipients, are not stored.
+        :type msgdata: dict
+        :return: The new delivery.
+        :rtype: `IDelivery`
+        """
+
+    def get(delivery_id):
+        """Return the delivery with the given id.
+
+        :param delivery_id: The delivery's id.
+        :type delivery_id: int
+        :return: The delivery, or None if there is no such delivery.
+        :rtype: `IDelivery`
+        """
+
+    def due():
+        """Mark the deferred recipients which are due for a retry as queued.
+
+        :return: The deliveries with recipients due for a retry, with those
+            recipients.
+        :rtype: list of 2-tuples of (`IDelivery`, list of str)
+        """
+
+    def next_due():
+        """Return when the next deferred recipient is due for a retry.
+
+        :return: The earliest retry time of the deferred recipients, or None
+            if there are none.
+        :rtype: `datetime.datetime`
+        """
+
+    def find(*, list_id=None, status=None):
+        """Find the recipient states matching the given criteria.
+
+        :param list_id: Only return the recipients of messages delivered for
+            the mailing list with this List-ID.
+        :type list_id: str
+        :param status: Only return the recipients with this status.
+        :type status: `DeliveryStatus`
+        :return: The matching recipient states, oldest delivery first.
+        :rtype: iterator of `IDeliveryRecipient`
+        """
+
+    def evict():
+        """Remove the resolved deliveries past their `deliver_until` time."""
@@ -25,10 +25,14 @@ from zope.interface import Interface
 @public
 class SomeRecipientsFailed(MailmanError):
     """Delivery to some or all recipients failed"""
-    def __init__(self, temporary_failures, permanent_failures):
+    def __init__(self, temporary_failures, permanent_failures,
+                 retry_after=None):
         super().__init__()
         self.temporary_failures = temporary_failures
         self.permanent_failures = permanent_failures
+        # Map temporary failures which must not be retried before a given
+        # time to that time.
+        self.retry_after = ({} if retry_after is None else retry_after)
 
 
 @public
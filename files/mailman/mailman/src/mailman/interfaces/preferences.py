@@ -82,3 +82,79 @@ class IPreferences(Interface):
         :type preferences: IPreferences
         :raises TypeError: if `preferences` isn't a preference.
         """
+
+
+@public
+class IEffectivePreferences(Interface):
+    """The effective preferences of a member.
+
+    These are the values the member's attributes resolve to, from the
+    member's, its address's and its user's preferences, or the defaults.
+    """
+
+    member_id = Attribute("""The id of the member.""")
+
+    list_id = Attribute("""The List-ID of the member's mailing list.""")
+
+    role = Attribute("""The member's `MemberRole`.""")
+
+    email = Attribute("""The email address the member is subscribed with.""")
+
+    acknowledge_posts = Attribute(
+        """The member's effective `acknowledge_posts` preference.""")
+
+    delivery_mode = Attribute(
+        """The member's effective `DeliveryMode`.""")
+
+    delivery_status = Attribute(
+        """The member's effective `DeliveryStatus`.""")
+
+    receive_list_copy = Attribute(
+        """The member's effective `receive_list_copy` preference.""")
+
+    receive_own_postings = Attribute(
+        """The member's effective `receive_own_postings` preference.""")
+
+    preferred_language = Attribute(
+        """The code of the member's effective preferred language.""")
+
+
+@public
+class IEffectivePreferencesManager(Interface):
+    """The table of the members' effective preferences.
+
+    The table is kept current as members, addresses, users, preferences and
+    mailing lists change in the database.  Rebuild it if the database was
+    changed by other means.
+    """
+
+    def get(member):
+        """Return the effective preferences of a member.
+
+        :param member: The member.
+        :type member: `IMember`
+        :return: The member's effective preferences, or None if the member
+            has no subscribed address.
+        :rtype: `IEffectivePreferences`
+        """
+
+    def get_many(members):
+        """Return the effective preferences of several members at once.
+
+        :param members: The members.
+        :type members: iterable of `IMember`
+        :return: The members' effective preferences, by member id.  Members
+            which have no subscribed address are missing.
+        :rtype: dict
+        """
+
+    def rebuild(mlist=None):
+        """Recompute the effective preferences of the members.
+
+        :param mlist: The mailing list whose members are recomputed.  If not
+            given, the members of all mailing lists are.
+        :type mlist: `IMailingList`
+        :return: The number of members whose effective preferences were
+            computed.
+        :rtype: int
+        """
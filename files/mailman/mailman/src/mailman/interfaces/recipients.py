@@ -0,0 +1,54 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Interface for the cache of the mailing lists' recipients."""
+
+from public import public
+from zope.interface import Interface
+
+
+@public
+class IRecipientCache(Interface):
+    """The regular delivery recipients of the mailing lists.
+
+    Every mailing list has a membership generation, which is bumped whenever
+    its members, or their effective preferences, change.  The recipients are
+    only looked up again when the generation of the mailing list changes.
+    """
+
+    def generation(mlist):
+        """Return the membership generation of the mailing list.
+
+        :param mlist: The mailing list.
+        :type mlist: `IMailingList`
+        :return: The membership generation, which is 0 until the membership
+            of the mailing list first changes.
+        :rtype: int
+        """
+
+    def get_recipients(mlist):
+        """Return the email addresses of the enabled regular members.
+
+        :param mlist: The mailing list.
+        :type mlist: `IMailingList`
+        :return: The email addresses the enabled regular delivery members are
+            subscribed with.
+        :rtype: frozenset of str
+        """
+
+    def clear():
+        """Forget the recipients cached by this process."""
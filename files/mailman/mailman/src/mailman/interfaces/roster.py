@@ -17,10 +17,20 @@
 
 """Interface for a roster of members."""
 
+from collections import namedtuple
 from public import public
 from zope.interface import Attribute, Interface
 
 
+@public
+class RosterEntry(namedtuple('RosterEntry', (
+        'email', 'original_email', 'display_name',
+        'delivery_mode', 'delivery_status'))):
+    """A member's address and effective delivery preferences."""
+
+    __slots__ = ()
+
+
 @public
 class IRoster(Interface):
     """A roster is a collection of `IMembers`."""
@@ -64,6 +74,67 @@ class IRoster(Interface):
         :rtype: `IMember` or None
         """
 
+    def get_members(emails):
+        """Get the members for many addresses at once.
+
+        This is like calling ``get_member()`` for each address, but it uses
+        only a few queries, which also load the members' addresses, users and
+        preferences.
+
+        :param emails: The email addresses to search for.
+        :type emails: iterable of strings
+        :return: A mapping from the email addresses which are found to their
+            members.
+        :rtype: dict
+        """
+
+    def find_members(**preferences):
+        """Find the members by their effective preferences.
+
+        The preferences are resolved the same way as the member's attributes
+        are: from the member, its address, the address's user, or the
+        defaults, whichever sets it first.  They are looked up in the table
+        of the members' effective preferences.  Only the
+        `acknowledge_posts`, `delivery_mode`, `delivery_status`,
+        `receive_list_copy`, `receive_own_postings` and `preferred_language`
+        preferences can be used.  The preferred language is given by its
+        code.
+
+        :param preferences: The preferences to match, mapped to their value,
+            or to a list, tuple or set of accepted values.
+        :return: The matching members.
+        :rtype: iterator of `IMember`
+        :raises ValueError: if one of the preferences can't be used.
+        """
+
+    def find_emails(**preferences):
+        """Find the members' email addresses by their effective preferences.
+
+        This is like `find_members()`, except that only the email addresses
+        the members are subscribed with are looked up.
+
+        :param preferences: The preferences to match, mapped to their value,
+            or to a list, tuple or set of accepted values.
+        :return: The matching members' email addresses.
+        :rtype: iterator of strings
+        :raises ValueError: if one of the preferences can't be used.
+        """
+
+    def find_entries(**preferences):
+        """Stream the members' addresses and delivery preferences.
+
+        This is like `find_members()`, except that no members, addresses or
+        users are loaded.  The rows are fetched from the database in batches
+        as they are iterated over, so that large rosters can be walked in
+        constant memory.
+
+        :param preferences: The preferences to match, mapped to their value,
+            or to a list, tuple or set of accepted values.
+        :return: The matching members' entries, sorted by email address.
+        :rtype: iterator of `RosterEntry`
+        :raises ValueError: if one of the preferences can't be used.
+        """
+
     def get_memberships(email):
         """Get the memberships for the given address.
 
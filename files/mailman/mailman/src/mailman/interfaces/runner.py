@@ -105,8 +105,13 @@ class IRunner(Interface):
         :param msgdata: The message metadata.
         :type msgdata: dict
         :return: True if the message should continue to be queued, False if
-            the message should be deleted automatically.
-        :rtype: bool
+            the message should be deleted automatically.  Runners whose
+            `concurrency` is more than one may instead return a
+            `concurrent.futures.Future` for work done in another thread.  Its
+            result is a callable, which is called without arguments in the
+            runner's thread once the future is done, and returns the boolean.
+            The queue file is finished only then.
+        :rtype: bool or `concurrent.futures.Future`
         """
 
     def _do_periodic():
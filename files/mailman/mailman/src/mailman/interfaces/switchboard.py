@@ -42,6 +42,11 @@ class ISwitchboard(Interface):
         keyword arguments are added to the metadata dictonary, with precedence
         given to the keyword arguments.
 
+        The `priority` metadata key gives the message's priority lane, where
+        higher lanes are processed first.  The default lane is 0.  The
+        `deliver_after` metadata key, if given, is a naive UTC datetime
+        before which the message is held back from the queue's files.
+
         The base name of the message file is returned.
         """
 
@@ -51,7 +56,8 @@ class ISwitchboard(Interface):
         filebase is the base name of the message file as returned by the
         .enqueue() method.  This file must exist and contain a message and
         metadata.  The message file is preserved in a backup file, which must
-        be removed by calling the .finish() method.
+        be removed by calling the .finish() method.  If the file has already
+        been dequeued, e.g. by another runner, `FileNotFoundError` is raised.
 
         Returned is a 2-tuple of the form (message, metadata).
         """
@@ -63,10 +69,29 @@ class ISwitchboard(Interface):
         a preservation file instead of being unlinked.
         """
 
+    def preserve(filebase, contents):
+        """Preserve a queue entry from another queue in this one.
+
+        This is used by .finish() to move an entry into the bad queue when
+        that queue is stored differently.  The entry is stored as if it were
+        a .psv file.
+
+        :param filebase: The base name of the entry.
+        :param contents: The serialized message and metadata.
+        :type contents: bytes
+        """
+
     files = Attribute(
         """An iterator over all the .pck files in the queue directory.
 
-        The base names of the matching files are returned.
+        The base names of the matching files are returned.  Files which are
+        delayed until a later time are not included until they are due.
+        """)
+
+    delayed_files = Attribute(
+        """The base names of the .pck files which are not due yet.
+
+        They are returned in the order in which they become due.
         """)
 
     def get_files(extension='.pck'):
@@ -77,6 +102,43 @@ class ISwitchboard(Interface):
         returned.
         """
 
+    def steal_files():
+        """Return the files in other slices which this slice may process.
+
+        A runner whose slice of the queue is empty uses this to help the
+        runners of busier slices.  Stolen files are dequeued and finished
+        like any other file, but another runner may dequeue a file first, in
+        which case .dequeue() raises a `FileNotFoundError`.
+
+        When the queue isn't sliced, no files are returned.  Like 'files',
+        the base names of the files are returned in FIFO order.
+        """
+
+    def wait(timeout, wakeup=None):
+        """Wait until there may be new files in the queue.
+
+        The wait ends early when the queue changes, when a delayed file falls
+        due, or when the `wakeup` file descriptor becomes readable.
+        Switchboards which can't tell when their queue changes return False
+        right away, and the caller should fall back to polling.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        :param wakeup: Optional file descriptor which also ends the wait when
+            it becomes readable.
+        :type wakeup: int
+        :return: Whether the switchboard waited for changes.
+        :rtype: bool
+        """
+
+    def close():
+        """Stop watching the queue for changes.
+
+        This releases the resources used to watch the queue, e.g. inotify
+        instances.  The switchboard can still be used, and watches the queue
+        again when it needs to.
+        """
+
     def recover_backup_files():
         """Move all backup files to active message files.
 
@@ -0,0 +1,301 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The delivery state of messages with failed recipients."""
+
+import os
+
+from contextlib import suppress
+from mailman.config import config
+from mailman.core.switchboard import deserialize, serialize
+from mailman.database.model import Model
+from mailman.database.transaction import dbconnection
+from mailman.database.types import Enum, SAUnicode
+from mailman.interfaces.deliveries import (
+    DeliveryStatus, IDelivery, IDeliveryRecipient, IDeliveryStore)
+from mailman.utilities.datetime import now
+from public import public
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, event, func
+from sqlalchemy.orm import Session, object_session, relationship
+from zope.interface import implementer
+
+
+# The metadata keys which describe a single delivery attempt, rather than the
+# message.  They are not stored with the message.
+ATTEMPT_KEYS = ('recipients', 'deliver_after', 'deliver_until',
+                'last_recip_count', 'delivery_id')
+
+UNRESOLVED = (DeliveryStatus.deferred, DeliveryStatus.queued)
+
+# The key of the message files written and removed in the current transaction
+# in the session's info dictionary.  Each is a 3-tuple of the transaction, or
+# savepoint, whether the file was written or removed, and its path.
+FILES_KEY = 'mailman.delivery_files'
+
+
+def _pending_files(session):
+    return session.info.setdefault(FILES_KEY, [])
+
+
+def _within(transaction, ancestor):
+    # Return whether the transaction is the ancestor or nested in it.
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+    # Undo the changes to the message files made in the rolled back
+    # transaction, or savepoint.  The files it wrote belong to deliveries
+    # which no longer exist, and the files it removed are kept.
+    pending = session.info.get(FILES_KEY)
+    if not pending:
+        return
+    kept = []
+    for transaction, written, path in pending:
+        if not _within(transaction, previous_transaction):
+            kept.append((transaction, written, path))
+        elif written:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+    session.info[FILES_KEY] = kept
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    # The files are only removed once the deliveries they belong to are
+    # resolved for good.
+    if session.transaction.nested:
+        return
+    for transaction, written, path in session.info.pop(FILES_KEY, ()):
+        if not written:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+
+@public
+@implementer(IDeliveryRecipient)
+class DeliveryRecipient(Model):
+    """The delivery state of one recipient of a message."""
+
+    __tablename__ = 'delivery_recipient'
+
+    id = Column(Integer, primary_key=True)
+    delivery_id = Column(Integer, ForeignKey('delivery.id'), index=True)
+    email = Column(SAUnicode)
+    status = Column(Enum(DeliveryStatus), index=True)
+    attempts = Column(Integer)
+    retry_after = Column(DateTime, index=True)
+    updated_on = Column(DateTime)
+
+    def __init__(self, email):
+        self.email = email
+        self.attempts = 0
+
+    def __repr__(self):
+        return '<DeliveryRecipient {} ({})>'.format(
+            self.email, self.status.name)
+
+
+@public
+@implementer(IDelivery)
+class Delivery(Model):
+    """A message whose delivery failed for some of its recipients."""
+
+    __tablename__ = 'delivery'
+
+    id = Column(Integer, primary_key=True)
+    list_id = Column(SAUnicode, index=True)
+    message_id = Column(SAUnicode)
+    created_on = Column(DateTime)
+    deliver_until = Column(DateTime)
+    recipients = relationship(
+        'DeliveryRecipient', backref='delivery',
+        cascade='all, delete-orphan')
+
+    def __init__(self, list_id, message_id):
+        self.list_id = list_id
+        self.message_id = message_id
+        self.created_on = now()
+        self.deliver_until = self.created_on
+
+    def __repr__(self):
+        return '<Delivery {} of {} to {}>'.format(
+            self.id, self.message_id, self.list_id)
+
+    @property
+    def _path(self):
+        return os.path.join(config.QUEUE_DIR, 'deliveries',
+                            '{}.pck'.format(self.id))
+
+    def _store_message(self, msg, msgdata):
+        # The file is written before the delivery is committed, and removed
+        # again if it is rolled back.
+        data = {key: value for key, value in msgdata.items()
+                if key not in ATTEMPT_KEYS}
+        filebase, contents = serialize(msg, data, {})
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmpfile = self._path + '.tmp'
+        with open(tmpfile, 'wb') as fp:
+            fp.write(contents)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmpfile, self._path)
+        session = object_session(self)
+        _pending_files(session).append((session.transaction, True, self._path))
+
+    def _remove_message(self):
+        # The file is only removed once the transaction is committed.
+        session = object_session(self)
+        _pending_files(session).append(
+            (session.transaction, False, self._path))
+
+    def _message_removed(self):
+        session = object_session(self)
+        return any(not written and path == self._path
+                   for transaction, written, path
+                   in session.info.get(FILES_KEY, ()))
+
+    @property
+    def unresolved(self):
+        """See `IDelivery`."""
+        return sum(1 for recipient in self.recipients
+                   if recipient.status in UNRESOLVED)
+
+    def get_message(self):
+        """See `IDelivery`."""
+        if self._message_removed():
+            return None
+        try:
+            with open(self._path, 'rb') as fp:
+                return deserialize(fp)
+        except FileNotFoundError:
+            return None
+
+    def record(self, temporary_failures, permanent_failures, retry_after,
+               delivered=()):
+        """See `IDelivery`."""
+        current_time = now()
+        by_email = {recipient.email: recipient
+                    for recipient in self.recipients}
+        outcomes = [(email, DeliveryStatus.deferred)
+                    for email in temporary_failures]
+        outcomes.extend((email, DeliveryStatus.failed)
+                        for email in permanent_failures)
+        outcomes.extend((email, DeliveryStatus.delivered)
+                        for email in delivered)
+        for email, status in outcomes:
+            recipient = by_email.get(email)
+            if recipient is None:
+                if status is DeliveryStatus.delivered:
+                    # Recipients which never failed aren't tracked.
+                    continue
+                recipient = by_email[email] = DeliveryRecipient(email)
+                self.recipients.append(recipient)
+            recipient.status = status
+            recipient.attempts += 1
+            recipient.updated_on = current_time
+            if status is not DeliveryStatus.deferred:
+                recipient.retry_after = None
+            elif isinstance(retry_after, dict):
+                recipient.retry_after = retry_after[email]
+            else:
+                recipient.retry_after = retry_after
+        if self.unresolved == 0:
+            self._remove_message()
+
+    def expire(self):
+        """See `IDelivery`."""
+        current_time = now()
+        for recipient in self.recipients:
+            if recipient.status in UNRESOLVED:
+                recipient.status = DeliveryStatus.expired
+                recipient.retry_after = None
+                recipient.updated_on = current_time
+        self._remove_message()
+
+
+@public
+@implementer(IDeliveryStore)
+class DeliveryStore:
+    """See `IDeliveryStore`."""
+
+    @property
+    @dbconnection
+    def deliveries(self, store):
+        """See `IDeliveryStore`."""
+        yield from store.query(Delivery).order_by(Delivery.id)
+
+    @dbconnection
+    def add(self, store, mlist, msg, msgdata):
+        """See `IDeliveryStore`."""
+        delivery = Delivery(mlist.list_id, msg.get('message-id'))
+        store.add(delivery)
+        # The id names the file the message is stored in.
+        store.flush()
+        delivery._store_message(msg, msgdata)
+        return delivery
+
+    @dbconnection
+    def get(self, store, delivery_id):
+        """See `IDeliveryStore`."""
+        return store.query(Delivery).get(delivery_id)
+
+    @dbconnection
+    def due(self, store):
+        """See `IDeliveryStore`."""
+        current_time = now()
+        due = {}
+        query = store.query(DeliveryRecipient).filter(
+            DeliveryRecipient.status == DeliveryStatus.deferred,
+            DeliveryRecipient.retry_after <= current_time,
+            ).order_by(DeliveryRecipient.delivery_id, DeliveryRecipient.id)
+        for recipient in query:
+            recipient.status = DeliveryStatus.queued
+            recipient.retry_after = None
+            recipient.updated_on = current_time
+            due.setdefault(recipient.delivery, []).append(recipient.email)
+        return sorted(due.items(), key=lambda item: item[0].id)
+
+    @dbconnection
+    def next_due(self, store):
+        """See `IDeliveryStore`."""
+        return store.query(func.min(DeliveryRecipient.retry_after)).filter(
+            DeliveryRecipient.status == DeliveryStatus.deferred).scalar()
+
+    @dbconnection
+    def find(self, store, *, list_id=None, status=None):
+        """See `IDeliveryStore`."""
+        query = store.query(DeliveryRecipient).join(Delivery)
+        if list_id is not None:
+            query = query.filter(Delivery.list_id == list_id)
+        if status is not None:
+            query = query.filter(DeliveryRecipient.status == status)
+        yield from query.order_by(Delivery.id, DeliveryRecipient.id)
+
+    @dbconnection
+    def evict(self, store):
+        """See `IDeliveryStore`."""
+        current_time = now()
+        for delivery in store.query(Delivery).filter(
+                Delivery.deliver_until < current_time):
+            if delivery.unresolved == 0:
+                delivery._remove_message()
+                store.delete(delivery)
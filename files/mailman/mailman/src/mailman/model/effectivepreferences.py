@@ -0,0 +1,261 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The table of the members' effective preferences."""
+
+from mailman.core.constants import system_preferences
+from mailman.database.model import Model
+from mailman.database.transaction import dbconnection
+from mailman.database.types import Enum, SAUnicode
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus, MemberRole
+from mailman.interfaces.preferences import (
+    IEffectivePreferences, IEffectivePreferencesManager)
+from mailman.model.address import Address
+from mailman.model.member import Member
+from mailman.model.preferences import Preferences
+from mailman.model.recipients import bump_generations
+from public import public
+from sqlalchemy import Boolean, Column, Integer, event, func, literal, or_
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session, aliased
+from zope.interface import implementer
+
+
+# The preferences which resolve to a system default.
+PREFERENCES = (
+    'acknowledge_posts',
+    'delivery_mode',
+    'delivery_status',
+    'receive_list_copy',
+    'receive_own_postings',
+    )
+
+# The maximum number of ids to look up in one query.  This keeps the number
+# of bound parameters well below SQLite's limit.
+MAX_IDS_PER_QUERY = 500
+
+
+@public
+@implementer(IEffectivePreferences)
+class EffectivePreferences(Model):
+    """See `IEffectivePreferences`."""
+
+    __tablename__ = 'effective_preferences'
+
+    id = Column(Integer, primary_key=True)
+    member_id = Column(Integer, index=True)
+    list_id = Column(SAUnicode, index=True)
+    role = Column(Enum(MemberRole))
+    email = Column(SAUnicode)
+    acknowledge_posts = Column(Boolean)
+    delivery_mode = Column(Enum(DeliveryMode))
+    delivery_status = Column(Enum(DeliveryStatus))
+    receive_list_copy = Column(Boolean)
+    receive_own_postings = Column(Boolean)
+    preferred_language = Column(SAUnicode)
+
+    def __repr__(self):
+        return '<EffectivePreferences of member {} ({})>'.format(
+            self.member_id, self.email)
+
+
+COLUMNS = ('member_id', 'list_id', 'role', 'email') + PREFERENCES + (
+    'preferred_language',)
+
+
+class _Resolver:
+    """Compute the effective preferences of members in the database.
+
+    Like `Member._lookup()`, each preference is taken from the member, its
+    address, the address's user, or the defaults, whichever comes first.
+    """
+
+    def __init__(self, store):
+        # Avoid circular imports.
+        from mailman.model.mailinglist import MailingList
+        from mailman.model.user import User
+        self.member_user = aliased(User)
+        self.address = aliased(Address)
+        self.address_user = aliased(User)
+        self.member_preferences = aliased(Preferences)
+        self.address_preferences = aliased(Preferences)
+        self.user_preferences = aliased(Preferences)
+        chain = (self.member_preferences,
+                 self.address_preferences,
+                 self.user_preferences)
+        columns = [Member.id, Member.list_id, Member.role, self.address.email]
+        for name in PREFERENCES:
+            column_type = getattr(Preferences, name).type
+            defaults = [getattr(preferences, name) for preferences in chain]
+            defaults.append(
+                literal(getattr(system_preferences, name), column_type))
+            columns.append(func.coalesce(*defaults, type_=column_type))
+        # The preferred language defaults to the mailing list's.
+        columns.append(func.coalesce(
+            *[preferences._preferred_language for preferences in chain],
+            MailingList._preferred_language))
+        self.query = store.query(*columns).select_from(Member).outerjoin(
+            self.member_user, Member.user_id == self.member_user.id
+            ).join(
+                self.address, self.address.id == func.coalesce(
+                    Member.address_id, self.member_user._preferred_address_id)
+            ).outerjoin(
+                self.address_user,
+                self.address.user_id == self.address_user.id
+            ).outerjoin(
+                self.member_preferences,
+                Member.preferences_id == self.member_preferences.id
+            ).outerjoin(
+                self.address_preferences,
+                self.address.preferences_id == self.address_preferences.id
+            ).outerjoin(
+                self.user_preferences,
+                self.address_user.preferences_id == self.user_preferences.id
+            ).outerjoin(
+                MailingList, MailingList._list_id == Member.list_id)
+
+
+def _delete(store, member_ids):
+    table = EffectivePreferences.__table__
+    member_ids = sorted(member_ids)
+    for i in range(0, len(member_ids), MAX_IDS_PER_QUERY):
+        store.execute(table.delete().where(
+            table.c.member_id.in_(member_ids[i:i + MAX_IDS_PER_QUERY])))
+
+
+def _store(store, query):
+    # Replace the effective preferences of the members found by the query.
+    rows = [dict(zip(COLUMNS, row)) for row in query]
+    _delete(store, [row['member_id'] for row in rows])
+    if len(rows) > 0:
+        store.execute(EffectivePreferences.__table__.insert(), rows)
+    return rows
+
+
+def _update(store, member_ids=(), preferences_ids=(), address_ids=(),
+            user_ids=(), list_ids=()):
+    # Recompute the effective preferences of the members which depend on any
+    # of the given rows, and return the List-IDs of their mailing lists.
+    resolver = _Resolver(store)
+    changed = set()
+    for ids, columns in (
+            (member_ids, [Member.id]),
+            (preferences_ids, [resolver.member_preferences.id,
+                               resolver.address_preferences.id,
+                               resolver.user_preferences.id]),
+            (address_ids, [resolver.address.id]),
+            (user_ids, [resolver.member_user.id, resolver.address_user.id]),
+            (list_ids, [Member.list_id]),
+            ):
+        ids = sorted(ids)
+        for i in range(0, len(ids), MAX_IDS_PER_QUERY):
+            chunk = ids[i:i + MAX_IDS_PER_QUERY]
+            rows = _store(store, resolver.query.filter(
+                or_(*[column.in_(chunk) for column in columns])))
+            changed.update(row['list_id'] for row in rows)
+    return changed
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    # Keep the effective preferences current as the rows they are computed
+    # from change.  The pre-flush state of the session is still available.
+    #
+    # Avoid circular imports.
+    from mailman.model.mailinglist import MailingList
+    from mailman.model.user import User
+    member_ids = set()
+    preferences_ids = set()
+    address_ids = set()
+    user_ids = set()
+    list_ids = set()
+    deleted = set()
+    # The List-IDs of the mailing lists whose membership changed.
+    changed = set()
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Member):
+            member_ids.add(obj.id)
+            changed.add(obj.list_id)
+        elif isinstance(obj, Preferences):
+            preferences_ids.add(obj.id)
+        elif isinstance(obj, Address):
+            address_ids.add(obj.id)
+        elif isinstance(obj, User):
+            user_ids.add(obj.id)
+        elif (isinstance(obj, MailingList) and
+              inspect(obj).attrs._preferred_language.history.has_changes()):
+            list_ids.add(obj.list_id)
+    for obj in session.deleted:
+        if isinstance(obj, Member):
+            deleted.add(obj.id)
+            changed.add(obj.list_id)
+    if len(deleted) > 0:
+        _delete(session, deleted)
+    if (len(member_ids) + len(preferences_ids) + len(address_ids) +
+            len(user_ids) + len(list_ids)) > 0:
+        # Members which no longer have an address keep no row.
+        _delete(session, member_ids)
+        changed.update(_update(session, member_ids, preferences_ids,
+                               address_ids, user_ids, list_ids))
+    # Invalidate the mailing lists' cached recipients.
+    bump_generations(session, changed)
+
+
+@public
+@implementer(IEffectivePreferencesManager)
+class EffectivePreferencesManager:
+    """See `IEffectivePreferencesManager`."""
+
+    @dbconnection
+    def get(self, store, member):
+        """See `IEffectivePreferencesManager`."""
+        # The rows are replaced behind the session's back, possibly reusing
+        # the ids of the rows it has already loaded.
+        return store.query(EffectivePreferences).filter_by(
+            member_id=member.id).populate_existing().one_or_none()
+
+    @dbconnection
+    def get_many(self, store, members):
+        """See `IEffectivePreferencesManager`."""
+        member_ids = sorted(member.id for member in members)
+        found = {}
+        for i in range(0, len(member_ids), MAX_IDS_PER_QUERY):
+            for preferences in store.query(EffectivePreferences).filter(
+                    EffectivePreferences.member_id.in_(
+                        member_ids[i:i + MAX_IDS_PER_QUERY])
+                    ).populate_existing():
+                found[preferences.member_id] = preferences
+        return found
+
+    @dbconnection
+    def rebuild(self, store, mlist=None):
+        """See `IEffectivePreferencesManager`."""
+        table = EffectivePreferences.__table__
+        if mlist is None:
+            store.execute(table.delete())
+            list_ids = [list_id for list_id, in
+                        store.query(Member.list_id).distinct()]
+        else:
+            store.execute(table.delete().where(
+                table.c.list_id == mlist.list_id))
+            list_ids = [mlist.list_id]
+        count = 0
+        for list_id in list_ids:
+            count += len(_store(store, _Resolver(store).query.filter(
+                Member.list_id == list_id)))
+        bump_generations(store, list_ids)
+        return count
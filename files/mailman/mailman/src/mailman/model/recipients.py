@@ -0,0 +1,166 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The cache of the mailing lists' recipients."""
+
+from lazr.config import as_boolean
+from mailman.config import config
+from mailman.database.model import Model
+from mailman.database.transaction import dbconnection
+from mailman.database.types import SAUnicode
+from mailman.interfaces.cache import ICacheManager
+from mailman.interfaces.member import DeliveryStatus
+from mailman.interfaces.recipients import IRecipientCache
+from public import public
+from sqlalchemy import Column, Integer, event
+from sqlalchemy.orm import Session
+from zope.component import getUtility
+from zope.interface import implementer
+
+
+# The keys of the per-transaction state in the session's info dictionary:
+# the List-IDs of the mailing lists whose membership the transaction changed,
+# the membership generations read in it, and the members looked up in it.
+CHANGED_KEY = 'mailman.membership_changed'
+GENERATIONS_KEY = 'mailman.membership_generations'
+LOOKUPS_KEY = 'mailman.member_lookups'
+
+
+@public
+class MembershipGeneration(Model):
+    """The membership generation of a mailing list."""
+
+    __tablename__ = 'membership_generation'
+
+    list_id = Column(SAUnicode, primary_key=True)
+    generation = Column(Integer)
+
+
+def bump_generations(store, list_ids):
+    """Bump the membership generation of the mailing lists.
+
+    :param store: The session to bump the generations in.
+    :param list_ids: The List-IDs of the mailing lists.
+    :type list_ids: iterable of str
+    """
+    table = MembershipGeneration.__table__
+    for list_id in sorted(list_ids):
+        result = store.execute(table.update().where(
+            table.c.list_id == list_id).values(
+                generation=table.c.generation + 1))
+        if result.rowcount == 0:
+            store.execute(table.insert().values(
+                list_id=list_id, generation=1))
+    if len(list_ids) > 0:
+        store.info.setdefault(CHANGED_KEY, set()).update(list_ids)
+        store.info.pop(LOOKUPS_KEY, None)
+
+
+def _read_generation(store, list_id):
+    generation = store.query(MembershipGeneration.generation).filter(
+        MembershipGeneration.list_id == list_id).scalar()
+    return 0 if generation is None else generation
+
+
+def cacheable_generation(store, list_id):
+    """Return the membership generation to cache lookups under.
+
+    Nothing may be cached for a mailing list whose membership changed in the
+    current transaction, because the change could still be rolled back, and
+    its generation reused by another change.  Otherwise, the generation is
+    only read once per transaction.
+
+    :param store: The session.
+    :param list_id: The List-ID of the mailing list.
+    :type list_id: str
+    :return: The membership generation of the mailing list, or None if it
+        changed in the current transaction.
+    :rtype: int
+    """
+    if list_id in store.info.get(CHANGED_KEY, ()):
+        return None
+    generations = store.info.setdefault(GENERATIONS_KEY, {})
+    generation = generations.get(list_id)
+    if generation is None:
+        generation = generations[list_id] = _read_generation(store, list_id)
+    return generation
+
+
+def member_lookups(store):
+    """Return the members looked up in the current transaction.
+
+    :param store: The session.
+    :return: A dictionary which is emptied when the transaction, or a
+        savepoint, ends, or when a membership changes in the transaction.
+    :rtype: dict
+    """
+    return store.info.setdefault(LOOKUPS_KEY, {})
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    # Savepoints end the lookups too, since they may have rolled back a
+    # change.
+    session.info.pop(LOOKUPS_KEY, None)
+    if transaction.parent is None:
+        session.info.pop(CHANGED_KEY, None)
+        session.info.pop(GENERATIONS_KEY, None)
+
+
+@public
+@implementer(IRecipientCache)
+class RecipientCache:
+    """See `IRecipientCache`."""
+
+    def __init__(self):
+        # Map List-IDs to the generation and the recipients.
+        self._snapshots = {}
+
+    @dbconnection
+    def generation(self, store, mlist):
+        """See `IRecipientCache`."""
+        return _read_generation(store, mlist.list_id)
+
+    @dbconnection
+    def get_recipients(self, store, mlist):
+        """See `IRecipientCache`."""
+        generation = cacheable_generation(store, mlist.list_id)
+        if generation is None:
+            return frozenset(mlist.regular_members.find_emails(
+                delivery_status=DeliveryStatus.enabled))
+        snapshot = self._snapshots.get(mlist.list_id)
+        if snapshot is not None and snapshot[0] == generation:
+            return snapshot[1]
+        recipients = None
+        shared = as_boolean(config.mailman.share_recipients)
+        key = 'recipients:{}:{}'.format(mlist.list_id, generation)
+        if shared:
+            contents = getUtility(ICacheManager).get(key)
+            if contents is not None:
+                recipients = frozenset(contents.splitlines())
+        if recipients is None:
+            recipients = frozenset(mlist.regular_members.find_emails(
+                delivery_status=DeliveryStatus.enabled))
+            if shared:
+                getUtility(ICacheManager).add(
+                    key, '\n'.join(sorted(recipients)))
+        self._snapshots[mlist.list_id] = (generation, recipients)
+        return recipients
+
+    def clear(self):
+        """See `IRecipientCache`."""
+        self._snapshots.clear()
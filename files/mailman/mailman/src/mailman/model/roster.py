@@ -22,16 +22,107 @@ the ones that fit a particular role.  These are used as the member, owner,
 moderator, and administrator roster filters.
 """
 
+import threading
+
+from collections import OrderedDict
+from mailman.config import config
 from mailman.database.transaction import dbconnection
 from mailman.interfaces.member import DeliveryMode, MemberRole
-from mailman.interfaces.roster import IRoster
+from mailman.interfaces.roster import IRoster, RosterEntry
 from mailman.model.address import Address
+from mailman.model.effectivepreferences import EffectivePreferences
 from mailman.model.member import Member
+from mailman.model.recipients import cacheable_generation, member_lookups
 from public import public
-from sqlalchemy import or_
+from sqlalchemy import false, func, or_
+from sqlalchemy.orm import contains_eager, joinedload
 from zope.interface import implementer
 
 
+# The maximum number of email addresses to look up in one query.  This keeps
+# the number of bound parameters well below SQLite's limit.
+MAX_EMAILS_PER_QUERY = 500
+
+# The number of rows to fetch at a time when streaming a roster.
+ROWS_PER_FETCH = 1000
+
+MISSING = object()
+
+
+@public
+class MemberCache:
+    """The ids of the members found by `get_member()` in this process.
+
+    The entries are keyed by the List-ID, the roster name and the email
+    address, and are only used while the membership generation of the
+    mailing list they were found in is current.  The least recently used
+    entries are evicted beyond `[mailman]member_cache_size` entries.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        """Return the cached member id, or `MISSING`.
+
+        :param key: The List-ID, roster name and email address.
+        :type key: tuple
+        :param generation: The current membership generation of the list.
+        :type generation: int
+        :return: The id of the member, None if there is no such member, or
+            `MISSING` if it isn't known.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                return MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def add(self, key, generation, member_id):
+        """Cache the id of a member.
+
+        :param key: The List-ID, roster name and email address.
+        :type key: tuple
+        :param generation: The membership generation of the list.
+        :type generation: int
+        :param member_id: The id of the member, or None if there is no such
+            member.
+        :type member_id: int
+        """
+        size = int(config.mailman.member_cache_size)
+        if size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (generation, member_id)
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forget all the entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+member_cache = MemberCache()
+public(member_cache=member_cache)
+
+# The preferences which members can be found by.
+QUERYABLE_PREFERENCES = (
+    'acknowledge_posts',
+    'delivery_mode',
+    'delivery_status',
+    'receive_list_copy',
+    'receive_own_postings',
+    'preferred_language',
+    )
+
+
 @public
 @implementer(IRoster)
 class AbstractRoster:
@@ -103,8 +194,37 @@ class AbstractRoster:
             User._preferred_address_id == Address.id)
         return members_a.union(members_u).all()
 
-    def get_member(self, email):
+    @dbconnection
+    def get_member(self, store, email):
         """See ``IRoster``."""
+        key = (self._mlist.list_id, self.name, email)
+        # The members found in this transaction are kept, so they stay in
+        # the session's identity map.  They are forgotten when the membership
+        # changes, so they can be returned without any query.
+        lookups = member_lookups(store)
+        member = lookups.get(key, MISSING)
+        if member is not MISSING:
+            return member
+        generation = cacheable_generation(store, self._mlist.list_id)
+        if generation is None:
+            # The membership changed in this transaction.
+            return self._get_member(email)
+        member_id = member_cache.get(key, generation)
+        if member_id is None:
+            member = None
+        elif member_id is not MISSING:
+            # Look the member up again if it has been deleted anyway.
+            member = store.query(Member).get(member_id)
+            if member is None:
+                member_id = MISSING
+        if member_id is MISSING:
+            member = self._get_member(email)
+            member_cache.add(
+                key, generation, None if member is None else member.id)
+        lookups[key] = member
+        return member
+
+    def _get_member(self, email):
         memberships = self._get_all_memberships(email)
         count = len(memberships)
         if count == 0:
@@ -119,6 +239,56 @@ class AbstractRoster:
                 if memberships[0]._address is not None
                 else memberships[1])
 
+    @dbconnection
+    def get_members(self, store, emails):
+        """See ``IRoster``."""
+        # Avoid circular imports.
+        from mailman.model.user import User
+        emails = list(emails)
+        explicit = {}
+        preferred = {}
+        for i in range(0, len(emails), MAX_EMAILS_PER_QUERY):
+            chunk = emails[i:i + MAX_EMAILS_PER_QUERY]
+            # Members subscribed with an explicit email address, along with
+            # the address, its user, and all their preferences.
+            members_a = store.query(Member).join(
+                Address, Member.address_id == Address.id
+                ).filter(
+                    Member.list_id == self._mlist.list_id,
+                    Member.role == self.role,
+                    Address.email.in_(chunk)
+                ).options(
+                    joinedload(Member.preferences),
+                    contains_eager(Member._address).joinedload(
+                        Address.preferences),
+                    contains_eager(Member._address).joinedload(
+                        Address.user).joinedload(User.preferences),
+                )
+            for member in members_a:
+                explicit[member._address.email] = member
+            # Members subscribed with their preferred address, along with the
+            # user, the address, and all their preferences.
+            members_u = store.query(Member).join(
+                User, Member.user_id == User.id
+                ).join(
+                    Address, User._preferred_address_id == Address.id
+                ).filter(
+                    Member.list_id == self._mlist.list_id,
+                    Member.role == self.role,
+                    Address.email.in_(chunk)
+                ).options(
+                    joinedload(Member.preferences),
+                    contains_eager(Member._user).joinedload(User.preferences),
+                    contains_eager(Member._user).contains_eager(
+                        User._preferred_address).joinedload(
+                            Address.preferences),
+                )
+            for member in members_u:
+                preferred[member._user._preferred_address.email] = member
+        # As with get_member(), the explicit address membership wins.
+        preferred.update(explicit)
+        return preferred
+
     def get_memberships(self, email):
         """See ``IRoster``."""
         memberships = self._get_all_memberships(email)
@@ -127,6 +297,51 @@ class AbstractRoster:
             count)
         return memberships
 
+    def _find(self, preferences):
+        # Return a query for the members with the given effective
+        # preferences, joined to the table of the members' effective
+        # preferences, which is kept current as the preferences change.
+        query = self._query().join(
+            EffectivePreferences, EffectivePreferences.member_id == Member.id)
+        for name, value in sorted(preferences.items()):
+            if name not in QUERYABLE_PREFERENCES:
+                raise ValueError('Not a queryable preference: {}'.format(name))
+            column = getattr(EffectivePreferences, name)
+            if isinstance(value, (list, tuple, set, frozenset)):
+                # An empty IN () is legal, but SQLAlchemy warns about it.
+                query = query.filter(
+                    column.in_(value) if len(value) > 0 else false())
+            else:
+                query = query.filter(column == value)
+        return query
+
+    def find_members(self, **preferences):
+        """See ``IRoster``."""
+        yield from self._find(preferences)
+
+    def find_emails(self, **preferences):
+        """See ``IRoster``."""
+        query = self._find(preferences).with_entities(
+            EffectivePreferences.email)
+        for email, in query.yield_per(ROWS_PER_FETCH):
+            yield email
+
+    def find_entries(self, **preferences):
+        """See ``IRoster``."""
+        # Only columns are selected, so nothing is added to the session's
+        # identity map.
+        query = self._find(preferences).join(
+            Address, Address.email == EffectivePreferences.email
+            ).with_entities(
+                EffectivePreferences.email,
+                func.coalesce(Address._original, Address.email),
+                Address.display_name,
+                EffectivePreferences.delivery_mode,
+                EffectivePreferences.delivery_status,
+            ).order_by(EffectivePreferences.email)
+        for row in query.yield_per(ROWS_PER_FETCH):
+            yield RosterEntry(*row)
+
 
 @public
 class MemberRoster(AbstractRoster):
@@ -183,36 +398,41 @@ class AdministratorRoster(AbstractRoster):
             Address.email == email,
             Member.address_id == Address.id).one_or_none()
 
+    def get_members(self, emails):
+        """See `IRoster`."""
+        members = {}
+        for email in emails:
+            member = self.get_member(email)
+            if member is not None:
+                members[email] = member
+        return members
+
 
 @public
 class DeliveryMemberRoster(AbstractRoster):
     """Return all the members having a particular kind of delivery."""
 
     role = MemberRole.member
+    # The delivery modes of the members in this roster.
+    delivery_modes = ()
+
+    def _find(self, preferences):
+        modes = preferences.get('delivery_mode', self.delivery_modes)
+        if not isinstance(modes, (list, tuple, set, frozenset)):
+            modes = (modes,)
+        preferences['delivery_mode'] = [
+            mode for mode in self.delivery_modes if mode in modes]
+        return super()._find(preferences)
 
     @property
-    def member_count(self):
+    def members(self):
         """See `IRoster`."""
-        # XXX 2012-03-15 BAW: It would be nice to make this more efficient.
-        # The problem is that you'd have to change the loop in _get_members()
-        # checking the delivery mode to a query parameter.
-        return len(tuple(self.members))
+        yield from self.find_members()
 
-    @dbconnection
-    def _get_members(self, store, *delivery_modes):
-        """The set of members for a mailing list, filter by delivery mode.
-
-        :param delivery_modes: The modes to filter on.
-        :type delivery_modes: sequence of `DeliveryMode`.
-        :return: A generator of members.
-        :rtype: generator
-        """
-        results = store.query(Member).filter_by(
-            list_id=self._mlist.list_id,
-            role=MemberRole.member)
-        for member in results:
-            if member.delivery_mode in delivery_modes:
-                yield member
+    @property
+    def member_count(self):
+        """See `IRoster`."""
+        return self._find({}).count()
 
 
 @public
@@ -220,11 +440,7 @@ class RegularMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'regular_members'
-
-    @property
-    def members(self):
-        """See `IRoster`."""
-        yield from self._get_members(DeliveryMode.regular)
+    delivery_modes = (DeliveryMode.regular,)
 
 
 @public
@@ -232,14 +448,11 @@ class DigestMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'digest_members'
-
-    @property
-    def members(self):
-        """See `IRoster`."""
-        yield from self._get_members(
-            DeliveryMode.plaintext_digests,
-            DeliveryMode.mime_digests,
-            DeliveryMode.summary_digests)
+    delivery_modes = (
+        DeliveryMode.plaintext_digests,
+        DeliveryMode.mime_digests,
+        DeliveryMode.summary_digests,
+        )
 
 
 @public
@@ -298,6 +511,23 @@ class Memberships:
         """See `IRoster`."""
         raise NotImplementedError
 
+    @dbconnection
+    def get_members(self, store, emails):
+        """See `IRoster`."""
+        raise NotImplementedError
+
+    def find_members(self, **preferences):
+        """See `IRoster`."""
+        raise NotImplementedError
+
+    def find_emails(self, **preferences):
+        """See `IRoster`."""
+        raise NotImplementedError
+
+    def find_entries(self, **preferences):
+        """See `IRoster`."""
+        raise NotImplementedError
+
     @dbconnection
     def get_memberships(self, store, address):
         """See `IRoster`."""
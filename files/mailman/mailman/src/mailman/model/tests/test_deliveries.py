@@ -0,0 +1,241 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the delivery state store."""
+
+import os
+import unittest
+
+from datetime import timedelta
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.interfaces.deliveries import DeliveryStatus, IDeliveryStore
+from mailman.testing.helpers import (
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import factory, now
+from zope.component import getUtility
+
+
+class TestDeliveryStore(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._store = getUtility(IDeliveryStore)
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+A message.
+""")
+        self._msgdata = dict(
+            listid='test.example.com',
+            recipients=['bart@example.com', 'cris@example.com'],
+            deliver_until=now(),
+            tolist=True,
+            )
+
+    def _statuses(self, delivery):
+        return sorted((recipient.email, recipient.status)
+                      for recipient in delivery.recipients)
+
+    def test_add(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        self.assertEqual(delivery.list_id, 'test.example.com')
+        self.assertEqual(delivery.message_id, '<ant>')
+        self.assertEqual(delivery.created_on, now())
+        self.assertEqual(delivery.recipients, [])
+        self.assertEqual(self._store.get(delivery.id), delivery)
+        self.assertEqual(list(self._store.deliveries), [delivery])
+
+    def test_stored_message(self):
+        # The message is stored with its metadata, except for the keys which
+        # describe a single delivery attempt.
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        msg, msgdata = delivery.get_message()
+        self.assertEqual(msg.as_string(), self._msg.as_string())
+        self.assertEqual(msgdata['listid'], 'test.example.com')
+        self.assertTrue(msgdata['tolist'])
+        self.assertNotIn('recipients', msgdata)
+        self.assertNotIn('deliver_until', msgdata)
+
+    def test_get_missing(self):
+        self.assertIsNone(self._store.get(801))
+
+    def test_record(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        later = now() + timedelta(minutes=15)
+        delivery.record(['bart@example.com'], ['cris@example.com'], later,
+                        delivered=['dave@example.com'])
+        # Recipients which never failed aren't tracked.
+        self.assertEqual(self._statuses(delivery), [
+            ('bart@example.com', DeliveryStatus.deferred),
+            ('cris@example.com', DeliveryStatus.failed),
+            ])
+        self.assertEqual(delivery.unresolved, 1)
+        bart = [recipient for recipient in delivery.recipients
+                if recipient.email == 'bart@example.com'][0]
+        self.assertEqual(bart.retry_after, later)
+        self.assertEqual(bart.attempts, 1)
+        self.assertEqual(bart.updated_on, now())
+        self.assertEqual(bart.delivery, delivery)
+
+    def test_record_retry_times(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        sooner = now() + timedelta(minutes=15)
+        later = now() + timedelta(hours=1)
+        delivery.record(
+            ['bart@example.com', 'cris@example.com'], [],
+            {'bart@example.com': sooner, 'cris@example.com': later})
+        self.assertEqual(
+            sorted((recipient.email, recipient.retry_after)
+                   for recipient in delivery.recipients),
+            [('bart@example.com', sooner), ('cris@example.com', later)])
+
+    def test_due(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        delivery.record(
+            ['bart@example.com', 'cris@example.com'], [],
+            {'bart@example.com': now() + timedelta(minutes=15),
+             'cris@example.com': now() + timedelta(days=2)})
+        self.assertEqual(self._store.due(), [])
+        factory.fast_forward()
+        self.assertEqual(self._store.due(),
+                         [(delivery, ['bart@example.com'])])
+        # The due recipients are queued, so they are only returned once.
+        self.assertEqual(self._statuses(delivery), [
+            ('bart@example.com', DeliveryStatus.queued),
+            ('cris@example.com', DeliveryStatus.deferred),
+            ])
+        self.assertEqual(delivery.unresolved, 2)
+        self.assertEqual(self._store.due(), [])
+
+    def test_next_due(self):
+        self.assertIsNone(self._store.next_due())
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        sooner = now() + timedelta(minutes=15)
+        later = now() + timedelta(days=2)
+        delivery.record(
+            ['bart@example.com', 'cris@example.com'], [],
+            {'bart@example.com': later, 'cris@example.com': sooner})
+        self.assertEqual(self._store.next_due(), sooner)
+        factory.fast_forward()
+        self._store.due()
+        # Queued recipients are no longer due.
+        self.assertEqual(self._store.next_due(), later)
+
+    def test_message_removed_when_resolved(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        delivery.record(['bart@example.com'], [], now())
+        path = delivery._path
+        self.assertTrue(os.path.exists(path))
+        delivery.record([], [], now(), delivered=['bart@example.com'])
+        self.assertEqual(self._statuses(delivery), [
+            ('bart@example.com', DeliveryStatus.delivered),
+            ])
+        self.assertEqual(delivery.recipients[0].attempts, 2)
+        self.assertIsNone(delivery.recipients[0].retry_after)
+        self.assertIsNone(delivery.get_message())
+        # The file is only removed once the transaction is committed.
+        self.assertTrue(os.path.exists(path))
+        config.db.commit()
+        self.assertFalse(os.path.exists(path))
+
+    def test_message_removed_on_rollback(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        path = delivery._path
+        self.assertTrue(os.path.exists(path))
+        config.db.abort()
+        self.assertFalse(os.path.exists(path))
+
+    def test_message_kept_on_rollback(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        delivery.record(['bart@example.com'], [], now())
+        config.db.commit()
+        delivery.expire()
+        self.assertIsNone(delivery.get_message())
+        config.db.abort()
+        self.assertTrue(os.path.exists(delivery._path))
+        msg, msgdata = delivery.get_message()
+        self.assertEqual(msg['message-id'], '<ant>')
+        config.db.commit()
+        self.assertTrue(os.path.exists(delivery._path))
+
+    def test_savepoint_rollback(self):
+        kept = self._store.add(self._mlist, self._msg, self._msgdata)
+        kept.record(['bart@example.com'], [], now())
+        with self.assertRaises(RuntimeError):
+            with config.db.savepoint():
+                kept.expire()
+                lost = self._store.add(self._mlist, self._msg, self._msgdata)
+                lost_path = lost._path
+                raise RuntimeError
+        self.assertFalse(os.path.exists(lost_path))
+        self.assertIsNotNone(kept.get_message())
+        config.db.commit()
+        self.assertTrue(os.path.exists(kept._path))
+        self.assertFalse(os.path.exists(lost_path))
+
+    def test_expire(self):
+        delivery = self._store.add(self._mlist, self._msg, self._msgdata)
+        delivery.record(['bart@example.com'], ['cris@example.com'], now())
+        delivery.expire()
+        self.assertEqual(self._statuses(delivery), [
+            ('bart@example.com', DeliveryStatus.expired),
+            ('cris@example.com', DeliveryStatus.failed),
+            ])
+        self.assertIsNone(delivery.get_message())
+        self.assertEqual(self._store.due(), [])
+
+    def test_find(self):
+        other_list = create_list('other@example.com')
+        first = self._store.add(self._mlist, self._msg, self._msgdata)
+        first.record(['bart@example.com'], ['cris@example.com'], now())
+        second = self._store.add(other_list, self._msg, self._msgdata)
+        second.record(['dave@example.com'], [], now())
+        self.assertEqual(
+            [recipient.email for recipient in self._store.find()],
+            ['bart@example.com', 'cris@example.com', 'dave@example.com'])
+        self.assertEqual(
+            [recipient.email for recipient in self._store.find(
+                list_id='test.example.com')],
+            ['bart@example.com', 'cris@example.com'])
+        self.assertEqual(
+            [recipient.email for recipient in self._store.find(
+                status=DeliveryStatus.deferred)],
+            ['bart@example.com', 'dave@example.com'])
+        self.assertEqual(
+            [recipient.email for recipient in self._store.find(
+                list_id='other.example.com', status=DeliveryStatus.failed)],
+            [])
+
+    def test_evict(self):
+        # Only the resolved deliveries past their deliver_until time are
+        # evicted.
+        resolved = self._store.add(self._mlist, self._msg, self._msgdata)
+        resolved.record([], ['bart@example.com'], now())
+        unresolved = self._store.add(self._mlist, self._msg, self._msgdata)
+        unresolved.record(['bart@example.com'], [], now())
+        recent = self._store.add(self._mlist, self._msg, self._msgdata)
+        recent.record([], ['bart@example.com'], now())
+        recent.deliver_until = now() + timedelta(days=2)
+        factory.fast_forward()
+        self._store.evict()
+        self.assertEqual(list(self._store.deliveries), [unresolved, recent])
+        self.assertEqual(len(list(self._store.find())), 2)
@@ -0,0 +1,145 @@
+# Copyright (C) 2015-2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the table of the members' effective preferences."""
+
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus, MemberRole
+from mailman.interfaces.preferences import IEffectivePreferencesManager
+from mailman.interfaces.usermanager import IUserManager
+from mailman.model.effectivepreferences import EffectivePreferences
+from mailman.testing.helpers import set_preferred
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import now
+from zope.component import getUtility
+
+
+class TestEffectivePreferences(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._manager = getUtility(IEffectivePreferencesManager)
+        self._mlist = create_list('ant@example.com')
+        user_manager = getUtility(IUserManager)
+        self._user = user_manager.create_user('anne@example.com')
+        self._address = set_preferred(self._user)
+        self._member = self._mlist.subscribe(self._user)
+
+    def _get(self, member=None):
+        # Flush the session, as a query would.
+        config.db.store.flush()
+        return self._manager.get(self._member if member is None else member)
+
+    def _check(self, member=None):
+        # The effective preferences are the member's attributes.
+        member = self._member if member is None else member
+        preferences = self._get(member)
+        for name in ('acknowledge_posts', 'delivery_mode', 'delivery_status',
+                     'receive_list_copy', 'receive_own_postings'):
+            self.assertEqual(getattr(preferences, name),
+                             getattr(member, name), name)
+        self.assertEqual(preferences.preferred_language,
+                         member.preferred_language.code)
+        self.assertEqual(preferences.email, member.address.email)
+
+    def test_subscribe(self):
+        preferences = self._get()
+        self.assertEqual(preferences.member_id, self._member.id)
+        self.assertEqual(preferences.list_id, 'ant.example.com')
+        self.assertEqual(preferences.role, MemberRole.member)
+        self.assertEqual(preferences.email, 'anne@example.com')
+        self.assertEqual(preferences.delivery_mode, DeliveryMode.regular)
+        self.assertEqual(preferences.delivery_status, DeliveryStatus.enabled)
+        self.assertEqual(preferences.preferred_language, 'en')
+        self._check()
+
+    def test_member_preferences(self):
+        self._member.preferences.delivery_mode = DeliveryMode.mime_digests
+        self._member.preferences.preferred_language = 'fr'
+        self.assertEqual(self._get().delivery_mode, DeliveryMode.mime_digests)
+        self._check()
+
+    def test_address_preferences(self):
+        self._address.preferences.receive_own_postings = False
+        self.assertFalse(self._get().receive_own_postings)
+        self._check()
+
+    def test_user_preferences(self):
+        self._user.preferences.delivery_status = DeliveryStatus.by_user
+        self._user.preferences.acknowledge_posts = True
+        self.assertEqual(self._get().delivery_status, DeliveryStatus.by_user)
+        self._check()
+        # The member's preferences come first.
+        self._member.preferences.delivery_status = DeliveryStatus.by_bounces
+        self.assertEqual(self._get().delivery_status,
+                         DeliveryStatus.by_bounces)
+        self._check()
+
+    def test_preferred_address(self):
+        # A member subscribed as a user follows its preferred address.
+        other = self._user.register('anne@example.org')
+        other.preferences.receive_list_copy = False
+        other.verified_on = now()
+        self._user.preferred_address = other
+        preferences = self._get()
+        self.assertEqual(preferences.email, 'anne@example.org')
+        self.assertFalse(preferences.receive_list_copy)
+        self._check()
+
+    def test_list_language(self):
+        self._mlist.preferred_language = 'fr'
+        self.assertEqual(self._get().preferred_language, 'fr')
+        self._check()
+
+    def test_unsubscribe(self):
+        self._member.unsubscribe()
+        self.assertIsNone(self._get())
+        self.assertEqual(
+            config.db.store.query(EffectivePreferences).count(), 0)
+
+    def test_get_many(self):
+        bart = self._mlist.subscribe(
+            getUtility(IUserManager).create_address('bart@example.com'))
+        config.db.store.flush()
+        found = self._manager.get_many([self._member, bart])
+        self.assertEqual(
+            {member_id: preferences.email
+             for member_id, preferences in found.items()},
+            {self._member.id: 'anne@example.com',
+             bart.id: 'bart@example.com'})
+        bart.unsubscribe()
+        config.db.store.flush()
+        self.assertEqual(list(self._manager.get_many([bart])), [])
+
+    def test_rebuild(self):
+        bee = create_list('bee@example.com')
+        bart = bee.subscribe(
+            getUtility(IUserManager).create_address('bart@example.com'))
+        config.db.store.flush()
+        config.db.store.query(EffectivePreferences).delete()
+        self.assertIsNone(self._get())
+        self.assertEqual(self._manager.rebuild(bee), 1)
+        self.assertIsNone(self._get())
+        self._check(bart)
+        self.assertEqual(self._manager.rebuild(), 2)
+        self._check()
+        self._check(bart)
+        self.assertEqual(
+            config.db.store.query(EffectivePreferences).count(), 2)
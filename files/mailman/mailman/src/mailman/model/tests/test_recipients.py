@@ -0,0 +1,111 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cache of the mailing lists' recipients."""
+
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.interfaces.cache import ICacheManager
+from mailman.interfaces.member import DeliveryMode
+from mailman.interfaces.preferences import IEffectivePreferencesManager
+from mailman.interfaces.recipients import IRecipientCache
+from mailman.interfaces.usermanager import IUserManager
+from mailman.testing.helpers import configuration
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+from zope.component import getUtility
+
+
+class TestRecipientCache(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._cache = getUtility(IRecipientCache)
+        self._manager = getUtility(IUserManager)
+        self._ant = create_list('ant@example.com')
+        self._bee = create_list('bee@example.com')
+        self._anne = self._ant.subscribe(
+            self._manager.create_address('anne@example.com'))
+
+    def test_generation(self):
+        # A mailing list's generation is bumped when its membership changes.
+        self.assertEqual(self._cache.generation(self._ant), 1)
+        self.assertEqual(self._cache.generation(self._bee), 0)
+        bart = self._ant.subscribe(
+            self._manager.create_address('bart@example.com'))
+        self.assertEqual(self._cache.generation(self._ant), 2)
+        bart.unsubscribe()
+        self.assertEqual(self._cache.generation(self._ant), 3)
+        self.assertEqual(self._cache.generation(self._bee), 0)
+
+    def test_preferences_bump_generation(self):
+        # The preferences of the address are used by every membership.
+        self._bee.subscribe(self._anne.address)
+        self.assertEqual(self._cache.generation(self._bee), 1)
+        self._anne.address.preferences.delivery_mode = (
+            DeliveryMode.mime_digests)
+        self.assertEqual(self._cache.generation(self._ant), 2)
+        self.assertEqual(self._cache.generation(self._bee), 2)
+
+    def test_rebuild_bumps_generation(self):
+        getUtility(IEffectivePreferencesManager).rebuild(self._ant)
+        self.assertEqual(self._cache.generation(self._ant), 2)
+
+    def test_recipients(self):
+        self.assertEqual(self._cache.get_recipients(self._ant),
+                         frozenset(['anne@example.com']))
+        self.assertEqual(self._cache.get_recipients(self._bee), frozenset())
+        self._anne.preferences.delivery_mode = DeliveryMode.plaintext_digests
+        self.assertEqual(self._cache.get_recipients(self._ant), frozenset())
+
+    def test_unchanged_list_skips_roster(self):
+        config.db.commit()
+        recipients = self._cache.get_recipients(self._ant)
+        with patch('mailman.model.roster.AbstractRoster.find_emails') as find:
+            self.assertIs(self._cache.get_recipients(self._ant), recipients)
+        self.assertFalse(find.called)
+
+    def test_changed_in_transaction(self):
+        # Nothing is cached for a list whose membership changed in the
+        # current transaction, since the change could be rolled back.
+        self._cache.get_recipients(self._ant)
+        with patch('mailman.model.roster.AbstractRoster.find_emails',
+                   return_value=iter(['anne@example.com'])) as find:
+            self._cache.get_recipients(self._ant)
+        self.assertTrue(find.called)
+        config.db.abort()
+        self.assertEqual(self._cache.generation(self._ant), 0)
+        self.assertEqual(self._cache.get_recipients(self._ant), frozenset())
+
+    def test_shared_recipients(self):
+        # The recipients can be shared with the other processes through the
+        # file cache.
+        config.db.commit()
+        with configuration('mailman', share_recipients='yes'):
+            self._cache.get_recipients(self._ant)
+            self.assertEqual(
+                getUtility(ICacheManager).get('recipients:ant.example.com:1'),
+                'anne@example.com')
+            # Another process finds them there.
+            self._cache.clear()
+            with patch('mailman.model.roster.AbstractRoster.find_emails') \
+                    as find:
+                self.assertEqual(self._cache.get_recipients(self._ant),
+                                 frozenset(['anne@example.com']))
+            self.assertFalse(find.called)
@@ -20,12 +20,18 @@
 import unittest
 
 from mailman.app.lifecycle import create_list
+from mailman.config import config
 from mailman.interfaces.address import IAddress
-from mailman.interfaces.member import DeliveryMode, MemberRole
+from mailman.interfaces.member import (
+    DeliveryMode, DeliveryStatus, MemberRole)
+from mailman.interfaces.roster import RosterEntry
 from mailman.interfaces.user import IUser
 from mailman.interfaces.usermanager import IUserManager
-from mailman.testing.helpers import set_preferred
+from mailman.model.roster import member_cache
+from mailman.testing.helpers import configuration, set_preferred
 from mailman.testing.layers import ConfigLayer
+from sqlalchemy import event
+from unittest.mock import patch
 from zope.component import getUtility
 
 
@@ -225,3 +231,321 @@ class TestUserRoster(unittest.TestCase):
         self._mlist.subscribe(self._dave)
         member = self._mlist.members.get_member('bart@example.com')
         self.assertEqual(member.user, self._bart)
+
+    def test_get_members(self):
+        # get_members() finds the same members as get_member().
+        self._mlist.subscribe(self._anne)
+        self._mlist.subscribe(self._bart.preferred_address)
+        # Cris is subscribed both ways, so the explicit address wins.
+        self._mlist.subscribe(self._cris)
+        self._mlist.subscribe(self._cris.preferred_address)
+        emails = ['anne@example.com', 'bart@example.com', 'cris@example.com',
+                  'dave@example.com', 'elle@example.com']
+        members = self._mlist.members.get_members(emails)
+        self.assertEqual(
+            members,
+            {email: self._mlist.members.get_member(email)
+             for email in emails[:3]})
+        self.assertEqual(members['anne@example.com'].subscriber, self._anne)
+        self.assertEqual(members['cris@example.com'].subscriber,
+                         self._cris.preferred_address)
+
+    def test_get_members_many(self):
+        # Many addresses are looked up in several queries.
+        self._mlist.subscribe(self._anne)
+        self._mlist.subscribe(self._dave.preferred_address)
+        emails = ['anne@example.com']
+        emails.extend('person{}@example.com'.format(i) for i in range(1000))
+        emails.append('dave@example.com')
+        members = self._mlist.members.get_members(emails)
+        self.assertEqual(sorted(members),
+                         ['anne@example.com', 'dave@example.com'])
+
+    def test_get_members_administrators(self):
+        self._mlist.subscribe(self._anne.preferred_address, MemberRole.owner)
+        self._mlist.subscribe(
+            self._bart.preferred_address, MemberRole.moderator)
+        members = self._mlist.administrators.get_members(
+            ['anne@example.com', 'bart@example.com', 'cris@example.com'])
+        self.assertEqual(sorted(members),
+                         ['anne@example.com', 'bart@example.com'])
+
+
+class TestFindMembers(unittest.TestCase):
+    """Test finding members by their effective preferences."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        user_manager = getUtility(IUserManager)
+        # Anne is subscribed with an address which has no user.
+        anne = user_manager.create_address('anne@example.com')
+        # Bart is subscribed with an address of his user.
+        bart = user_manager.create_user('bart@example.com')
+        # Cris is subscribed as a user, through his preferred address.
+        cris = user_manager.create_user('cris@example.com')
+        set_preferred(cris)
+        # Dave is subscribed as a user and sets nothing.
+        dave = user_manager.create_user('dave@example.com')
+        set_preferred(dave)
+        self._anne = self._mlist.subscribe(anne)
+        self._bart = self._mlist.subscribe(list(bart.addresses)[0])
+        self._cris = self._mlist.subscribe(cris)
+        self._dave = self._mlist.subscribe(dave)
+        # The preferences are set at every level.
+        self._anne.preferences.delivery_mode = DeliveryMode.mime_digests
+        anne.preferences.delivery_status = DeliveryStatus.by_user
+        anne.preferences.delivery_mode = DeliveryMode.regular
+        bart.preferences.delivery_status = DeliveryStatus.by_bounces
+        list(bart.addresses)[0].preferences.receive_own_postings = False
+        bart.preferences.receive_own_postings = True
+        cris.preferences.delivery_mode = DeliveryMode.plaintext_digests
+        cris.preferred_address.preferences.acknowledge_posts = True
+        # Someone else's memberships and other roles don't count.
+        other = create_list('bee@example.com')
+        other.subscribe(user_manager.create_address('elle@example.com'))
+        self._mlist.subscribe(
+            user_manager.create_address('fred@example.com'),
+            MemberRole.owner)
+
+    def _emails(self, members):
+        return sorted(member.address.email for member in members)
+
+    def test_same_as_the_members(self):
+        # The preferences are resolved like the members' attributes.
+        members = list(self._mlist.members.members)
+        for name, values in (
+                ('acknowledge_posts', (True, False)),
+                ('delivery_mode', tuple(DeliveryMode)),
+                ('delivery_status', tuple(DeliveryStatus)),
+                ('receive_list_copy', (True, False)),
+                ('receive_own_postings', (True, False)),
+                ):
+            for value in values:
+                expected = sorted(
+                    member.address.email for member in members
+                    if getattr(member, name) == value)
+                self.assertEqual(
+                    self._emails(self._mlist.members.find_members(
+                        **{name: value})),
+                    expected, (name, value))
+                self.assertEqual(
+                    sorted(self._mlist.members.find_emails(**{name: value})),
+                    expected, (name, value))
+
+    def test_several_values_and_preferences(self):
+        self.assertEqual(
+            self._emails(self._mlist.members.find_members(
+                delivery_mode=[DeliveryMode.regular,
+                               DeliveryMode.plaintext_digests],
+                delivery_status=DeliveryStatus.enabled)),
+            ['cris@example.com', 'dave@example.com'])
+
+    def test_no_preferences(self):
+        self.assertEqual(
+            self._emails(self._mlist.members.find_members()),
+            ['anne@example.com', 'bart@example.com', 'cris@example.com',
+             'dave@example.com'])
+
+    def test_delivery_rosters(self):
+        self.assertEqual(
+            self._emails(self._mlist.regular_members.members),
+            ['bart@example.com', 'dave@example.com'])
+        self.assertEqual(self._mlist.regular_members.member_count, 2)
+        self.assertEqual(
+            self._emails(self._mlist.digest_members.members),
+            ['anne@example.com', 'cris@example.com'])
+        self.assertEqual(self._mlist.digest_members.member_count, 2)
+        # Searching a delivery roster by delivery mode only finds the modes
+        # of the roster.
+        self.assertEqual(
+            list(self._mlist.regular_members.find_emails(
+                delivery_mode=DeliveryMode.mime_digests)),
+            [])
+        self.assertEqual(
+            list(self._mlist.digest_members.find_emails(
+                delivery_mode=[DeliveryMode.mime_digests,
+                               DeliveryMode.regular])),
+            ['anne@example.com'])
+
+    def test_administrators(self):
+        self.assertEqual(
+            list(self._mlist.administrators.find_emails(
+                delivery_status=DeliveryStatus.enabled)),
+            ['fred@example.com'])
+
+    def test_preferred_language(self):
+        # The preferred language defaults to the mailing list's.
+        self._bart.preferences.preferred_language = 'fr'
+        self.assertEqual(
+            sorted(self._mlist.members.find_emails(preferred_language='en')),
+            ['anne@example.com', 'cris@example.com', 'dave@example.com'])
+        self.assertEqual(
+            list(self._mlist.members.find_emails(preferred_language='fr')),
+            ['bart@example.com'])
+
+    def test_find_entries(self):
+        # The entries are sorted by email address, and carry the original
+        # email address and the display name.
+        self._cris.address.display_name = 'Cris Person'
+        self._cris.address._original = 'Cris@example.com'
+        self.assertEqual(list(self._mlist.members.find_entries()), [
+            ('anne@example.com', 'anne@example.com', '',
+             DeliveryMode.mime_digests, DeliveryStatus.by_user),
+            ('bart@example.com', 'bart@example.com', '',
+             DeliveryMode.regular, DeliveryStatus.by_bounces),
+            ('cris@example.com', 'Cris@example.com', 'Cris Person',
+             DeliveryMode.plaintext_digests, DeliveryStatus.enabled),
+            ('dave@example.com', 'dave@example.com', '',
+             DeliveryMode.regular, DeliveryStatus.enabled),
+            ])
+        entries = list(self._mlist.digest_members.find_entries(
+            delivery_status=DeliveryStatus.enabled))
+        self.assertEqual([entry.email for entry in entries],
+                         ['cris@example.com'])
+        self.assertIsInstance(entries[0], RosterEntry)
+
+    def test_find_entries_loads_no_members(self):
+        # Streaming the entries doesn't add anything to the session.
+        config.db.store.expunge_all()
+        entries = list(self._mlist.members.find_entries())
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(len(config.db.store.identity_map), 0)
+
+    def test_unqueryable_preference(self):
+        with self.assertRaises(ValueError):
+            list(self._mlist.members.find_members(hide_address=True))
+
+
+class TestMemberCache(unittest.TestCase):
+    """Test caching the members found by email address."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        self._manager = getUtility(IUserManager)
+        self._anne = self._mlist.subscribe(
+            self._manager.create_address('anne@example.com'))
+        config.db.commit()
+
+    def _union_count(self, email, roster=None):
+        # Count the number of times the memberships are looked up.
+        roster = self._mlist.members if roster is None else roster
+        with patch.object(roster, '_get_all_memberships',
+                          wraps=roster._get_all_memberships) as lookup:
+            member = roster.get_member(email)
+        return member, lookup.call_count
+
+    def test_repeated_lookups(self):
+        member, count = self._union_count('anne@example.com')
+        self.assertEqual(member, self._anne)
+        self.assertEqual(count, 1)
+        # The member is remembered for the rest of the transaction.
+        member, count = self._union_count('anne@example.com')
+        self.assertEqual(member, self._anne)
+        self.assertEqual(count, 0)
+        # And by the process.
+        config.db.commit()
+        member, count = self._union_count('anne@example.com')
+        self.assertEqual(member, self._anne)
+        self.assertEqual(count, 0)
+
+    def test_repeated_lookups_issue_no_sql(self):
+        self._mlist.members.get_member('anne@example.com')
+        statements = []
+
+        def before_cursor_execute(connection, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(config.db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        self.addCleanup(event.remove, config.db.engine,
+                        'before_cursor_execute', before_cursor_execute)
+        member = self._mlist.members.get_member('anne@example.com')
+        self.assertEqual(member, self._anne)
+        self.assertEqual(statements, [])
+
+    def test_generation_read_once(self):
+        # The membership generation is read once per transaction.
+        with patch('mailman.model.recipients._read_generation',
+                   return_value=0) as read_generation:
+            self._mlist.members.get_member('anne@example.com')
+            self._mlist.members.get_member('bart@example.com')
+            self._mlist.nonmembers.get_member('anne@example.com')
+            self.assertEqual(read_generation.call_count, 1)
+            config.db.commit()
+            self._mlist.members.get_member('anne@example.com')
+            self.assertEqual(read_generation.call_count, 2)
+
+    def test_missing_members(self):
+        member, count = self._union_count('bart@example.com')
+        self.assertIsNone(member)
+        self.assertEqual(count, 1)
+        member, count = self._union_count('bart@example.com')
+        self.assertIsNone(member)
+        self.assertEqual(count, 0)
+
+    def test_keyed_by_roster(self):
+        self._union_count('anne@example.com')
+        member, count = self._union_count(
+            'anne@example.com', self._mlist.nonmembers)
+        self.assertIsNone(member)
+        self.assertEqual(count, 1)
+
+    def test_subscription_invalidates(self):
+        self._union_count('bart@example.com')
+        bart = self._mlist.subscribe(
+            self._manager.create_address('bart@example.com'))
+        member, count = self._union_count('bart@example.com')
+        self.assertEqual(member, bart)
+        self.assertEqual(count, 1)
+        config.db.commit()
+        # After the subscription is committed, the member is cached again.
+        self._union_count('bart@example.com')
+        member, count = self._union_count('bart@example.com')
+        self.assertEqual(member, bart)
+        self.assertEqual(count, 0)
+
+    def test_unsubscription_invalidates(self):
+        self._union_count('anne@example.com')
+        self._anne.unsubscribe()
+        config.db.commit()
+        member, count = self._union_count('anne@example.com')
+        self.assertIsNone(member)
+        self.assertEqual(count, 1)
+
+    def test_rolled_back_subscription(self):
+        # A rolled back subscription isn't remembered.
+        self._mlist.subscribe(
+            self._manager.create_address('bart@example.com'))
+        self.assertIsNotNone(self._mlist.members.get_member(
+            'bart@example.com'))
+        config.db.abort()
+        member, count = self._union_count('bart@example.com')
+        self.assertIsNone(member)
+        self.assertEqual(count, 1)
+
+    def test_bounded(self):
+        with configuration('mailman', member_cache_size=2):
+            for email in ('bart@example.com', 'cris@example.com',
+                          'dave@example.com'):
+                self._mlist.members.get_member(email)
+            self.assertEqual(len(member_cache), 2)
+            # The least recently used entry was evicted.
+            config.db.commit()
+            member, count = self._union_count('bart@example.com')
+            self.assertEqual(count, 1)
+            member, count = self._union_count('dave@example.com')
+            self.assertEqual(count, 0)
+
+    def test_disabled(self):
+        with configuration('mailman', member_cache_size=0):
+            self._union_count('anne@example.com')
+            self.assertEqual(len(member_cache), 0)
+            # The member is still remembered for the transaction.
+            member, count = self._union_count('anne@example.com')
+            self.assertEqual(count, 0)
+            config.db.commit()
+            member, count = self._union_count('anne@example.com')
+            self.assertEqual(count, 1)
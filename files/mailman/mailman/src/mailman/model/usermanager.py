@@ -82,10 +82,9 @@ class UserManager:
     @dbconnection
     def get_user(self, store, email):
         """See `IUserManager`."""
-        addresses = store.query(Address).filter_by(email=email.lower())
-        if addresses.count() == 0:
-            return None
-        return addresses.one().user
+        address = store.query(Address).filter_by(
+            email=email.lower()).one_or_none()
+        return (None if address is None else address.user)
 
     @dbconnection
     def get_user_by_id(self, store, user_id):
@@ -0,0 +1,452 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Delivery with asyncio and ESMTP pipelining."""
+
+import re
+import hmac
+import socket
+import asyncio
+import logging
+import smtplib
+
+from base64 import b64decode, b64encode
+from collections import deque
+from functools import partial
+from lazr.config import as_boolean
+from mailman.config import config
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.deliver import (
+    Deliver, SplicingDeliver, deliver as deliver_blocking)
+from public import public
+
+
+CRLF = b'\r\n'
+NL = b'\n'
+# The supported AUTH mechanisms, in the order smtplib prefers them.
+AUTH_MECHANISMS = ('CRAM-MD5', 'PLAIN', 'LOGIN')
+# Queued messages are sent once there are this many for each connection.
+QUEUED_PER_CONNECTION = 10
+# The reply for non-ASCII addresses when the server doesn't support SMTPUTF8.
+NON_ASCII_REFUSAL = b'5.6.7 Non-ASCII address without SMTPUTF8 support'
+
+log = logging.getLogger('mailman.smtp')
+
+
+def _is_ascii(address):
+    try:
+        address.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _as_data(msgtext):
+    # Return the message text as the bytes of an SMTP DATA command, i.e. with
+    # CRLF line endings, leading periods doubled, and the final period.  Like
+    # smtplib, take bytes to already have CRLF line endings.
+    if isinstance(msgtext, str):
+        msgtext = re.sub(
+            r'(?:\r\n|\n|\r(?!\n))', '\r\n', msgtext).encode('ascii')
+    data = re.sub(br'(?m)^\.', b'..', msgtext)
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b'.' + CRLF
+
+
+@public
+class SMTPClient:
+    """A minimal asyncio SMTP client.
+
+    When the server supports ESMTP pipelining (RFC 2920), all the commands of
+    a mail transaction up to the message data are sent at once, so that all
+    the recipients are in flight together instead of each costing a round
+    trip.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        # The names of the ESMTP extensions supported by the server.
+        self.extensions = set()
+        # The AUTH mechanisms supported by the server.
+        self.auth_mechanisms = set()
+        # The number of mail transactions completed over this connection.
+        self.sessions = 0
+
+    @property
+    def pipelining(self):
+        """Whether the commands are pipelined."""
+        return 'pipelining' in self.extensions
+
+    @classmethod
+    @asyncio.coroutine
+    def connect(cls, host, port, smtp_user=None, smtp_pass=None, loop=None):
+        """Connect to an SMTP server, and log in if credentials are given.
+
+        :param host: The host name of the SMTP server to connect to.
+        :type host: string
+        :param port: The port number of the SMTP server to connect to.
+        :type port: integer
+        :param smtp_user: Optional SMTP authentication user name.
+        :type smtp_user: str
+        :param smtp_pass: Optional SMTP authentication password.
+        :type smtp_pass: str
+        :param loop: The event loop to use.
+        :return: The connected client.
+        :rtype: `SMTPClient`
+        """
+        log.debug('Connecting to %s:%s', host, port)
+        reader, writer = yield from asyncio.open_connection(
+            host, port, loop=loop)
+        client = cls(reader, writer)
+        try:
+            code, message = yield from client._reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+            yield from client._ehlo()
+            if smtp_user is not None and smtp_pass is not None:
+                yield from client._login(smtp_user, smtp_pass)
+        except BaseException:
+            client.close()
+            raise
+        return client
+
+    @asyncio.coroutine
+    def _reply(self):
+        # Read a possibly multi-line reply, returning the code and the text,
+        # like smtplib.SMTP.getreply().
+        lines = []
+        while True:
+            line = yield from self._reader.readline()
+            if not line:
+                raise smtplib.SMTPServerDisconnected(
+                    'Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            raise smtplib.SMTPException('Bad reply: {!r}'.format(line))
+        return code, NL.join(lines)
+
+    @asyncio.coroutine
+    def _command(self, command):
+        self._writer.write(command + CRLF)
+        yield from self._writer.drain()
+        reply = yield from self._reply()
+        return reply
+
+    @asyncio.coroutine
+    def _commands(self, commands):
+        # Send the commands and return their replies.  Without pipelining,
+        # the commands are sent one at a time, and the recipients are only
+        # sent if the sender is accepted.
+        replies = []
+        if self.pipelining:
+            self._writer.write(
+                b''.join(command + CRLF for command in commands))
+            yield from self._writer.drain()
+            for command in commands:
+                replies.append((yield from self._reply()))
+        else:
+            for command in commands:
+                replies.append((yield from self._command(command)))
+                if replies[0][0] != 250:
+                    break
+        return replies
+
+    @asyncio.coroutine
+    def _ehlo(self):
+        hostname = socket.getfqdn().encode('ascii')
+        code, message = yield from self._command(b'EHLO ' + hostname)
+        if code != 250:
+            code, message = yield from self._command(b'HELO ' + hostname)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            return
+        for line in message.split(NL)[1:]:
+            words = line.decode('ascii').split()
+            if len(words) > 0:
+                self.extensions.add(words[0].lower())
+                if words[0].lower() == 'auth':
+                    self.auth_mechanisms.update(
+                        word.upper() for word in words[1:])
+
+    @asyncio.coroutine
+    def _login(self, smtp_user, smtp_pass):
+        # Like smtplib.SMTP.login(), use the first mechanism supported by
+        # both sides.
+        if 'auth' not in self.extensions:
+            raise smtplib.SMTPNotSupportedError(
+                'SMTP AUTH extension not supported by server.')
+        for mechanism in AUTH_MECHANISMS:
+            if mechanism in self.auth_mechanisms:
+                break
+        else:
+            raise smtplib.SMTPException(
+                'No suitable authentication method found.')
+        log.debug('Logging in with %s', mechanism)
+        user = smtp_user.encode('utf-8')
+        password = smtp_pass.encode('utf-8')
+        if mechanism == 'PLAIN':
+            code, message = yield from self._command(
+                b'AUTH PLAIN ' + b64encode(b'\0' + user + b'\0' + password))
+        elif mechanism == 'LOGIN':
+            code, message = yield from self._command(b'AUTH LOGIN')
+            for response in (user, password):
+                if code != 334:
+                    break
+                code, message = yield from self._command(b64encode(response))
+        else:
+            code, message = yield from self._command(b'AUTH CRAM-MD5')
+            if code == 334:
+                digest = hmac.new(
+                    password, b64decode(message), 'md5').hexdigest()
+                code, message = yield from self._command(
+                    b64encode(user + b' ' + digest.encode('ascii')))
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    @asyncio.coroutine
+    def sendmail(self, envsender, recipients, msgtext):
+        """Mimic `mailman.mta.connection.Connection.sendmail`.
+
+        Failures are reported by raising the same exceptions as
+        `smtplib.SMTP.sendmail`.
+        """
+        if as_boolean(config.devmode.enabled):
+            # Force the recipients to the specified address, but still deliver
+            # to the same number of recipients.
+            recipients = [config.devmode.recipient] * len(recipients)
+        log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
+                  envsender, recipients, len(msgtext))
+        # Non-ASCII addresses can only be sent to servers which support
+        # SMTPUTF8 (RFC 6531).  Otherwise, they are refused here, like the
+        # server would.
+        smtputf8 = 'smtputf8' in self.extensions and not all(
+            _is_ascii(address) for address in [envsender, *recipients])
+        if not smtputf8 and not _is_ascii(envsender):
+            raise smtplib.SMTPSenderRefused(
+                553, NON_ASCII_REFUSAL, envsender)
+        refused = {
+            recipient: (553, NON_ASCII_REFUSAL)
+            for recipient in recipients
+            if not smtputf8 and not _is_ascii(recipient)
+            }
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        recipients = [recipient for recipient in recipients
+                      if recipient not in refused]
+        commands = [
+            'MAIL FROM:<{}>{}'.format(
+                envsender, ' SMTPUTF8' if smtputf8 else '').encode('utf-8')
+            ] + [
+            'RCPT TO:<{}>'.format(recipient).encode('utf-8')
+            for recipient in recipients
+            ]
+        # With pipelining, the DATA command is sent along with the others.
+        if self.pipelining:
+            commands.append(b'DATA')
+        replies = yield from self._commands(commands)
+        code, message = replies[0]
+        if code != 250:
+            yield from self._reset(replies)
+            raise smtplib.SMTPSenderRefused(code, message, envsender)
+        refused.update(
+            (recipient, reply)
+            for recipient, reply in zip(recipients, replies[1:])
+            if reply[0] not in (250, 251))
+        if all(recipient in refused for recipient in recipients):
+            yield from self._reset(replies)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if self.pipelining:
+            code, message = replies[-1]
+        else:
+            code, message = yield from self._command(b'DATA')
+        if code != 354:
+            yield from self._reset(replies)
+            raise smtplib.SMTPDataError(code, message)
+        self._writer.write(_as_data(msgtext))
+        yield from self._writer.drain()
+        code, message = yield from self._reply()
+        if code != 250:
+            yield from self._command(b'RSET')
+            raise smtplib.SMTPDataError(code, message)
+        self.sessions += 1
+        return refused
+
+    @asyncio.coroutine
+    def _reset(self, replies):
+        # If the server accepted the DATA command even though the transaction
+        # failed, send it an empty message before resetting the transaction.
+        if len(replies) > 0 and replies[-1][0] == 354:
+            self._writer.write(b'.' + CRLF)
+            yield from self._reply()
+        yield from self._command(b'RSET')
+
+    @asyncio.coroutine
+    def quit(self):
+        """End the session and close the connection."""
+        try:
+            yield from self._command(b'QUIT')
+        except (socket.error, smtplib.SMTPException):
+            pass
+        self.close()
+
+    def close(self):
+        """Close the connection."""
+        self._writer.close()
+
+
+@public
+class AsyncDeliveryMixin:
+    """Send the messages of a delivery over concurrent, pipelined connections.
+
+    This is a mixin for the `BaseDelivery` subclasses.  Rather than sending
+    each message as soon as it's ready, `_sendmail()` queues it.  Once enough
+    messages are queued, and when the delivery is done, they are sent over up
+    to `max_connections` connections at once.  The connections are kept open
+    for the whole delivery.
+    """
+
+    def __init__(self, *args, max_connections=None, **kws):
+        """See `BaseDelivery`.
+
+        :param max_connections: The maximum number of connections over which
+            messages are sent at the same time.  None, one or less means to
+            send the messages one after the other.
+        :type max_connections: integer
+        """
+        super().__init__(*args, **kws)
+        self._max_connections = (max_connections
+                                 if max_connections is not None and
+                                 max_connections > 0
+                                 else 1)
+
+    def deliver(self, mlist, msg, msgdata):
+        """See `IMailTransportAgentDelivery`."""
+        # Each delivery runs its own event loop, so that it can be called
+        # from any thread.
+        self._loop = asyncio.new_event_loop()
+        self._queue = deque()
+        self._clients = [None] * self._max_connections
+        self._refused = {}
+        try:
+            refused = super().deliver(mlist, msg, msgdata)
+            self._flush()
+            refused.update(self._refused)
+            return refused
+        finally:
+            self._loop.run_until_complete(asyncio.gather(*(
+                client.quit() for client in self._clients
+                if client is not None), loop=self._loop))
+            self._loop.close()
+
+    def _sendmail(self, sender, recipients, message_id, msgtext):
+        """See `BaseDelivery`.
+
+        The message is only queued, so its failures are returned by
+        `deliver()` instead.
+        """
+        self._queue.append((sender, recipients, message_id, msgtext))
+        if len(self._queue) >= QUEUED_PER_CONNECTION * self._max_connections:
+            self._flush()
+        return {}
+
+    def _flush(self):
+        # Send all the queued messages.
+        workers = [
+            self._send_queued(i)
+            for i in range(min(len(self._queue), self._max_connections))
+            ]
+        self._loop.run_until_complete(
+            asyncio.gather(*workers, loop=self._loop))
+
+    @asyncio.coroutine
+    def _send_queued(self, i):
+        # Send queued messages over the i'th connection until there are none
+        # left.
+        host, port, sessions_per_connection, username, password = (
+            self._connection_args)
+        while len(self._queue) > 0:
+            sender, recipients, message_id, msgtext = self._queue.popleft()
+            client = self._clients[i]
+            try:
+                if client is None:
+                    client = self._clients[i] = yield from SMTPClient.connect(
+                        host, port, username, password, loop=self._loop)
+                # Sort the recipients by email address for predictability and
+                # testability.
+                refused = yield from client.sendmail(
+                    sender, sorted(recipients), msgtext)
+            except (socket.error, IOError, smtplib.SMTPException) as error:
+                refused = self._failed(error, recipients, message_id)
+                # For safety, close this connection.  The next message will
+                # open a new one.
+                if client is not None:
+                    client.close()
+                    client = self._clients[i] = None
+            self._refused.update(refused)
+            if (client is not None and
+                    client.sessions == sessions_per_connection):
+                self._clients[i] = None
+                yield from client.quit()
+
+
+@public
+class AsyncBulkDelivery(AsyncDeliveryMixin, BulkDelivery):
+    """Deliver the recipient chunks over concurrent, pipelined connections."""
+
+    def __init__(self, max_recipients=None, max_connections=None):
+        """See `BulkDelivery` and `AsyncDeliveryMixin`."""
+        super().__init__(max_recipients, max_connections=max_connections)
+
+
+@public
+class AsyncDeliver(AsyncDeliveryMixin, Deliver):
+    """Deliver one message to each recipient, over concurrent connections."""
+
+
+@public
+class AsyncSplicingDeliver(AsyncDeliveryMixin, SplicingDeliver):
+    """Like `AsyncDeliver`, but flatten the message only once."""
+
+
+def _individual_agent():
+    # Return the agent to use for individual deliveries.
+    max_connections = int(config.mta.max_async_connections)
+    if as_boolean(config.mta.splice_individual_deliveries):
+        return AsyncSplicingDeliver(max_connections=max_connections)
+    return AsyncDeliver(max_connections=max_connections)
+
+
+@public
+def deliver(mlist, msg, msgdata):
+    """Deliver a message to the outgoing mail server.
+
+    This is like `mailman.mta.deliver.deliver()`, except that the messages
+    are sent by an `AsyncBulkDelivery`, `AsyncDeliver` or
+    `AsyncSplicingDeliver`.
+    """
+    deliver_blocking(
+        mlist, msg, msgdata,
+        bulk_agent=partial(
+            AsyncBulkDelivery, int(config.mta.max_recipients),
+            int(config.mta.max_async_connections)),
+        individual_agent=_individual_agent)
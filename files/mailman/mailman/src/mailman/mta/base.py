@@ -22,10 +22,13 @@ import socket
 import logging
 import smtplib
 
+from lazr.config import as_timedelta
 from mailman.config import config
 from mailman.interfaces.mta import IMailTransportAgentDelivery
-from mailman.mta.connection import Connection
+from mailman.interfaces.preferences import IEffectivePreferencesManager
+from mailman.mta.connection import ConnectionPool, connection_pool
 from public import public
+from zope.component import getUtility
 from zope.interface import implementer
 
 
@@ -41,10 +44,20 @@ class BaseDelivery:
         """Create a basic deliverer."""
         username = (config.mta.smtp_user if config.mta.smtp_user else None)
         password = (config.mta.smtp_pass if config.mta.smtp_pass else None)
-        self._connection = Connection(
+        self._connection_args = (
             config.mta.smtp_host, int(config.mta.smtp_port),
             int(config.mta.max_sessions_per_connection),
             username, password)
+        idle_timeout = as_timedelta(
+            config.mta.connection_idle_timeout).total_seconds()
+        # Without the shared pool, the connections are only reused within
+        # this delivery, and closed by _close_connections() when it's done.
+        if idle_timeout > 0:
+            self._pool = connection_pool
+            self._idle_timeout = idle_timeout
+        else:
+            self._pool = ConnectionPool()
+            self._idle_timeout = None
 
     def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
         """Low-level delivery to a set of recipients.
@@ -62,33 +75,78 @@ class BaseDelivery:
         """
         # Do the actual sending.
         sender = self._get_sender(mlist, msg, msgdata)
-        message_id = msg['message-id']
+        return self._sendmail(
+            sender, recipients, msg['message-id'], msg.as_wire_bytes())
+
+    def _sendmail(self, sender, recipients, message_id, msgtext):
+        """Send the message text to a set of recipients.
+
+        Unlike `_deliver_to_recipients()`, this doesn't need the database, so
+        it can be called from any thread.
+
+        :param sender: The envelope sender.
+        :type sender: string
+        :param recipients: The recipients of this message.
+        :type recipients: sequence
+        :param message_id: The Message-ID of the message, for logging.
+        :type message_id: string
+        :param msgtext: The message text, preferably as returned by
+            `Message.as_wire_bytes()`.
+        :type msgtext: bytes or string
+        :return: delivery failures as defined by `smtplib.SMTP.sendmail`
+        :rtype: dictionary
+        """
         # Since the recipients can be a set or a list, sort the recipients by
         # email address for predictability and testability.
         try:
-            refused = self._connection.sendmail(
-                sender, sorted(recipients), msg.as_string())
-        except smtplib.SMTPRecipientsRefused as error:
+            with self._pool.connection(
+                    *self._connection_args,
+                    idle_timeout=self._idle_timeout) as connection:
+                refused = connection.sendmail(
+                    sender, sorted(recipients), msgtext)
+        except (socket.error, IOError, smtplib.SMTPException) as error:
+            refused = self._failed(error, recipients, message_id)
+        return refused
+
+    def _close_connections(self):
+        """Close the connections opened by this delivery.
+
+        Connections in the shared pool are left open for other deliveries.
+        """
+        if self._pool is not connection_pool:
+            self._pool.close()
+
+    def _failed(self, error, recipients, message_id):
+        """Return the recipients refused because of a failed delivery.
+
+        :param error: The exception raised by the delivery.
+        :type error: `socket.error`, `IOError` or `smtplib.SMTPException`
+        :param recipients: The recipients of the failed delivery.
+        :type recipients: sequence
+        :param message_id: The Message-ID of the message, for logging.
+        :type message_id: string
+        :return: delivery failures as defined by `smtplib.SMTP.sendmail`
+        :rtype: dictionary
+        """
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
             log.error('%s recipients refused: %s', message_id, error)
-            refused = error.recipients
-        except smtplib.SMTPResponseException as error:
+            return error.recipients
+        if isinstance(error, smtplib.SMTPResponseException):
             log.error('%s response exception: %s', message_id, error)
-            refused = dict(
+            return dict(
                 # recipient -> (code, error)
                 (recipient, (error.smtp_code, error.smtp_error))
                 for recipient in recipients)
-        except (socket.error, IOError, smtplib.SMTPException) as error:
-            # MTA not responding, or other socket problems, or any other
-            # kind of SMTPException.  In that case, nothing got delivered,
-            # so treat this as a temporary failure.  We use error code 444
-            # for this (temporary, unspecified failure, cf RFC 5321).
-            log.error('%s low level smtp error: %s', message_id, error)
-            error = str(error)
-            refused = dict(
-                # recipient -> (code, error)
-                (recipient, (444, error))
-                for recipient in recipients)
-        return refused
+        # MTA not responding, or other socket problems, or any other kind of
+        # SMTPException.  In that case, nothing got delivered, so treat this
+        # as a temporary failure.  We use error code 444 for this (temporary,
+        # unspecified failure, cf RFC 5321).
+        log.error('%s low level smtp error: %s', message_id, error)
+        error = str(error)
+        return dict(
+            # recipient -> (code, error)
+            (recipient, (444, error))
+            for recipient in recipients)
 
     def _get_sender(self, mlist, msg, msgdata):
         """Return the envelope sender to use.
@@ -143,25 +201,37 @@ class IndividualDelivery(BaseDelivery):
         """
         refused = {}
         recipients = msgdata.get('recipients', set())
-        for recipient in recipients:
-            log.debug('IndividualDelivery to: %s', recipient)
-            # Make a copy of the original messages and operator on it, since
-            # we're going to munge it repeatedly for each recipient.
-            message_copy = copy.deepcopy(msg)
-            msgdata_copy = msgdata.copy()
-            # Squirrel the current recipient away in the message metadata.
-            # That way the subclass's _get_sender() override can encode the
-            # recipient address in the sender, e.g. for VERP.
-            msgdata_copy['recipient'] = recipient
-            # See if the recipient is a member of the mailing list, and if so,
-            # squirrel this information away for use by other modules, such as
-            # the header/footer decorator.  XXX 2012-03-05 this is probably
-            # highly inefficient on the database.
-            member = mlist.members.get_member(recipient)
-            msgdata_copy['member'] = member
-            for callback in self.callbacks:
-                callback(mlist, message_copy, msgdata_copy)
-            status = self._deliver_to_recipients(
-                mlist, message_copy, msgdata_copy, [recipient])
-            refused.update(status)
+        # Look up all the recipients' memberships at once, along with their
+        # addresses, users and preferences, and their effective preferences.
+        # These are needed by the other modules, such as the header/footer
+        # decorator, and holding on to them here keeps them in the database
+        # session for the whole loop.
+        members = mlist.members.get_members(recipients)
+        preferences = getUtility(IEffectivePreferencesManager).get_many(
+            members.values())
+        try:
+            for recipient in recipients:
+                log.debug('IndividualDelivery to: %s', recipient)
+                # Make a copy of the original messages and operator on it,
+                # since we're going to munge it repeatedly for each recipient.
+                message_copy = copy.deepcopy(msg)
+                msgdata_copy = msgdata.copy()
+                # Squirrel the current recipient away in the message
+                # metadata.  That way the subclass's _get_sender() override
+                # can encode the recipient address in the sender, e.g. for
+                # VERP.
+                msgdata_copy['recipient'] = recipient
+                # If the recipient is a member of the mailing list, squirrel
+                # this information away for use by other modules.
+                member = members.get(recipient)
+                msgdata_copy['member'] = member
+                if member is not None:
+                    msgdata_copy['preferences'] = preferences.get(member.id)
+                for callback in self.callbacks:
+                    callback(mlist, message_copy, msgdata_copy)
+                status = self._deliver_to_recipients(
+                    mlist, message_copy, msgdata_copy, [recipient])
+                refused.update(status)
+        finally:
+            self._close_connections()
         return refused
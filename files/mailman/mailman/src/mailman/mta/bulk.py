@@ -17,7 +17,17 @@
 
 """Bulk message delivery."""
 
+import time
+import logging
+import threading
+import dns.resolver
+
+from concurrent.futures import ThreadPoolExecutor
+from dns.exception import DNSException
+from functools import partial
+from mailman.config import config
 from mailman.mta.base import BaseDelivery
+from mailman.utilities.modules import find_name
 from public import public
 
 
@@ -33,23 +43,127 @@ CHUNKMAP = dict(
     ca=3,
     )
 
+log = logging.getLogger('mailman.smtp')
+
+
+@public
+def group_by_domain(domain):
+    """Group recipients by their domain.
+
+    :param domain: The domain of a recipient's email address.
+    :type domain: str
+    :return: The destination group of the domain.
+    """
+    return domain.lower()
+
+
+@public
+class MXGrouping:
+    """Group recipients by the mail exchangers of their domain.
+
+    Domains which are served by the same mail exchangers, such as those of a
+    hosting provider, end up in the same group.  The mail exchangers of every
+    domain are cached for as long as their DNS records may be.
+    """
+
+    def __init__(self, timeout=2, retry=300):
+        """Create a grouping with an empty cache.
+
+        :param timeout: How long to wait, in seconds, for the DNS answer.
+        :type timeout: float
+        :param retry: How long to wait, in seconds, before looking up a
+            domain again after a failed lookup.  Meanwhile, the domain is in
+            a group of its own.
+        :type retry: float
+        """
+        self._timeout = timeout
+        self._retry = retry
+        self._lock = threading.Lock()
+        # Map domains to their expiration time and group.
+        self._cache = {}
+
+    def __call__(self, domain):
+        """Return the destination group of a domain.
+
+        :param domain: The domain of a recipient's email address.
+        :type domain: str
+        :return: The sorted names of the domain's most preferred mail
+            exchangers.
+        :rtype: tuple of str
+        """
+        domain = domain.lower()
+        with self._lock:
+            expiration, group = self._cache.get(domain, (0, None))
+        if expiration > time.time():
+            return group
+        expiration, group = self._lookup(domain)
+        with self._lock:
+            self._cache[domain] = (expiration, group)
+        return group
+
+    def _lookup(self, domain):
+        # Return the expiration time and the group of the domain.
+        resolver = dns.resolver.Resolver()
+        resolver.timeout = resolver.lifetime = self._timeout
+        try:
+            answer = resolver.query(domain, dns.rdatatype.MX)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            # Without MX records, the domain is its own mail exchanger.
+            return time.time() + self._retry, (domain,)
+        except DNSException as error:
+            log.error('Unable to look up the MX records of %s: %s',
+                      domain, error)
+            return time.time() + self._retry, (domain,)
+        preference = min(record.preference for record in answer)
+        group = tuple(sorted(
+            record.exchange.to_text(omit_final_dot=True).lower()
+            for record in answer
+            if record.preference == preference))
+        return answer.expiration, group
+
+    def clear(self):
+        """Forget all the cached groups."""
+        with self._lock:
+            self._cache.clear()
+
+
+# The grouping shared by all deliveries, so that they share its cache.
+public(group_by_mx=MXGrouping())
+
 
 @public
 class BulkDelivery(BaseDelivery):
     """Deliver messages to the MSA in as few sessions as possible."""
 
-    def __init__(self, max_recipients=None):
+    def __init__(self, max_recipients=None, max_threads=None,
+                 grouping=None):
         """See `BaseDelivery`.
 
         :param max_recipients: The maximum number of recipients per delivery
             chunk.  None, zero or less means to group all recipients into one
             big chunk.
         :type max_recipients: integer
+        :param max_threads: The maximum number of chunks to deliver at the
+            same time, each over its own connection.  None, one or less means
+            to deliver the chunks one after the other.
+        :type max_threads: integer
+        :param grouping: A callable returning the destination group of a
+            recipient domain.  Recipients in the same group are delivered in
+            as few chunks as possible.  When None, the callable named by
+            `[mta]recipient_grouping` is used, and if that isn't set either,
+            the recipients are grouped by top-level domain instead.
+        :type grouping: callable
         """
         super().__init__()
+        if grouping is None and config.mta.recipient_grouping:
+            grouping = find_name(config.mta.recipient_grouping)
+        self._grouping = grouping
         self._max_recipients = (max_recipients
                                 if max_recipients is not None
                                 else 0)
+        self._max_threads = (max_threads
+                             if max_threads is not None
+                             else 0)
 
     def chunkify(self, recipients):
         """Split a set of recipients into chunks.
@@ -67,6 +181,9 @@ class BulkDelivery(BaseDelivery):
         if self._max_recipients <= 0:
             yield set(recipients)
             return
+        if self._grouping is not None:
+            yield from self._chunkify_by_group(recipients)
+            return
         # This algorithm was originally suggested by Chuq Von Rospach.  Start
         # by splitting the recipient addresses into top-level domain buckets,
         # using the "most common" domains.  Everything else ends up in the
@@ -93,11 +210,57 @@ class BulkDelivery(BaseDelivery):
         if len(chunk) > 0:
             yield chunk
 
+    def _chunkify_by_group(self, recipients):
+        # Split the recipients into destination groups.
+        by_group = {}
+        for address in recipients:
+            localpart, at, domain = address.rpartition('@')
+            by_group.setdefault(self._grouping(domain), []).append(address)
+        # Each group gets as few chunks as possible.  The chunks of a large
+        # group are all full, except maybe for the last one.  Pack these
+        # leftovers into the fullest chunk they fit in, biggest first.
+        leftovers = []
+        for group in by_group.values():
+            group.sort()
+            full = len(group) - len(group) % self._max_recipients
+            for i in range(0, full, self._max_recipients):
+                yield set(group[i:i + self._max_recipients])
+            if full < len(group):
+                leftovers.append(group[full:])
+        chunks = []
+        for leftover in sorted(
+                leftovers, key=lambda leftover: (-len(leftover), leftover)):
+            fitting = [chunk for chunk in chunks
+                       if len(chunk) + len(leftover) <= self._max_recipients]
+            if len(fitting) == 0:
+                chunks.append(set(leftover))
+            else:
+                max(fitting, key=len).update(leftover)
+        yield from chunks
+
     def deliver(self, mlist, msg, msgdata):
         """See `IMailTransportAgentDelivery`."""
+        chunks = list(self.chunkify(msgdata.get('recipients', set())))
+        try:
+            return self._send_chunks(mlist, msg, msgdata, chunks)
+        finally:
+            self._close_connections()
+
+    def _send_chunks(self, mlist, msg, msgdata, chunks):
+        # Deliver the chunks and return the refused recipients.
         refused = {}
-        for recipients in self.chunkify(msgdata.get('recipients', set())):
-            chunk_refused = self._deliver_to_recipients(
-                mlist, msg, msgdata, recipients)
-            refused.update(chunk_refused)
+        if self._max_threads <= 1 or len(chunks) <= 1:
+            for recipients in chunks:
+                chunk_refused = self._deliver_to_recipients(
+                    mlist, msg, msgdata, recipients)
+                refused.update(chunk_refused)
+            return refused
+        # The threads must not touch the database, so work out the sender
+        # here, and render the message only once for all of them.
+        send = partial(
+            self._sendmail, self._get_sender(mlist, msg, msgdata),
+            message_id=msg['message-id'], msgtext=msg.as_wire_bytes())
+        with ThreadPoolExecutor(min(self._max_threads, len(chunks))) as pool:
+            for chunk_refused in pool.map(send, chunks):
+                refused.update(chunk_refused)
         return refused
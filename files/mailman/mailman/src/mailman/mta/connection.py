@@ -17,10 +17,13 @@
 
 """MTA connections."""
 
+import time
+import socket
 import logging
 import smtplib
+import threading
 
-from contextlib import suppress
+from contextlib import contextmanager, suppress
 from lazr.config import as_boolean
 from mailman.config import config
 from public import public
@@ -32,6 +35,11 @@ log = logging.getLogger('mailman.smtp')
 @public
 class Connection:
     """Manage a connection to the SMTP server."""
+
+    # Before an open connection is used again after being idle for at least
+    # this many seconds, check that the server is still there.
+    check_interval = 1
+
     def __init__(self, host, port, sessions_per_connection,
                  smtp_user=None, smtp_pass=None):
         """Create a connection manager.
@@ -59,6 +67,14 @@ class Connection:
         self._password = smtp_pass
         self._session_count = None
         self._connection = None
+        self._last_used = None
+
+    @property
+    def idle_time(self):
+        """The number of seconds since the connection was last used."""
+        if self._last_used is None:
+            return 0
+        return time.monotonic() - self._last_used
 
     def _connect(self):
         """Open a new connection."""
@@ -76,17 +92,22 @@ class Connection:
             # Force the recipients to the specified address, but still deliver
             # to the same number of recipients.
             recipients = [config.devmode.recipient] * len(recipients)
-        if self._connection is None:
+        if self._connection is not None and not self._check():
+            self.quit()
+        fresh = self._connection is None
+        if fresh:
             self._connect()
         try:
-            log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
-                      envsender, recipients, len(msgtext))
-            results = self._connection.sendmail(envsender, recipients, msgtext)
-        except smtplib.SMTPException:
-            # For safety, close this connection.  The next send attempt will
-            # automatically re-open it.  Pass the exception on up.
-            self.quit()
-            raise
+            results = self._send(envsender, recipients, msgtext)
+        except smtplib.SMTPServerDisconnected:
+            if fresh:
+                raise
+            # The server may close a connection that we've kept open at any
+            # time.  Try once more over a new one.
+            log.debug('Reconnecting to %s:%s', self._host, self._port)
+            self._connect()
+            results = self._send(envsender, recipients, msgtext)
+        self._last_used = time.monotonic()
         # This session has been successfully completed.
         self._session_count -= 1
         # By testing exactly for equality to 0, we automatically handle the
@@ -96,6 +117,27 @@ class Connection:
             self.quit()
         return results
 
+    def _send(self, envsender, recipients, msgtext):
+        try:
+            log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
+                      envsender, recipients, len(msgtext))
+            return self._connection.sendmail(envsender, recipients, msgtext)
+        except smtplib.SMTPException:
+            # For safety, close this connection.  The next send attempt will
+            # automatically re-open it.  Pass the exception on up.
+            self.quit()
+            raise
+
+    def _check(self):
+        # Return whether the open connection still works.
+        if self.idle_time < self.check_interval:
+            return True
+        try:
+            code, message = self._connection.noop()
+        except (socket.error, smtplib.SMTPException):
+            return False
+        return code == 250
+
     def quit(self):
         """Mimic `smtplib.SMTP.quit`."""
         if self._connection is None:
@@ -103,3 +145,69 @@ class Connection:
         with suppress(smtplib.SMTPException):
             self._connection.quit()
         self._connection = None
+
+
+@public
+class ConnectionPool:
+    """A pool of connections to SMTP servers, shared by all deliveries.
+
+    Connections are kept open between deliveries, so that the cost of
+    connecting and logging in is paid once per connection rather than once per
+    message.  Each connection still honors its maximum number of sessions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Maps the connection arguments to the idle connections.
+        self._idle = {}
+
+    @contextmanager
+    def connection(self, host, port, sessions_per_connection,
+                   smtp_user=None, smtp_pass=None, idle_timeout=0):
+        """Borrow a connection from the pool.
+
+        The arguments are the same as for `Connection`.  The connection is
+        returned to the pool at the end of the `with` statement.  While it is
+        borrowed, no other thread will use it.
+
+        :param idle_timeout: Connections which have been idle in the pool for
+            longer than this many seconds are closed instead of being reused.
+            Zero means connections are never reused, and None means they are
+            kept until the pool is closed.
+        :type idle_timeout: float
+        """
+        key = (host, port, sessions_per_connection, smtp_user, smtp_pass)
+        with self._lock:
+            self._expire(idle_timeout)
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else Connection(*key)
+        try:
+            yield connection
+        finally:
+            if idle_timeout is None or idle_timeout > 0:
+                with self._lock:
+                    self._idle.setdefault(key, []).append(connection)
+            else:
+                connection.quit()
+
+    def _expire(self, idle_timeout):
+        if idle_timeout is None:
+            return
+        for key, idle in list(self._idle.items()):
+            for connection in idle[:]:
+                if connection.idle_time > idle_timeout:
+                    connection.quit()
+                    idle.remove(connection)
+            if len(idle) == 0:
+                del self._idle[key]
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.quit()
+            self._idle.clear()
+
+
+public(connection_pool=ConnectionPool())
@@ -20,6 +20,7 @@
 import time
 import logging
 
+from lazr.config import as_boolean
 from mailman.config import config
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.mta import SomeRecipientsFailed
@@ -27,6 +28,8 @@ from mailman.mta.base import IndividualDelivery
 from mailman.mta.bulk import BulkDelivery
 from mailman.mta.decorating import DecoratingMixin
 from mailman.mta.personalized import PersonalizedMixin
+from mailman.mta.splicing import SplicingMixin
+from mailman.mta.throttle import domain_throttle
 from mailman.mta.verp import VERPMixin
 from mailman.utilities.string import expand
 from public import public
@@ -59,8 +62,30 @@ class Deliver(VERPMixin, DecoratingMixin, PersonalizedMixin,
 
 
 @public
-def deliver(mlist, msg, msgdata):
-    """Deliver a message to the outgoing mail server."""
+class SplicingDeliver(SplicingMixin, Deliver):
+    """Deliver one message to one recipient, flattening it only once.
+
+    The recipients get the same messages as with `Deliver`.
+    """
+
+
+def _individual_agent():
+    # Return the agent to use for individual deliveries.
+    if as_boolean(config.mta.splice_individual_deliveries):
+        return SplicingDeliver()
+    return Deliver()
+
+
+@public
+def deliver(mlist, msg, msgdata, bulk_agent=None, individual_agent=None):
+    """Deliver a message to the outgoing mail server.
+
+    :param bulk_agent: Optional callable returning the delivery agent to use
+        for bulk deliveries, instead of a `BulkDelivery`.
+    :param individual_agent: Optional callable returning the delivery agent
+        to use for individual deliveries, instead of a `Deliver` or
+        `SplicingDeliver`.
+    """
     # If there are no recipients, there's nothing to do.
     recipients = msgdata.get('recipients')
     if not recipients:
@@ -69,26 +94,45 @@ def deliver(mlist, msg, msgdata):
     # Which delivery agent should we use?  Several situations can cause us to
     # use individual delivery.  If not specified, use bulk delivery.  See the
     # to-outgoing handler for when the 'verp' key is set in the metadata.
+    if individual_agent is None:
+        individual_agent = _individual_agent
     if msgdata.get('verp', False):
-        agent = Deliver()
+        agent = individual_agent()
     elif mlist.personalize != Personalization.none:
-        agent = Deliver()
+        agent = individual_agent()
+    elif bulk_agent is not None:
+        agent = bulk_agent()
     else:
-        agent = BulkDelivery(int(config.mta.max_recipients))
+        agent = BulkDelivery(int(config.mta.max_recipients),
+                             int(config.mta.max_delivery_threads))
     log.debug('Using agent: %s', agent)
     # Keep track of the original recipients and the original sender for
     # logging purposes.
     original_recipients = msgdata['recipients']
     original_sender = msgdata.get('original-sender', msg.sender)
+    # Hold back the recipients at domains which are over their rate limit or
+    # which told us to slow down.  They are retried on their own schedule.
+    deferred = domain_throttle.defer(recipients)
+    if len(deferred) > 0:
+        log.info('%s deferring %s recipients at throttled domains',
+                 msg.get('message-id', 'n/a'), len(deferred))
+        msgdata = msgdata.copy()
+        msgdata['recipients'] = [
+            recipient for recipient in recipients
+            if recipient not in deferred]
+        if len(msgdata['recipients']) == 0:
+            # Nothing was delivered, so there is nothing else to log.
+            raise SomeRecipientsFailed(list(deferred), [], dict(deferred))
     # Let the agent attempt to deliver to the recipients.  Record all failures
     # for re-delivery later.
     t0 = time.time()
     refused = agent.deliver(mlist, msg, msgdata)
     t1 = time.time()
+    retry_after = domain_throttle.record(msgdata['recipients'], refused)
     # Log this posting.
     size = getattr(msg, 'original_size', msgdata.get('original_size'))
     if size is None:
-        size = len(msg.as_string())
+        size = len(msg.as_wire_bytes())
     substitutions = dict(
         msgid       = msg.get('message-id', 'n/a'),   # noqa: E221, E251
         listname    = mlist.fqdn_listname,            # noqa: E221, E251
@@ -146,6 +190,9 @@ def deliver(mlist, msg, msgdata):
                 smtpmsg     = smtp_message,         # noqa: E221, E251
                 )
             log.info('%s', expand(template, mlist, substitutions))
+    temporary_failures.extend(deferred)
+    retry_after.update(deferred)
     # Return the results
     if temporary_failures or permanent_failures:
-        raise SomeRecipientsFailed(temporary_failures, permanent_failures)
+        raise SomeRecipientsFailed(
+            temporary_failures, permanent_failures, retry_after)
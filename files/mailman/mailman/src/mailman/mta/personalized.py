@@ -42,20 +42,35 @@ class PersonalizedMixin:
         if the recipient is a user registered with Mailman, the recipient's
         real name too.
         """
+        to = self.personalized_to(mlist, msgdata)
+        if to is not None:
+            msg.replace_header('To', to)
+
+    def personalized_to(self, mlist, msgdata):
+        """Return the personalized contents of the To header.
+
+        :return: The recipient's address, with the recipient's real name if
+            the recipient is a user registered with Mailman, or None if the
+            list doesn't personalize the To header.
+        :rtype: str
+        """
         # Personalize the To header if the list requests it.
         if mlist.personalize != Personalization.full:
-            return
+            return None
         recipient = msgdata['recipient']
-        user_manager = getUtility(IUserManager)
-        user = user_manager.get_user(recipient)
-        if user is None:
-            msg.replace_header('To', recipient)
+        member = msgdata.get('member')
+        if member is not None and member.address.email == recipient.lower():
+            # The member's address is already loaded.
+            user = member.address.user
         else:
-            # Convert the unicode name to an email-safe representation.
-            # Create a Header instance for the name so that it's properly
-            # encoded for email transport.
-            name = Header(user.display_name).encode()
-            msg.replace_header('To', formataddr((name, recipient)))
+            user = getUtility(IUserManager).get_user(recipient)
+        if user is None:
+            return recipient
+        # Convert the unicode name to an email-safe representation.  Create a
+        # Header instance for the name so that it's properly encoded for email
+        # transport.
+        name = Header(user.display_name).encode()
+        return formataddr((name, recipient))
 
 
 @public
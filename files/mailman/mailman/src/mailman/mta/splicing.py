@@ -0,0 +1,238 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Individualized delivery which flattens the message only once."""
+
+import re
+import copy
+import logging
+
+from mailman.handlers.decorate import add_decorations, get_decorations
+from mailman.interfaces.preferences import IEffectivePreferencesManager
+from public import public
+from zope.component import getUtility
+
+
+EMPTYSTRING = ''
+NL = '\n'
+log = logging.getLogger('mailman.smtp')
+
+
+def _wire(text):
+    # Convert text like Message.as_wire_bytes() does.
+    return re.sub(r'(?:\r\n|\n|\r(?!\n))', '\r\n', text).encode('ascii')
+
+
+@public
+class MessageTemplate:
+    """A flattened message, with a slot for its To header.
+
+    The message is kept as it is sent over SMTP, like
+    `Message.as_wire_bytes()` returns it.
+    """
+
+    def __init__(self, msg):
+        """Flatten the message.
+
+        :param msg: The message.
+        :type msg: `Message`
+        :raises ValueError: if the headers of the flattened message can't be
+            located.
+        """
+        text = msg.as_string()
+        # This is how the generator flattens the headers for as_string().
+        self._fold = msg.policy.clone(max_line_length=0).fold
+        lines = []
+        slot = None
+        for name, value in msg.raw_items():
+            if slot is None and name.lower() == 'to':
+                slot = len(lines)
+                self._to_name = name
+            lines.append(self._fold(name, value))
+        block = EMPTYSTRING.join(lines)
+        if not text.startswith(block):
+            raise ValueError('Cannot locate the headers of {}'.format(
+                msg.get('message-id', 'n/a')))
+        if slot is None:
+            self._before, self._to, self._after = _wire(block), None, b''
+        else:
+            self._before = _wire(EMPTYSTRING.join(lines[:slot]))
+            self._to = _wire(lines[slot])
+            self._after = _wire(EMPTYSTRING.join(lines[slot + 1:]))
+        # The body, starting with the empty line after the headers.
+        self.body = text[len(block):]
+        self._wire_body = _wire(self.body)
+
+    def render(self, to=None, body=None):
+        """Return the flattened message.
+
+        :param to: If given, the contents of the To header replace the
+            original contents, like `Message.replace_header()` does.
+        :type to: str
+        :param body: If given, the flattened body to use instead of the
+            original one, starting with the empty line after the headers,
+            with CRLF line endings.
+        :type body: bytes
+        :return: The flattened message, with CRLF line endings.
+        :rtype: bytes
+        :raises KeyError: if `to` is given but the message has no To header.
+        """
+        if to is None:
+            to_line = (b'' if self._to is None else self._to)
+        elif self._to is None:
+            raise KeyError('To')
+        else:
+            to_line = _wire(self._fold(self._to_name, to))
+        return b''.join((
+            self._before, to_line, self._after,
+            self._wire_body if body is None else body))
+
+
+def _shape(header, footer):
+    # Decorations with the same shape are separated from the original body
+    # in the same way; see mailman.handlers.decorate.add_decorations().
+    return (len(header) > 0, header.endswith(NL), len(footer) > 0)
+
+
+def _splices(header, footer):
+    # Can these decorations be spliced into a plain text body in place of
+    # other ones?  They must not change the body's character set, and must
+    # not contain line endings which the generator would normalize.
+    text = header + footer
+    try:
+        text.encode('us-ascii')
+    except UnicodeError:
+        return False
+    return '\r' not in text
+
+
+@public
+class SplicingMixin:
+    """Flatten a message once, rather than once for every recipient.
+
+    This is a mixin class for `IndividualDelivery`, which replaces its
+    callbacks with the equivalent of those of `Deliver`, i.e. duplicate
+    avoidance, header and footer decoration, and To header personalization.
+    The message is copied, decorated and flattened once for every distinct
+    set of decorations, and the recipient's To header is spliced into that
+    for each recipient.  Plain text messages in us-ascii, which are
+    decorated by adding text before and after their body, are flattened only
+    once even if every recipient gets different decorations.
+
+    The mixed in class must also provide a `personalized_to()` method, as in
+    `PersonalizedMixin`.
+    """
+
+    def deliver(self, mlist, msg, msgdata):
+        """See `IMailTransportAgentDelivery`."""
+        refused = {}
+        # Flattened variants of the message, by their duplicate header flag.
+        variants = {}
+        recipients = msgdata.get('recipients', set())
+        members = mlist.members.get_members(recipients)
+        preferences = getUtility(IEffectivePreferencesManager).get_many(
+            members.values())
+        try:
+            for recipient in recipients:
+                log.debug('SplicingDelivery to: %s', recipient)
+                msgdata_copy = msgdata.copy()
+                msgdata_copy['recipient'] = recipient
+                member = members.get(recipient)
+                msgdata_copy['member'] = member
+                if member is not None:
+                    msgdata_copy['preferences'] = preferences.get(member.id)
+                msgtext = self._render(mlist, msg, msgdata_copy, variants)
+                sender = self._get_sender(mlist, msg, msgdata_copy)
+                status = self._sendmail(
+                    sender, [recipient], msg['message-id'], msgtext)
+                refused.update(status)
+        finally:
+            self._close_connections()
+        return refused
+
+    def _render(self, mlist, msg, msgdata, variants):
+        # Return the message flattened for msgdata['recipient'].
+        duplicate = msgdata['recipient'] in msgdata.get('add-dup-header', {})
+        decorations = get_decorations(mlist, msg, msgdata)
+        to = self.personalized_to(mlist, msgdata)
+        variant = variants.get(duplicate)
+        if variant is not None:
+            template, old_decorations, middle = variant
+            if decorations == old_decorations:
+                return template.render(to)
+            if (middle is not None and decorations is not None and
+                    _shape(*decorations) == _shape(*old_decorations) and
+                    _splices(*decorations)):
+                header, footer = decorations
+                return template.render(to, b''.join((
+                    _wire(EMPTYSTRING.join((
+                        NL, header,
+                        NL if header and not header.endswith(NL) else ''))),
+                    middle, _wire(footer))))
+        message = self._decorate(mlist, msg, decorations, duplicate)
+        try:
+            template = MessageTemplate(message)
+        except ValueError as error:
+            # Fall back to doing what Deliver does.
+            log.error('%s', error)
+            if to is not None:
+                message.replace_header('To', to)
+            return message.as_wire_bytes()
+        variants[duplicate] = (
+            template, decorations,
+            self._middle(mlist, message, template, decorations))
+        return template.render(to)
+
+    def _decorate(self, mlist, msg, decorations, duplicate):
+        # Return the message with the duplicate header and the decorations.
+        if (decorations is None and not duplicate and
+                'x-mailman-copy' not in msg):
+            return msg
+        message = copy.deepcopy(msg)
+        del message['x-mailman-copy']
+        if duplicate:
+            message['X-Mailman-Copy'] = 'yes'
+        if decorations is not None:
+            header, footer = decorations
+            add_decorations(mlist, message, header, footer)
+        return message
+
+    def _middle(self, mlist, message, template, decorations):
+        # If the decorations were added around a plain text body without
+        # changing its encoding, return the flattened body between them, with
+        # CRLF line endings.
+        if (decorations is None or not _splices(*decorations) or
+                mlist.preferred_language.charset != 'us-ascii' or
+                message.is_multipart() or
+                message.get_content_type() != 'text/plain' or
+                message.get_content_charset() != 'us-ascii' or
+                message.get('content-transfer-encoding', '').lower()
+                != '7bit'):
+            return None
+        header, footer = decorations
+        prefix = EMPTYSTRING.join((
+            NL, header, NL if header and not header.endswith(NL) else ''))
+        body = template.body
+        if (not body.startswith(prefix) or not body.endswith(footer) or
+                len(body) < len(prefix) + len(footer)):
+            return None
+        middle = body[len(prefix):len(body) - len(footer)]
+        # A carriage return at the end would be converted differently when
+        # followed by a newline.
+        if middle.endswith('\r'):
+            return None
+        return _wire(middle)
@@ -0,0 +1,370 @@
+# Copyright (C) 2012-2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test asynchronous delivery."""
+
+import asyncio
+import smtplib
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.interfaces.mailinglist import Personalization
+from mailman.interfaces.mta import SomeRecipientsFailed
+from mailman.mta.asynchronous import (
+    AsyncBulkDelivery, AsyncDeliver, NON_ASCII_REFUSAL, SMTPClient,
+    deliver)
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as message_from_string)
+from mailman.testing.layers import SMTPLayer
+from mailman.testing.mta import ConnectionCountingSMTP
+from unittest.mock import patch
+
+
+class TestSMTPClient(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        self.addCleanup(self._loop.close)
+
+    def _run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+    def _connect(self, *args):
+        client = self._run(SMTPClient.connect(
+            config.mta.smtp_host, int(config.mta.smtp_port), *args,
+            loop=self._loop))
+        self.addCleanup(lambda: self._run(client.quit()))
+        return client
+
+    def test_pipelining(self):
+        client = self._connect()
+        self.assertTrue(client.pipelining)
+        refused = self._run(client.sendmail(
+            'anne@example.com', ['bart@example.com', 'cris@example.com'],
+            'From: anne@example.com\n\n.A leading period.\n'))
+        self.assertEqual(refused, {})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['x-mailfrom'], 'anne@example.com')
+        self.assertEqual(messages[0]['x-rcptto'],
+                         'bart@example.com, cris@example.com')
+        self.assertEqual(messages[0].get_payload(), '.A leading period.')
+
+    def test_without_pipelining(self):
+        client = self._connect()
+        client.extensions.discard('pipelining')
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 550))
+        refused = self._run(client.sendmail(
+            'anne@example.com', ['bart@example.com', 'cris@example.com'],
+            'From: anne@example.com\n\n'))
+        self.assertEqual(refused, {
+            'bart@example.com': (550, b'Error: SMTPRecipientsRefused')})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['x-rcptto'], 'cris@example.com')
+
+    def test_non_ascii_recipient(self):
+        # Without SMTPUTF8, non-ASCII recipients are refused, but the others
+        # still get the message.
+        client = self._connect()
+        refused = self._run(client.sendmail(
+            'anne@example.com', ['bart@example.com', 'zo\xeb@example.com'],
+            'From: anne@example.com\n\n'))
+        self.assertEqual(refused, {
+            'zo\xeb@example.com': (553, NON_ASCII_REFUSAL)})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['x-rcptto'], 'bart@example.com')
+
+    def test_non_ascii_recipients(self):
+        client = self._connect()
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as cm:
+            self._run(client.sendmail(
+                'anne@example.com', ['zo\xeb@example.com'],
+                'From: anne@example.com\n\n'))
+        self.assertEqual(cm.exception.recipients, {
+            'zo\xeb@example.com': (553, NON_ASCII_REFUSAL)})
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 0)
+
+    def test_non_ascii_sender(self):
+        client = self._connect()
+        with self.assertRaises(smtplib.SMTPSenderRefused):
+            self._run(client.sendmail(
+                'zo\xeb@example.com', ['bart@example.com'],
+                'From: anne@example.com\n\n'))
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 0)
+
+    def test_smtputf8(self):
+        # Servers which support SMTPUTF8 get non-ASCII addresses.
+        with patch.object(ConnectionCountingSMTP, 'smtputf8', True):
+            client = self._connect()
+            self.assertIn('smtputf8', client.extensions)
+            refused = self._run(client.sendmail(
+                'zo\xeb@example.com',
+                ['bart@example.com', 'j\xfcrgen@example.com'],
+                'From: anne@example.com\n\n'))
+        self.assertEqual(refused, {})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['x-mailfrom'], 'zo\xeb@example.com')
+        self.assertEqual(messages[0]['x-rcptto'],
+                         'bart@example.com, j\xfcrgen@example.com')
+
+    def test_authentication(self):
+        self._connect('testuser', 'testpass')
+        self.assertEqual(SMTPLayer.smtpd.get_authentication_credentials(),
+                         'AHRlc3R1c2VyAHRlc3RwYXNz')
+
+    def test_login_authentication(self):
+        # Servers which don't offer AUTH PLAIN are logged in to with another
+        # mechanism, like smtplib does.
+        with patch.object(ConnectionCountingSMTP, 'auth_mechanisms',
+                          'LOGIN'):
+            client = self._connect('testuser', 'testpass')
+        self.assertEqual(client.auth_mechanisms, {'LOGIN'})
+        self.assertEqual(SMTPLayer.smtpd.get_authentication_credentials(),
+                         'AHRlc3R1c2VyAHRlc3RwYXNz')
+
+    def test_cram_md5_authentication(self):
+        with patch.object(ConnectionCountingSMTP, 'auth_mechanisms',
+                          'LOGIN CRAM-MD5'):
+            client = self._connect('testuser', 'testpass')
+        self.assertEqual(client.auth_mechanisms, {'LOGIN', 'CRAM-MD5'})
+        self.assertEqual(SMTPLayer.smtpd.get_authentication_credentials(),
+                         'AHRlc3R1c2VyAHRlc3RwYXNz')
+
+    def test_bad_password(self):
+        with patch.object(ConnectionCountingSMTP, 'auth_mechanisms',
+                          'LOGIN'):
+            with self.assertRaises(smtplib.SMTPAuthenticationError):
+                self._run(SMTPClient.connect(
+                    config.mta.smtp_host, int(config.mta.smtp_port),
+                    'testuser', 'bogus', loop=self._loop))
+
+    def test_no_suitable_mechanism(self):
+        with patch.object(ConnectionCountingSMTP, 'auth_mechanisms',
+                          'GSSAPI'):
+            with self.assertRaises(smtplib.SMTPException) as cm:
+                self._run(SMTPClient.connect(
+                    config.mta.smtp_host, int(config.mta.smtp_port),
+                    'testuser', 'testpass', loop=self._loop))
+        self.assertEqual(str(cm.exception),
+                         'No suitable authentication method found.')
+
+
+class TestAsyncBulkDelivery(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Subject: test
+Message-ID: <first>
+
+This is a test.
+""")
+        self._recipients = set(
+            'person_{:02d}@example.com'.format(i) for i in range(20))
+
+    def test_chunks(self):
+        bulk = AsyncBulkDelivery(5, 3)
+        refused = bulk.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(refused, {})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 4)
+        recipients = set()
+        for message in messages:
+            self.assertEqual(message['x-mailfrom'], 'test-bounces@example.com')
+            self.assertEqual(message['message-id'], '<first>')
+            recipients.update(message['x-rcptto'].split(', '))
+        self.assertEqual(recipients, self._recipients)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    def test_sessions_per_connection(self):
+        with configuration('mta', max_sessions_per_connection=2):
+            bulk = AsyncBulkDelivery(5, 1)
+        bulk.deliver(self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 4)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_recipients_refused(self):
+        # As with the blocking delivery, each refused recipient is reported
+        # with the server's reply.
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 550))
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 450))
+        bulk = AsyncBulkDelivery()
+        refused = bulk.deliver(self._mlist, self._msg, dict(
+            recipients=['anne@example.com', 'bart@example.com',
+                        'cris@example.com']))
+        self.assertEqual(refused, {
+            'anne@example.com': (550, b'Error: SMTPRecipientsRefused'),
+            'bart@example.com': (450, b'Error: SMTPRecipientsRefused'),
+            })
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['x-rcptto'], 'cris@example.com')
+
+    def test_all_recipients_refused(self):
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 550))
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 550))
+        bulk = AsyncBulkDelivery()
+        refused = bulk.deliver(self._mlist, self._msg, dict(
+            recipients=['anne@example.com', 'bart@example.com']))
+        self.assertEqual(refused, {
+            'anne@example.com': (550, b'Error: SMTPRecipientsRefused'),
+            'bart@example.com': (550, b'Error: SMTPRecipientsRefused'),
+            })
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 0)
+
+    def test_non_ascii_recipient(self):
+        # A non-ASCII recipient doesn't stop the delivery to the others.
+        bulk = AsyncBulkDelivery(1, 2)
+        refused = bulk.deliver(self._mlist, self._msg, dict(
+            recipients=['anne@example.com', 'zo\xeb@example.com',
+                        'cris@example.com']))
+        self.assertEqual(refused, {
+            'zo\xeb@example.com': (553, NON_ASCII_REFUSAL)})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(
+            sorted(message['x-rcptto'] for message in messages),
+            ['anne@example.com', 'cris@example.com'])
+
+    def test_sender_refused(self):
+        SMTPLayer.smtpd.err_queue.put(('mail', 450))
+        bulk = AsyncBulkDelivery()
+        refused = bulk.deliver(self._mlist, self._msg, dict(
+            recipients=['anne@example.com', 'bart@example.com']))
+        self.assertEqual(refused, {
+            'anne@example.com': (450, b'Error: SMTPResponseException'),
+            'bart@example.com': (450, b'Error: SMTPResponseException'),
+            })
+
+    def test_connection_refused(self):
+        with configuration('mta', smtp_port=2112):
+            bulk = AsyncBulkDelivery()
+        refused = bulk.deliver(self._mlist, self._msg, dict(
+            recipients=['anne@example.com']))
+        self.assertEqual(list(refused), ['anne@example.com'])
+        self.assertEqual(refused['anne@example.com'][0], 444)
+
+
+class TestAsyncDeliver(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Subject: test
+Message-ID: <first>
+
+This is a test.
+""")
+        self._recipients = [
+            'person_{:02d}@example.com'.format(i) for i in range(25)]
+
+    def test_one_message_per_recipient(self):
+        # Each recipient gets their own message, and the queued messages are
+        # sent over the same connection all along.
+        agent = AsyncDeliver()
+        refused = agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(refused, {})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(
+            sorted(message['x-rcptto'] for message in messages),
+            self._recipients)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+
+    def test_max_connections(self):
+        agent = AsyncDeliver(max_connections=3)
+        agent.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 25)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    def test_recipient_refused(self):
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 550))
+        agent = AsyncDeliver()
+        refused = agent.deliver(self._mlist, self._msg, dict(
+            recipients=['bart@example.com']))
+        self.assertEqual(refused, {
+            'bart@example.com': (550, b'Error: SMTPRecipientsRefused')})
+
+    def test_verp(self):
+        # VERP deliveries use the asyncio engine too.
+        deliver(self._mlist, self._msg, dict(
+            recipients=['bart@example.com', 'cris@example.com'], verp=True))
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(
+            sorted(message['x-mailfrom'] for message in messages), [
+                'test-bounces+bart=example.com@example.com',
+                'test-bounces+cris=example.com@example.com',
+                ])
+
+    def test_personalized(self):
+        # So do personalized deliveries.
+        self._mlist.personalize = Personalization.full
+        with patch('mailman.mta.asynchronous.SMTPClient.sendmail',
+                   side_effect=SMTPClient.sendmail,
+                   autospec=True) as sendmail:
+            deliver(self._mlist, self._msg, dict(
+                recipients=['bart@example.com', 'cris@example.com']))
+        self.assertEqual(sendmail.call_count, 2)
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(sorted(message['to'] for message in messages), [
+            'bart@example.com', 'cris@example.com'])
+
+
+class TestDeliver(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Subject: test
+Message-ID: <first>
+
+This is a test.
+""")
+
+    def test_deliver(self):
+        deliver(self._mlist, self._msg, dict(
+            recipients=['bart@example.com', 'cris@example.com']))
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['x-rcptto'],
+                         'bart@example.com, cris@example.com')
+
+    def test_failures(self):
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 550))
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 450))
+        with self.assertRaises(SomeRecipientsFailed) as cm:
+            deliver(self._mlist, self._msg, dict(
+                recipients=['bart@example.com', 'cris@example.com']))
+        self.assertEqual(cm.exception.permanent_failures,
+                         ['bart@example.com'])
+        self.assertEqual(cm.exception.temporary_failures,
+                         ['cris@example.com'])
@@ -0,0 +1,205 @@
+# Copyright (C) 2012-2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test bulk delivery."""
+
+import time
+import unittest
+import threading
+import dns.resolver
+
+from dns.exception import Timeout
+from dns.name import from_text
+from mailman.app.lifecycle import create_list
+from mailman.mta.bulk import BulkDelivery, MXGrouping, group_by_domain
+from mailman.testing.helpers import (
+    LogFileMark, configuration,
+    specialized_message_from_string as message_from_string)
+from mailman.testing.layers import ConfigLayer
+from types import SimpleNamespace
+from unittest.mock import patch
+
+
+class BulkTester(BulkDelivery):
+    """Record the chunks instead of sending them."""
+
+    def __init__(self, *args, **kws):
+        super().__init__(*args, **kws)
+        self.threads = set()
+        # Make every chunk wait for the next, so that they can only be
+        # delivered if at least two are in flight at the same time.
+        self.barrier = threading.Barrier(2)
+
+    def _sendmail(self, sender, recipients, message_id, msgtext):
+        self.threads.add(threading.get_ident())
+        self.barrier.wait(10)
+        self.sender = sender
+        self.msgtext = msgtext
+        # Refuse the recipients at example.org, temporarily or permanently.
+        return {
+            recipient: (450 if recipient.startswith('t') else 550, b'Nope')
+            for recipient in recipients
+            if recipient.endswith('@example.org')
+            }
+
+
+class TestParallelBulkDelivery(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Subject: test
+Message-ID: <first>
+
+""")
+        self._recipients = set()
+        for i in range(4):
+            for domain in ('example.com', 'example.org'):
+                self._recipients.add('p{}@{}'.format(i, domain))
+                self._recipients.add('t{}@{}'.format(i, domain))
+
+    def test_refusals_are_merged(self):
+        bulk = BulkTester(4, 2)
+        refused = bulk.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(len(bulk.threads), 2)
+        self.assertEqual(refused, {
+            'p0@example.org': (550, b'Nope'),
+            'p1@example.org': (550, b'Nope'),
+            'p2@example.org': (550, b'Nope'),
+            'p3@example.org': (550, b'Nope'),
+            't0@example.org': (450, b'Nope'),
+            't1@example.org': (450, b'Nope'),
+            't2@example.org': (450, b'Nope'),
+            't3@example.org': (450, b'Nope'),
+            })
+        self.assertEqual(bulk.sender, 'test-bounces@example.com')
+        self.assertEqual(bulk.msgtext, self._msg.as_wire_bytes())
+
+    def test_one_chunk_is_sent_from_this_thread(self):
+        bulk = BulkTester(0, 2)
+        bulk.barrier = threading.Barrier(1)
+        refused = bulk.deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        self.assertEqual(bulk.threads, {threading.get_ident()})
+        self.assertEqual(len(refused), 8)
+
+
+class TestGrouping(unittest.TestCase):
+    layer = ConfigLayer
+
+    def test_chunks_are_packed_per_group(self):
+        recipients = set()
+        for domain, count in (('a.example', 7), ('b.example', 2),
+                              ('c.example', 2), ('d.example', 1)):
+            recipients.update('p{}@{}'.format(i, domain)
+                              for i in range(count))
+        bulk = BulkDelivery(3, grouping=group_by_domain)
+        chunks = list(bulk.chunkify(recipients))
+        self.assertEqual(sorted(sorted(chunk) for chunk in chunks), [
+            ['p0@a.example', 'p1@a.example', 'p2@a.example'],
+            ['p0@b.example', 'p0@d.example', 'p1@b.example'],
+            ['p0@c.example', 'p1@c.example', 'p6@a.example'],
+            ['p3@a.example', 'p4@a.example', 'p5@a.example'],
+            ])
+
+    def test_grouping_is_case_insensitive(self):
+        bulk = BulkDelivery(2, grouping=group_by_domain)
+        chunks = list(bulk.chunkify(
+            {'anne@example.com', 'bart@EXAMPLE.com', 'cris@example.org'}))
+        self.assertIn({'anne@example.com', 'bart@EXAMPLE.com'}, chunks)
+
+    def test_grouping_from_configuration(self):
+        with patch('mailman.mta.bulk.group_by_mx',
+                   side_effect=group_by_domain) as group_by_mx, \
+                configuration('mta', recipient_grouping=(
+                    'mailman.mta.bulk.group_by_mx')):
+            bulk = BulkDelivery(2)
+            chunks = list(bulk.chunkify(
+                {'anne@example.com', 'bart@example.org'}))
+        self.assertEqual(group_by_mx.call_count, 2)
+        self.assertEqual(len(chunks), 1)
+
+    def test_no_grouping_by_default(self):
+        # Recipients are grouped by top-level domain.
+        bulk = BulkDelivery(2)
+        chunks = list(bulk.chunkify(
+            {'anne@example.com', 'bart@example.org'}))
+        self.assertEqual(len(chunks), 2)
+
+
+class FakeAnswer(list):
+    def __init__(self, records, ttl=60):
+        super().__init__(
+            SimpleNamespace(preference=preference,
+                            exchange=from_text(exchange))
+            for preference, exchange in records)
+        self.expiration = time.time() + ttl
+
+
+class TestMXGrouping(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._grouping = MXGrouping()
+        patcher = patch.object(dns.resolver.Resolver, 'query')
+        self._query = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_most_preferred_exchangers(self):
+        self._query.return_value = FakeAnswer([
+            (20, 'backup.example.net'),
+            (10, 'MX2.example.net'),
+            (10, 'mx1.example.net'),
+            ])
+        self.assertEqual(self._grouping('example.com'),
+                         ('mx1.example.net', 'mx2.example.net'))
+
+    def test_groups_are_cached(self):
+        self._query.return_value = FakeAnswer([(10, 'mx.example.net')])
+        self.assertEqual(self._grouping('example.com'), ('mx.example.net',))
+        self.assertEqual(self._grouping('EXAMPLE.com'), ('mx.example.net',))
+        self.assertEqual(self._query.call_count, 1)
+        self._grouping.clear()
+        self._grouping('example.com')
+        self.assertEqual(self._query.call_count, 2)
+
+    def test_expired_groups_are_looked_up_again(self):
+        self._query.return_value = FakeAnswer(
+            [(10, 'mx.example.net')], ttl=-1)
+        self._grouping('example.com')
+        self._grouping('example.com')
+        self.assertEqual(self._query.call_count, 2)
+
+    def test_no_mx_records(self):
+        self._query.side_effect = dns.resolver.NoAnswer
+        self.assertEqual(self._grouping('example.com'), ('example.com',))
+        self._query.side_effect = dns.resolver.NXDOMAIN
+        self.assertEqual(self._grouping('example.org'), ('example.org',))
+
+    def test_lookup_failure(self):
+        self._query.side_effect = Timeout
+        mark = LogFileMark('mailman.smtp')
+        self.assertEqual(self._grouping('example.com'), ('example.com',))
+        self.assertIn('Unable to look up the MX records of example.com',
+                      mark.read())
+        # The failure is remembered for a while.
+        self._grouping('example.com')
+        self.assertEqual(self._query.call_count, 1)
@@ -17,10 +17,16 @@
 
 """Test MTA connections."""
 
+import time
 import unittest
 
+from mailman.app.lifecycle import create_list
 from mailman.config import config
-from mailman.mta.connection import Connection
+from mailman.mta.base import IndividualDelivery
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.connection import Connection, ConnectionPool
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as message_from_string)
 from mailman.testing.layers import SMTPLayer
 from smtplib import SMTP, SMTPAuthenticationError
 
@@ -102,3 +108,122 @@ Subject: aardvarks
         client.connect(config.mta.smtp_host, int(config.mta.smtp_port))
         client.docmd('RSET')
         self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 0)
+
+
+class TestConnectionPool(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self.pool = ConnectionPool()
+        self.addCleanup(self.pool.close)
+        self.args = (config.mta.smtp_host, int(config.mta.smtp_port), 0)
+        self.msg_text = """\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+"""
+
+    def _send(self, idle_timeout=30):
+        with self.pool.connection(
+                *self.args, idle_timeout=idle_timeout) as connection:
+            connection.sendmail(
+                'anne@example.com', ['bart@example.com'], self.msg_text)
+        return connection
+
+    def test_connection_is_reused(self):
+        first = self._send()
+        second = self._send()
+        self.assertIs(first, second)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+
+    def test_no_reuse_without_idle_timeout(self):
+        self._send(0)
+        self._send(0)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_borrowed_connections_are_not_shared(self):
+        with self.pool.connection(*self.args, idle_timeout=30) as first:
+            with self.pool.connection(*self.args, idle_timeout=30) as second:
+                self.assertIsNot(first, second)
+
+    def test_connections_are_per_server(self):
+        with self.pool.connection(*self.args, idle_timeout=30) as first:
+            pass
+        with self.pool.connection(
+                *self.args, smtp_user='testuser', smtp_pass='testpass',
+                idle_timeout=30) as second:
+            self.assertIsNot(first, second)
+
+    def test_idle_connection_expires(self):
+        first = self._send()
+        # Pretend the connection has been idle for a long time.
+        first._last_used = time.monotonic() - 60
+        second = self._send()
+        self.assertIsNot(first, second)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_session_limit(self):
+        self.args = (config.mta.smtp_host, int(config.mta.smtp_port), 2)
+        for i in range(5):
+            self._send()
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    def test_health_check(self):
+        connection = self._send()
+        # The server hangs up while the connection is idle.
+        connection._connection.docmd('QUIT')
+        connection._last_used = time.monotonic() - connection.check_interval
+        self.assertIs(self._send(), connection)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 2)
+
+    def test_reconnect_when_disconnected(self):
+        connection = self._send()
+        # The server hangs up just before the connection is used again, too
+        # soon for it to be checked.
+        connection._connection.docmd('QUIT')
+        connection._last_used = time.monotonic()
+        self.assertIs(self._send(), connection)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 2)
+
+    @configuration('mta', connection_idle_timeout='30s')
+    def test_deliveries_share_connections(self):
+        mlist = create_list('test@example.com')
+        msg = message_from_string(self.msg_text)
+        for i in range(3):
+            BulkDelivery().deliver(
+                mlist, msg, dict(recipients=['bart@example.com']))
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+
+    def test_deliveries_close_connections_by_default(self):
+        mlist = create_list('test@example.com')
+        msg = message_from_string(self.msg_text)
+        for i in range(3):
+            BulkDelivery().deliver(
+                mlist, msg, dict(recipients=['bart@example.com']))
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    def test_chunks_share_a_connection_by_default(self):
+        # Without the shared pool, the chunks of one delivery still go over
+        # one connection, which is closed once the delivery is done.
+        mlist = create_list('test@example.com')
+        msg = message_from_string(self.msg_text)
+        agent = BulkDelivery(1)
+        agent.deliver(mlist, msg, dict(recipients=[
+            'person_{:02d}@example.com'.format(i) for i in range(8)]))
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 8)
+        self.assertEqual(agent._pool._idle, {})
+
+    def test_recipients_share_a_connection_by_default(self):
+        # Likewise for the recipients of an individual delivery.
+        mlist = create_list('test@example.com')
+        msg = message_from_string(self.msg_text)
+        agent = IndividualDelivery()
+        agent.deliver(mlist, msg, dict(recipients=[
+            'person_{:02d}@example.com'.format(i) for i in range(8)]))
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 8)
+        self.assertEqual(agent._pool._idle, {})
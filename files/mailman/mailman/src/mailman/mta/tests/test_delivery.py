@@ -26,10 +26,13 @@ from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.template import ITemplateManager
+from mailman.model.effectivepreferences import EffectivePreferencesManager
+from mailman.model.roster import MemberRoster
 from mailman.mta.deliver import Deliver
 from mailman.testing.helpers import (
     specialized_message_from_string as mfs, subscribe)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 from zope.component import getUtility
 
 
@@ -105,6 +108,45 @@ name     : $user_name
         member = _msgdata.get('member')
         self.assertEqual(member, self._anne)
 
+    def test_member_keys_looked_up_at_once(self):
+        # The members of all the recipients are looked up together, rather
+        # than one at a time.
+        self._mlist.personalize = Personalization.full
+        msgdata = dict(recipients=['anne@example.org', 'bart@example.org'])
+        agent = DeliverTester()
+        with patch.object(MemberRoster, 'get_member',
+                          side_effect=AssertionError):
+            refused = agent.deliver(self._mlist, self._msg, msgdata)
+        self.assertEqual(len(refused), 0)
+        members = {
+            recipients[0]: (_msgdata['member'], _msg['to'])
+            for _mlist, _msg, _msgdata, recipients in _deliveries
+            }
+        self.assertEqual(members, {
+            'anne@example.org': (self._anne, 'Anne Person <anne@example.org>'),
+            'bart@example.org': (None, 'bart@example.org'),
+            })
+
+    def test_preferences_looked_up_at_once(self):
+        # So are their effective preferences, which the decorator uses.
+        self._anne.preferences.preferred_language = 'fr'
+        msgdata = dict(recipients=['anne@example.org', 'bart@example.org'])
+        agent = DeliverTester()
+        with patch.object(EffectivePreferencesManager, 'get',
+                          side_effect=AssertionError):
+            refused = agent.deliver(self._mlist, self._msg, msgdata)
+        self.assertEqual(len(refused), 0)
+        preferences = {
+            recipients[0]: _msgdata.get('preferences')
+            for _mlist, _msg, _msgdata, recipients in _deliveries
+            }
+        self.assertEqual(preferences['anne@example.org'].member_id,
+                         self._anne.id)
+        self.assertIsNone(preferences['bart@example.org'])
+        _msg = [_msg for _mlist, _msg, _msgdata, recipients in _deliveries
+                if recipients == ['anne@example.org']][0]
+        self.assertIn('language : French', _msg.as_string())
+
     def test_decoration(self):
         msgdata = dict(recipients=['anne@example.org'])
         agent = DeliverTester()
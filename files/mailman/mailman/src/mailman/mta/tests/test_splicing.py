@@ -0,0 +1,243 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test individual delivery which flattens the message only once."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.interfaces.mailinglist import Personalization
+from mailman.interfaces.template import ITemplateManager
+from mailman.mta import splicing
+from mailman.mta.deliver import Deliver, SplicingDeliver, deliver
+from mailman.mta.splicing import MessageTemplate
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as mfs, subscribe)
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+from zope.component import getUtility
+
+
+class RecordingMixin:
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def _sendmail(self, sender, recipients, message_id, msgtext):
+        self.sent.append((sender, recipients, msgtext))
+        # Nothing gets refused.
+        return {}
+
+
+class DeliverTester(RecordingMixin, Deliver):
+    pass
+
+
+class SplicingDeliverTester(RecordingMixin, SplicingDeliver):
+    pass
+
+
+class TestMessageTemplate(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: a very long subject which should not be folded, even though it is
+ already longer than the usual line length
+Message-ID: <ant>
+
+Hello.
+""")
+
+    def test_render(self):
+        template = MessageTemplate(self._msg)
+        self.assertEqual(template.render(), self._msg.as_wire_bytes())
+
+    def test_render_to(self):
+        template = MessageTemplate(self._msg)
+        self._msg.replace_header('To', 'Bart Person <bart@example.org>')
+        self.assertEqual(template.render('Bart Person <bart@example.org>'),
+                         self._msg.as_wire_bytes())
+
+    def test_render_body(self):
+        template = MessageTemplate(self._msg)
+        self.assertEqual(template.body, '\nHello.\n')
+        self.assertEqual(
+            template.render(body=b'\r\nGoodbye.\r\n'),
+            self._msg.as_wire_bytes().replace(b'Hello', b'Goodbye'))
+
+    def test_render_to_without_to(self):
+        del self._msg['to']
+        template = MessageTemplate(self._msg)
+        self.assertEqual(template.render(), self._msg.as_wire_bytes())
+        self.assertRaises(KeyError, template.render, 'bart@example.org')
+
+
+class TestSplicingDelivery(unittest.TestCase):
+    """Test that splicing delivers the same messages as `Deliver`."""
+
+    layer = ConfigLayer
+    maxDiff = None
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._mlist.personalize = Personalization.individual
+        self._recipients = []
+        for name in ('Anne', 'Bart', 'Cris'):
+            email = '{}@example.org'.format(name.lower())
+            subscribe(self._mlist, name, email=email)
+            self._recipients.append(email)
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+
+A message.
+""")
+        self._template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._template_dir)
+        config.push('templates', """
+        [paths.testing]
+        template_dir: {}
+        """.format(self._template_dir))
+        self.addCleanup(config.pop, 'templates')
+
+    def _set_template(self, name, text):
+        path = os.path.join(self._template_dir, 'site', 'en', name + '.txt')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+        getUtility(ITemplateManager).set(
+            'list:member:regular:' + name, self._mlist.list_id,
+            'mailman:///{}.txt'.format(name))
+
+    def _assert_same(self, msgdata=None):
+        # Deliver the message with both agents, and return the number of
+        # times splicing flattened a message.
+        if msgdata is None:
+            msgdata = {}
+        msgdata.setdefault('recipients', self._recipients)
+        original = self._msg.as_string()
+        expected = DeliverTester()
+        expected.deliver(self._mlist, self._msg, msgdata.copy())
+        agent = SplicingDeliverTester()
+        with patch('mailman.mta.splicing.MessageTemplate',
+                   wraps=MessageTemplate) as template:
+            agent.deliver(self._mlist, self._msg, msgdata.copy())
+        self.assertEqual(len(agent.sent), len(self._recipients))
+        self.assertEqual(sorted(agent.sent), sorted(expected.sent))
+        # The original message is left alone.
+        self.assertEqual(self._msg.as_string(), original)
+        return template.call_count
+
+    def test_no_decoration(self):
+        self.assertEqual(self._assert_same(), 1)
+
+    def test_list_decoration(self):
+        self._set_template('footer', 'The list footer.\n')
+        self.assertEqual(self._assert_same(), 1)
+
+    def test_member_footer(self):
+        self._set_template('footer', """\
+address  : $user_address
+name     : $user_name
+""")
+        self.assertEqual(self._assert_same(), 1)
+
+    def test_member_header_and_footer(self):
+        self._set_template('header', 'Dear $user_name,')
+        self._set_template('footer', 'You are $user_address')
+        self.assertEqual(self._assert_same(), 1)
+
+    def test_multipart(self):
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+A message.
+--BOUNDARY
+Content-Type: text/plain
+
+Another part.
+--BOUNDARY--
+""")
+        self._set_template('footer', 'You are $user_address')
+        # The footer is attached as its own part, so every recipient's
+        # message is flattened.
+        expected = DeliverTester()
+        expected.deliver(self._mlist, self._msg,
+                         dict(recipients=self._recipients))
+        agent = SplicingDeliverTester()
+        agent.deliver(self._mlist, self._msg,
+                      dict(recipients=self._recipients))
+        # The boundaries of the footer parts are random, so only compare
+        # everything else.
+        self.assertEqual(len(agent.sent), 3)
+        self.assertEqual(
+            sorted(recipients for sender, recipients, text in agent.sent),
+            sorted(recipients for sender, recipients, text in expected.sent))
+        for sender, recipients, text in agent.sent:
+            self.assertIn('You are {}'.format(recipients[0]).encode(), text)
+
+    def test_non_ascii_footer(self):
+        self._set_template('footer', 'Hello $user_name ☺')
+        self.assertEqual(self._assert_same(), 3)
+
+    def test_full_personalization(self):
+        self._mlist.personalize = Personalization.full
+        self._set_template('footer', 'You are $user_address')
+        self.assertEqual(self._assert_same(), 1)
+
+    def test_duplicates(self):
+        self._msg['X-Mailman-Copy'] = 'no'
+        self._set_template('footer', 'You are $user_address')
+        msgdata = {'add-dup-header': {'bart@example.org'}}
+        # One flattening with the X-Mailman-Copy header, and one without.
+        self.assertEqual(self._assert_same(msgdata), 2)
+
+    def test_verp(self):
+        with configuration('mta', verp_format='$bounces+$local=$domain'):
+            self.assertEqual(self._assert_same(dict(verp=True)), 1)
+
+    def test_deliver_uses_splicing(self):
+        with configuration('mta', splice_individual_deliveries='yes'), \
+                patch.object(splicing.SplicingMixin, 'deliver',
+                             return_value={}) as splicing_deliver:
+            deliver(self._mlist, self._msg,
+                    dict(recipients=self._recipients))
+        self.assertEqual(splicing_deliver.call_count, 1)
+        # Splicing is off by default.
+        with patch.object(splicing.SplicingMixin, 'deliver',
+                          return_value={}) as splicing_deliver, \
+                patch.object(Deliver, '_sendmail', return_value={}):
+            deliver(self._mlist, self._msg,
+                    dict(recipients=self._recipients))
+        self.assertEqual(splicing_deliver.call_count, 0)
@@ -0,0 +1,240 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the per-domain rate limiting and backoff."""
+
+import unittest
+
+from datetime import timedelta
+from mailman.app.lifecycle import create_list
+from mailman.interfaces.mta import SomeRecipientsFailed
+from mailman.mta.deliver import deliver
+from mailman.mta.throttle import DomainThrottle
+from mailman.testing.helpers import (
+    LogFileMark, configuration, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import factory, now
+
+
+def advance(seconds):
+    # Move the predictable clock forward.
+    factory.fast_forward(seconds / 86400)
+
+
+class TestDomainThrottle(unittest.TestCase):
+    """Test the rate limits and the backoff of recipient domains."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._throttle = DomainThrottle()
+
+    def test_disabled_by_default(self):
+        recipients = ['anne{}@example.com'.format(i) for i in range(100)]
+        self.assertEqual(self._throttle.defer(recipients), {})
+        refused = {recipient: (452, b'Slow down') for recipient in recipients}
+        self.assertEqual(self._throttle.record(recipients, refused), {})
+        self.assertEqual(self._throttle.defer(recipients), {})
+
+    def test_rate_limit(self):
+        # Only two recipients per minute at each domain are delivered to.
+        with configuration('mta', domain_rate_limit=2):
+            deferred = self._throttle.defer([
+                'anne@example.com', 'bart@example.com', 'cris@example.com',
+                'dave@example.org'])
+            self.assertEqual(deferred, {
+                'cris@example.com': now() + timedelta(seconds=30),
+                })
+            # Half a minute later, there's room for one more recipient.
+            advance(30)
+            deferred = self._throttle.defer([
+                'cris@example.com', 'elle@example.com'])
+            self.assertEqual(deferred, {
+                'elle@example.com': now() + timedelta(seconds=30),
+                })
+
+    def test_domains_are_case_insensitive(self):
+        with configuration('mta', domain_rate_limit=1):
+            deferred = self._throttle.defer([
+                'anne@example.com', 'bart@EXAMPLE.COM'])
+        self.assertEqual(list(deferred), ['bart@EXAMPLE.COM'])
+
+    def test_backoff(self):
+        # A throttling reply makes us back off from the whole domain.
+        with configuration('mta', domain_backoff='1m'):
+            retry_after = self._throttle.record(
+                ['anne@example.com', 'bart@example.com', 'cris@example.org'],
+                {'anne@example.com': (451, b'Try again later'),
+                 'cris@example.org': (550, b'No such user')})
+            later = now() + timedelta(minutes=1)
+            self.assertEqual(retry_after, {'anne@example.com': later})
+            deferred = self._throttle.defer(
+                ['bart@example.com', 'cris@example.org'])
+            self.assertEqual(deferred, {'bart@example.com': later})
+            # Once the backoff is over, delivery resumes.
+            advance(60)
+            self.assertEqual(self._throttle.defer(['bart@example.com']), {})
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        refused = {'anne@example.com': (421, b'Too busy')}
+        with configuration('mta', domain_backoff='1m',
+                           domain_backoff_max='3m'):
+            backoffs = []
+            for i in range(3):
+                retry_after = self._throttle.record(
+                    ['anne@example.com'], refused)
+                backoffs.append(retry_after['anne@example.com'] - now())
+            self.assertEqual(backoffs, [
+                timedelta(minutes=1),
+                timedelta(minutes=2),
+                timedelta(minutes=3),
+                ])
+
+    def test_success_resets_the_backoff(self):
+        refused = {'anne@example.com': (421, b'Too busy')}
+        with configuration('mta', domain_backoff='1m'):
+            self._throttle.record(['anne@example.com'], refused)
+            self._throttle.record(['anne@example.com'], refused)
+            advance(120)
+            self._throttle.record(['bart@example.com'], {})
+            retry_after = self._throttle.record(['anne@example.com'], refused)
+        self.assertEqual(retry_after['anne@example.com'] - now(),
+                         timedelta(minutes=1))
+
+    def test_backoff_is_logged(self):
+        mark = LogFileMark('mailman.smtp')
+        with configuration('mta', domain_backoff='1m'):
+            self._throttle.record(
+                ['anne@example.com'],
+                {'anne@example.com': (450, b'Mailbox busy')})
+        self.assertIn('Backing off from example.com for 0:01:00',
+                      mark.readline())
+
+    def test_idle_domains_are_dropped(self):
+        # The state of the domains is dropped once they are neither over
+        # their rate limit nor backing off.
+        with configuration('mta', domain_rate_limit=2):
+            self._throttle.defer([
+                'anne@example{}.com'.format(i) for i in range(100)])
+            self.assertEqual(len(self._throttle._domains), 100)
+            advance(60)
+            self._throttle.defer(['bart@example.org'])
+        self.assertEqual(list(self._throttle._domains), ['example.org'])
+
+    def test_backing_off_domains_are_kept(self):
+        with configuration('mta', domain_backoff='10m',
+                           domain_backoff_max='1h'):
+            self._throttle.record(
+                ['anne@example.com'],
+                {'anne@example.com': (421, b'Too busy')})
+            advance(11 * 60)
+            self._throttle.defer(['bart@example.org'])
+            # The backoff is over, but it still counts towards the next one.
+            self.assertEqual(list(self._throttle._domains), ['example.com'])
+            advance(60 * 60)
+            self._throttle.defer(['bart@example.org'])
+        self.assertEqual(self._throttle._domains, {})
+
+    def test_clear(self):
+        with configuration('mta', domain_rate_limit=1):
+            self._throttle.defer(['anne@example.com'])
+            self._throttle.clear()
+            self.assertEqual(self._throttle.defer(['bart@example.com']), {})
+
+
+class RecordingAgent:
+    def __init__(self, refused):
+        self.refused = refused
+        self.deliveries = []
+
+    def deliver(self, mlist, msg, msgdata):
+        self.deliveries.append(msgdata['recipients'])
+        return self.refused
+
+
+class TestThrottledDelivery(unittest.TestCase):
+    """Test that deliveries hold back the recipients at throttled domains."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def test_deferred_recipients(self):
+        agent = RecordingAgent({'anne@example.com': (452, b'Slow down')})
+        msgdata = dict(recipients=['anne@example.com', 'bart@example.org'])
+        with configuration('mta', domain_backoff='10m'):
+            with self.assertRaises(SomeRecipientsFailed) as cm:
+                deliver(self._mlist, self._msg, msgdata, lambda: agent)
+            later = now() + timedelta(minutes=10)
+            self.assertEqual(cm.exception.temporary_failures,
+                             ['anne@example.com'])
+            self.assertEqual(cm.exception.retry_after,
+                             {'anne@example.com': later})
+            # The next delivery only goes to the other domain.  The
+            # recipients at the throttled domain are retried later.
+            agent.refused = {}
+            msgdata = dict(recipients=['bart@example.org', 'cris@example.com'])
+            with self.assertRaises(SomeRecipientsFailed) as cm:
+                deliver(self._mlist, self._msg, msgdata, lambda: agent)
+        self.assertEqual(agent.deliveries[-1], ['bart@example.org'])
+        self.assertEqual(cm.exception.temporary_failures,
+                         ['cris@example.com'])
+        self.assertEqual(cm.exception.permanent_failures, [])
+        self.assertEqual(cm.exception.retry_after,
+                         {'cris@example.com': later})
+        # The caller's metadata is left alone.
+        self.assertEqual(msgdata['recipients'],
+                         ['bart@example.org', 'cris@example.com'])
+
+    def test_all_recipients_deferred(self):
+        # When every recipient is deferred, the agent isn't called at all.
+        agent = RecordingAgent({})
+        msgdata = dict(recipients=['anne@example.com', 'bart@example.com'])
+        with configuration('mta', domain_rate_limit=1):
+            with self.assertRaises(SomeRecipientsFailed) as cm:
+                deliver(self._mlist, self._msg, msgdata, lambda: agent)
+            self.assertEqual(agent.deliveries, [['anne@example.com']])
+            self.assertEqual(cm.exception.temporary_failures,
+                             ['bart@example.com'])
+            with self.assertRaises(SomeRecipientsFailed) as cm:
+                deliver(self._mlist, self._msg,
+                        dict(recipients=['cris@example.com']), lambda: agent)
+        self.assertEqual(len(agent.deliveries), 1)
+        self.assertEqual(cm.exception.temporary_failures,
+                         ['cris@example.com'])
+
+    def test_all_recipients_deferred_not_logged(self):
+        # No delivery is logged when every recipient is deferred.
+        agent = RecordingAgent({})
+        with configuration('mta', domain_rate_limit=1):
+            deliver(self._mlist, self._msg,
+                    dict(recipients=['anne@example.com']), lambda: agent)
+            mark = LogFileMark('mailman.smtp')
+            with self.assertRaises(SomeRecipientsFailed):
+                deliver(self._mlist, self._msg,
+                        dict(recipients=['bart@example.com']), lambda: agent)
+        log = mark.read()
+        self.assertIn('<ant> deferring 1 recipients at throttled domains', log)
+        self.assertNotIn('<ant> smtp to', log)
+        self.assertNotIn('<ant> post to', log)
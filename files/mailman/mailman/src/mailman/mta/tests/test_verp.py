@@ -0,0 +1,80 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test VERP delivery."""
+
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.mta.verp import VERPDelivery, verp_formatter
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+
+
+class TestVERPFormatter(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+
+    def test_default_format(self):
+        verp = verp_formatter(self._mlist, 'test-bounces@example.com')
+        self.assertEqual(verp('anne@example.org'),
+                         'test-bounces+anne=example.org@example.com')
+
+    def test_unqualified_recipient(self):
+        verp = verp_formatter(self._mlist, 'test-bounces@example.com')
+        self.assertIsNone(verp('anne'))
+
+    def test_list_substitutions(self):
+        with configuration('mta',
+                           verp_format='$short_listname.$local.$domain'):
+            verp = verp_formatter(self._mlist, 'test-bounces@example.com')
+        self.assertEqual(verp('anne@example.org'),
+                         'test.anne.example.org@example.com')
+
+
+class TestVERPDelivery(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def test_formatter_is_compiled_once(self):
+        # The formatter is compiled once per delivery, not per recipient.
+        agent = VERPDelivery()
+        msgdata = dict(verp=True)
+        senders = []
+        with patch('mailman.mta.verp.verp_formatter',
+                   wraps=verp_formatter) as formatter:
+            for recipient in ('bart@example.org', 'cris@example.net'):
+                msgdata['recipient'] = recipient
+                senders.append(
+                    agent._get_sender(self._mlist, self._msg, msgdata))
+        self.assertEqual(formatter.call_count, 1)
+        self.assertEqual(senders, [
+            'test-bounces+bart=example.org@example.com',
+            'test-bounces+cris=example.net@example.com',
+            ])
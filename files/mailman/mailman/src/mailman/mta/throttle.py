@@ -0,0 +1,195 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-domain rate limiting and backoff of outgoing deliveries."""
+
+import logging
+import threading
+
+from datetime import timedelta
+from lazr.config import as_timedelta
+from mailman.config import config
+from mailman.utilities.datetime import now
+from public import public
+
+
+# SMTP replies with which servers tell us to slow down.
+THROTTLING_CODES = frozenset((421, 450, 451, 452))
+
+# How often the state of the domains which no longer need it is dropped.
+PRUNE_INTERVAL = timedelta(minutes=1)
+
+log = logging.getLogger('mailman.smtp')
+
+
+def _domain(recipient):
+    localpart, at, domain = recipient.rpartition('@')
+    return domain.lower()
+
+
+class _Domain:
+    """The delivery state of one recipient domain."""
+
+    def __init__(self, rate, current_time):
+        # A token bucket holding up to a minute's worth of recipients.
+        self.tokens = rate
+        self.filled = current_time
+        # The current backoff, and the time until which it lasts.
+        self.backoff = timedelta()
+        self.not_before = current_time
+
+    def refill(self, rate, current_time):
+        seconds = (current_time - self.filled).total_seconds()
+        self.tokens = min(rate, self.tokens + seconds * rate / 60)
+        self.filled = current_time
+
+    def is_idle(self, rate, max_backoff, current_time):
+        # Whether the domain is neither limited nor backing off, so that a
+        # new state would do just as well.  A backoff which ended long ago
+        # no longer counts towards the next one.
+        if rate > 0:
+            self.refill(rate, current_time)
+            if self.tokens < rate:
+                return False
+        return (self.not_before <= current_time and
+                (self.backoff.total_seconds() == 0 or
+                 self.not_before + max_backoff <= current_time))
+
+
+@public
+class DomainThrottle:
+    """Track the delivery rate and the failures of every recipient domain.
+
+    Recipients at a domain are deferred while the domain is over its rate
+    limit, or while it is backing off after telling us to slow down.  The
+    backoff doubles with every throttling reply, up to a maximum, and ends
+    with the first successful delivery to the domain.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._domains = {}
+        self._pruned = None
+
+    def _settings(self):
+        # Return the rate limit, the initial backoff and the maximum backoff.
+        return (int(config.mta.domain_rate_limit),
+                as_timedelta(config.mta.domain_backoff),
+                as_timedelta(config.mta.domain_backoff_max))
+
+    def _prune(self, rate, max_backoff, current_time):
+        # Every once in a while, drop the state of the idle domains, so that
+        # it doesn't grow with every domain ever delivered to.  The lock must
+        # be held.
+        if (self._pruned is not None and
+                current_time - self._pruned < PRUNE_INTERVAL):
+            return
+        self._pruned = current_time
+        for domain, state in list(self._domains.items()):
+            if state.is_idle(rate, max_backoff, current_time):
+                del self._domains[domain]
+
+    def defer(self, recipients):
+        """Pick the recipients which must not be delivered to yet.
+
+        The other recipients count towards their domain's rate limit, so
+        they should be delivered to right away.
+
+        :param recipients: The recipients of a message.
+        :type recipients: iterable of str
+        :return: The deferred recipients, mapped to the time at which they
+            may be delivered to.
+        :rtype: dict
+        """
+        rate, backoff, max_backoff = self._settings()
+        if rate <= 0 and backoff.total_seconds() <= 0:
+            return {}
+        current_time = now()
+        deferred = {}
+        with self._lock:
+            self._prune(rate, max_backoff, current_time)
+            for recipient in sorted(recipients):
+                state = self._domains.get(_domain(recipient))
+                if state is None:
+                    if rate <= 0:
+                        continue
+                    state = self._domains[_domain(recipient)] = _Domain(
+                        rate, current_time)
+                if state.not_before > current_time:
+                    deferred[recipient] = state.not_before
+                elif rate > 0:
+                    state.refill(rate, current_time)
+                    if state.tokens >= 1:
+                        state.tokens -= 1
+                    else:
+                        # Wait until there is room for this recipient.
+                        deferred[recipient] = current_time + timedelta(
+                            seconds=(1 - state.tokens) * 60 / rate)
+        return deferred
+
+    def record(self, recipients, refused):
+        """Record the outcome of a delivery.
+
+        :param recipients: The recipients the message was delivered to.
+        :type recipients: iterable of str
+        :param refused: The refused recipients, as returned by the delivery
+            agent.
+        :type refused: dict
+        :return: The recipients refused because their domain is throttling
+            us, mapped to the time at which they may be delivered to again.
+        :rtype: dict
+        """
+        rate, backoff, max_backoff = self._settings()
+        if backoff.total_seconds() <= 0:
+            return {}
+        current_time = now()
+        throttled = {}
+        succeeded = set()
+        for recipient in recipients:
+            if recipient not in refused:
+                succeeded.add(_domain(recipient))
+            elif refused[recipient][0] in THROTTLING_CODES:
+                throttled.setdefault(_domain(recipient), []).append(recipient)
+        retry_after = {}
+        with self._lock:
+            self._prune(rate, max_backoff, current_time)
+            for domain in succeeded - set(throttled):
+                state = self._domains.get(domain)
+                if state is not None:
+                    state.backoff = timedelta()
+            for domain, domain_recipients in throttled.items():
+                state = self._domains.get(domain)
+                if state is None:
+                    state = self._domains[domain] = _Domain(
+                        rate, current_time)
+                state.backoff = min(max_backoff, max(backoff,
+                                                     state.backoff * 2))
+                state.not_before = current_time + state.backoff
+                log.info('Backing off from %s for %s', domain, state.backoff)
+                for recipient in domain_recipients:
+                    retry_after[recipient] = state.not_before
+        return retry_after
+
+    def clear(self):
+        """Forget the state of all domains."""
+        with self._lock:
+            self._domains.clear()
+            self._pruned = None
+
+
+# The throttle shared by all the deliveries in this process.
+public(domain_throttle=DomainThrottle())
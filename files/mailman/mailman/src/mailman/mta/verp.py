@@ -21,15 +21,44 @@ import logging
 
 from mailman.config import config
 from mailman.mta.base import IndividualDelivery
-from mailman.utilities.email import split_email
-from mailman.utilities.string import expand
+from mailman.utilities.string import compile_template
 from public import public
 
 
-DOT = '.'
 log = logging.getLogger('mailman.smtp')
 
 
+@public
+def verp_formatter(mlist, sender):
+    """Return a function which VERP encodes recipients in the sender.
+
+    The `verp_format` template is compiled once for the mailing list and the
+    sender, so that only the recipient is left to substitute.
+
+    :param mlist: The mailing list being delivered to.
+    :type mlist: `IMailingList`
+    :param sender: The envelope sender.
+    :type sender: str
+    :return: A function which takes a recipient's address, and returns the
+        VERP'd envelope sender, or None if the address is not
+        fully-qualified.
+    :rtype: callable
+    """
+    sender_mailbox, at, sender_domain = sender.partition('@')
+    expand_verp = compile_template(
+        config.mta.verp_format, mlist, dict(bounces=sender_mailbox),
+        ('local', 'domain'))
+    suffix = '@' + sender_domain
+
+    def verp(recipient):
+        recipient_mailbox, at, recipient_domain = recipient.partition('@')
+        if len(at) == 0:
+            return None
+        return expand_verp(local=recipient_mailbox,
+                           domain=recipient_domain) + suffix
+    return verp
+
+
 @public
 class VERPMixin:
     """Mixin for VERP functionality.
@@ -38,6 +67,11 @@ class VERPMixin:
     the VERP'd envelope sender.  It expects the individual recipient's address
     to be squirreled away in the message metadata.
     """
+    def __init__(self, *args, **kws):
+        super().__init__(*args, **kws)
+        # The VERP formatters of this delivery, by list and sender.
+        self._verp_formatters = {}
+
     def _get_sender(self, mlist, msg, msgdata):
         """Return the recipient's address VERP encoded in the sender.
 
@@ -52,10 +86,14 @@ class VERPMixin:
         if msgdata.get('verp', False):
             log.debug('VERPing %s', msg.get('message-id'))
             recipient = msgdata['recipient']
-            sender_mailbox, sender_domain = split_email(sender)
+            key = (mlist.list_id, sender)
+            verp = self._verp_formatters.get(key)
+            if verp is None:
+                verp = self._verp_formatters[key] = verp_formatter(
+                    mlist, sender)
             # Encode the recipient's address for VERP.
-            recipient_mailbox, recipient_domain = split_email(recipient)
-            if recipient_domain is None:
+            verp_sender = verp(recipient)
+            if verp_sender is None:
                 # The recipient address is not fully-qualified.  We can't
                 # deliver it to this person, nor can we craft a valid verp
                 # header.  I don't think there's much we can do except ignore
@@ -63,12 +101,7 @@ class VERPMixin:
                 log.info('Skipping VERP delivery to unqual recip: %s',
                          recipient)
                 return sender
-            return '{0}@{1}'.format(
-                expand(config.mta.verp_format, mlist, dict(
-                    bounces=sender_mailbox,
-                    local=recipient_mailbox,
-                    domain=DOT.join(recipient_domain))),
-                DOT.join(sender_domain))
+            return verp_sender
         else:
             return sender
 
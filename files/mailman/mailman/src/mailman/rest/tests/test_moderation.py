@@ -22,6 +22,7 @@ import unittest
 from email import message_from_binary_file
 from mailman.app.lifecycle import create_list
 from mailman.app.moderator import hold_message
+from mailman.config import config
 from mailman.database.transaction import transaction
 from mailman.interfaces.bans import IBanManager
 from mailman.interfaces.mailinglist import SubscriptionPolicy
@@ -360,6 +361,8 @@ class TestSubscriptionModeration(unittest.TestCase):
             action='accept',
             ))
         self.assertEqual(response.status, 204)
+        # Reset any current transaction.
+        config.db.abort()
         # Anne is a member.
         self.assertEqual(
             self._mlist.members.get_member('anne@example.com').address,
@@ -43,11 +43,13 @@ class TestSystemConfiguration(unittest.TestCase):
             filtered_messages_are_preservable='no',
             html_to_plain_text_command='/usr/bin/lynx -dump $filename',
             layout='testing',
+            member_cache_size='10000',
             noreply_address='noreply',
             pending_request_life='3d',
             post_hook='',
             pre_hook='',
             sender_headers='from from_ reply-to sender',
+            share_recipients='no',
             site_owner='noreply@example.com',
             ))
 
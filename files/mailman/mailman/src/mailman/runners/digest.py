@@ -329,23 +329,21 @@ class DigestRunner(Runner):
         # When someone turns off digest delivery, they will get one last
         # digest to ensure that there will be no gaps in the messages they
         # receive.
-        digest_members = set(mlist.digest_members.members)
-        for member in digest_members:
-            if member.delivery_status is not DeliveryStatus.enabled:
-                continue
+        for entry in mlist.digest_members.find_entries(
+                delivery_status=DeliveryStatus.enabled):
             # Send the digest to the case-preserved address of the digest
             # members.
-            email_address = member.address.original_email
-            if member.delivery_mode == DeliveryMode.plaintext_digests:
+            email_address = entry.original_email
+            if entry.delivery_mode == DeliveryMode.plaintext_digests:
                 rfc1153_recipients.add(email_address)
             # We currently treat summary_digests the same as mime_digests.
-            elif member.delivery_mode in (DeliveryMode.mime_digests,
-                                          DeliveryMode.summary_digests):
+            elif entry.delivery_mode in (DeliveryMode.mime_digests,
+                                         DeliveryMode.summary_digests):
                 mime_recipients.add(email_address)
             else:
                 raise AssertionError(
                     'Digest member "{}" unexpected delivery mode: {}'.format(
-                        email_address, member.delivery_mode))
+                        email_address, entry.delivery_mode))
         # Add also the folks who are receiving one last digest.
         for address, delivery_mode in mlist.last_digest_recipients:
             if delivery_mode == DeliveryMode.plaintext_digests:
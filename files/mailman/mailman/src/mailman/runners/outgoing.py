@@ -20,11 +20,15 @@
 import socket
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.runner import Runner
 from mailman.interfaces.bounce import BounceContext, IBounceProcessor
+from mailman.interfaces.deliveries import IDeliveryStore
+from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.mta import SomeRecipientsFailed
 from mailman.interfaces.pending import IPendings
@@ -58,9 +62,19 @@ class OutgoingRunner(Runner):
         # set if there was a socket.error.
         self._logged = False
         self._retryq = config.switchboards['retry']
+        # With more than one concurrent delivery, messages are delivered by a
+        # pool of threads.
+        self._executor = (ThreadPoolExecutor(self.concurrency)
+                          if self.concurrency > 1 else None)
+
+    def _clean_up(self):
+        if self._executor is not None:
+            self._executor.shutdown()
 
     def _dispose(self, mlist, msg, msgdata):
-        # See if we should retry delivery of this message again.
+        # Messages which must not be delivered yet are normally held back by
+        # the switchboard until they are due, but check anyway in case this
+        # one was queued without its due time in the file name.
         deliver_after = msgdata.get('deliver_after', datetime.fromtimestamp(0))
         if now() < deliver_after:
             return True
@@ -87,12 +101,45 @@ class OutgoingRunner(Runner):
         else:
             # VERP every 'interval' number of times.
             msgdata['verp'] = (mlist.post_id % interval == 0)
+        if self._executor is not None:
+            # Deliver the message in a worker thread, and deal with the
+            # outcome in this one once it's done.
+            return self._executor.submit(
+                self._deliver_in_thread, mlist.list_id,
+                partial(self._delivered, mlist, msg, msgdata), msg, msgdata)
+        return self._delivered(
+            mlist, msg, msgdata, self._deliver(mlist, msg, msgdata))
+
+    def _deliver(self, mlist, msg, msgdata):
+        # Return the exception for a failed delivery, or None.
         try:
             debug_log.debug('[outgoing] {}: {}'.format(
                 self._func, msg.get('message-id', 'n/a')))
             self._func(mlist, msg, msgdata)
+        except (socket.error, SomeRecipientsFailed) as error:
+            return error
+        return None
+
+    def _deliver_in_thread(self, list_id, delivered, msg, msgdata):
+        # Each thread has its own database session, so the mailing list must
+        # be looked up again in this one.
+        try:
+            mlist = getUtility(IListManager).get_by_list_id(list_id)
+            error = self._deliver(mlist, msg, msgdata)
+        finally:
+            # Delivery doesn't change the database, but don't keep the
+            # thread's transaction open until its next message.
+            config.db.abort()
+        return partial(delivered, error)
+
+    def _delivered(self, mlist, msg, msgdata, error):
+        if error is None:
             self._logged = False
-        except socket.error:
+            if 'delivery_id' in msgdata:
+                # A retry of a tracked delivery went through.
+                self._track(mlist, msg, msgdata, [], [], {})
+            return False
+        if isinstance(error, socket.error):
             # There was a problem connecting to the SMTP server.  Log this
             # once, but crank up our sleep time so we don't fill the error
             # log.
@@ -104,62 +151,121 @@ class OutgoingRunner(Runner):
                           config.mta.smtp_host, port)
                 self._logged = True
             return True
-        except SomeRecipientsFailed as error:
-            processor = getUtility(IBounceProcessor)
-            # BAW: msg is the original message that failed delivery, not a
-            # bounce message.  This may be confusing if this is what's sent to
-            # the user in the probe message.  Maybe we should craft a
-            # bounce-like message containing information about the permanent
-            # SMTP failure?
-            if 'probe_token' in msgdata:
-                # This is a failure of our local MTA to deliver to a probe
-                # message recipient.  Register the bounce event for permanent
-                # failures.  Start by grabbing and confirming (i.e. removing)
-                # the pendable record associated with this bounce token,
-                # regardless of what address was actually failing.
-                if len(error.permanent_failures) > 0:
-                    pended = getUtility(IPendings).confirm(
-                        msgdata['probe_token'])
-                    # It's possible the token has been confirmed out of the
-                    # database.  Just ignore that.
-                    if pended is not None:
-                        # The UUID had to be pended as a unicode.
-                        member = getUtility(ISubscriptionService).get_member(
-                            UUID(hex=pended['member_id']))
-                        processor.register(
-                            mlist, member.address.email, msg,
-                            BounceContext.probe)
-            else:
-                # Delivery failed at SMTP time for some or all of the
-                # recipients.  Permanent failures are registered as bounces,
-                # but temporary failures are retried for later.
-                for email in error.permanent_failures:
-                    processor.register(mlist, email, msg, BounceContext.normal)
-                # Move temporary failures to the qfiles/retry queue which will
-                # occasionally move them back here for another shot at
-                # delivery.
-                if error.temporary_failures:
-                    current_time = now()
-                    recipients = error.temporary_failures
-                    last_recip_count = msgdata.get('last_recip_count', 0)
-                    deliver_until = msgdata.get('deliver_until', current_time)
-                    if len(recipients) == last_recip_count:
-                        # We didn't make any progress.  If we've exceeded the
-                        # configured retry period, log this failure and
-                        # discard the message.
-                        if current_time > deliver_until:
-                            smtp_log.error('Discarding message with '
-                                           'persistent temporary failures: '
-                                           '{}'.format(msg['message-id']))
-                            return False
-                    else:
-                        # We made some progress, so keep trying to delivery
-                        # this message for a while longer.
-                        deliver_until = current_time + as_timedelta(
-                            config.mta.delivery_retry_period)
-                    msgdata['last_recip_count'] = len(recipients)
-                    msgdata['deliver_until'] = deliver_until
-                    msgdata['recipients'] = recipients
+        processor = getUtility(IBounceProcessor)
+        # BAW: msg is the original message that failed delivery, not a
+        # bounce message.  This may be confusing if this is what's sent to
+        # the user in the probe message.  Maybe we should craft a
+        # bounce-like message containing information about the permanent
+        # SMTP failure?
+        if 'probe_token' in msgdata:
+            # This is a failure of our local MTA to deliver to a probe
+            # message recipient.  Register the bounce event for permanent
+            # failures.  Start by grabbing and confirming (i.e. removing)
+            # the pendable record associated with this bounce token,
+            # regardless of what address was actually failing.
+            if len(error.permanent_failures) > 0:
+                pended = getUtility(IPendings).confirm(
+                    msgdata['probe_token'])
+                # It's possible the token has been confirmed out of the
+                # database.  Just ignore that.
+                if pended is not None:
+                    # The UUID had to be pended as a unicode.
+                    member = getUtility(ISubscriptionService).get_member(
+                        UUID(hex=pended['member_id']))
+                    processor.register(
+                        mlist, member.address.email, msg,
+                        BounceContext.probe)
+        else:
+            # Delivery failed at SMTP time for some or all of the
+            # recipients.  Permanent failures are registered as bounces,
+            # but temporary failures are retried for later.
+            for email in error.permanent_failures:
+                processor.register(mlist, email, msg, BounceContext.normal)
+            # The delivery state store keeps track of the temporary failures
+            # of tracked deliveries, and the retry runner queues them here
+            # again when they are due.
+            if 'delivery_id' in msgdata or (
+                    error.temporary_failures and
+                    as_boolean(config.mta.track_delivery_state)):
+                self._track(mlist, msg, msgdata, error.temporary_failures,
+                            error.permanent_failures, error.retry_after)
+            # Otherwise, move temporary failures to the qfiles/retry queue
+            # which will occasionally move them back here for another shot at
+            # delivery.
+            elif error.temporary_failures:
+                current_time = now()
+                recipients = error.temporary_failures
+                last_recip_count = msgdata.get('last_recip_count', 0)
+                deliver_until = msgdata.get('deliver_until', current_time)
+                if len(recipients) == last_recip_count:
+                    # We didn't make any progress.  If we've exceeded the
+                    # configured retry period, log this failure and
+                    # discard the message.
+                    if current_time > deliver_until:
+                        smtp_log.error('Discarding message with '
+                                       'persistent temporary failures: '
+                                       '{}'.format(msg['message-id']))
+                        return False
+                else:
+                    # We made some progress, so keep trying to delivery
+                    # this message for a while longer.
+                    deliver_until = current_time + as_timedelta(
+                        config.mta.delivery_retry_period)
+                msgdata['last_recip_count'] = len(recipients)
+                msgdata['deliver_until'] = deliver_until
+                # The retry queue holds the message back until it's due.
+                # Recipients at throttled domains have retry times of their
+                # own, so retry each group of recipients separately.
+                retry_time = current_time + as_timedelta(
+                    config.mta.delivery_retry_interval)
+                by_time = {}
+                for recipient in recipients:
+                    by_time.setdefault(
+                        error.retry_after.get(recipient, retry_time),
+                        []).append(recipient)
+                for deliver_after in sorted(by_time):
+                    msgdata['recipients'] = by_time[deliver_after]
+                    msgdata['deliver_after'] = deliver_after
                     self._retryq.enqueue(msg, msgdata)
         # We've successfully completed handling of this message.
         return False
+
+    def _track(self, mlist, msg, msgdata, temporary_failures,
+               permanent_failures, retry_after):
+        # Record the outcome of a delivery attempt in the delivery state
+        # store.
+        store = getUtility(IDeliveryStore)
+        current_time = now()
+        delivery = (store.get(msgdata['delivery_id'])
+                    if 'delivery_id' in msgdata
+                    else None)
+        if delivery is None:
+            if len(temporary_failures) == 0:
+                return
+            # This is the first failed attempt.  The recipients which were
+            # delivered to aren't tracked.
+            delivery = store.add(mlist, msg, msgdata)
+            delivered = []
+            progress = True
+        else:
+            failed = set(temporary_failures)
+            failed.update(permanent_failures)
+            delivered = [recipient for recipient in msgdata['recipients']
+                         if recipient not in failed]
+            progress = len(delivered) + len(permanent_failures) > 0
+        retry_time = current_time + as_timedelta(
+            config.mta.delivery_retry_interval)
+        delivery.record(
+            temporary_failures, permanent_failures,
+            {recipient: retry_after.get(recipient, retry_time)
+             for recipient in temporary_failures},
+            delivered)
+        if progress:
+            # Keep trying to deliver this message for a while longer.
+            delivery.deliver_until = current_time + as_timedelta(
+                config.mta.delivery_retry_period)
+        elif len(temporary_failures) > 0 and (
+                current_time > delivery.deliver_until):
+            smtp_log.error('Discarding message with persistent temporary '
+                           'failures: {}'.format(msg['message-id']))
+            delivery.expire()
@@ -17,22 +17,75 @@
 
 """Retry delivery."""
 
-import time
+import logging
 
+from lazr.config import as_boolean
 from mailman.config import config
+from mailman.core.queueindex import parse_filebase
 from mailman.core.runner import Runner
+from mailman.core.switchboard import due_clock, timestamp
+from mailman.interfaces.deliveries import IDeliveryStore
 from public import public
+from zope.component import getUtility
+
+
+elog = logging.getLogger('mailman.error')
 
 
 @public
 class RetryRunner(Runner):
     """Retry delivery."""
 
+    def __init__(self, name, slice=None):
+        super().__init__(name, slice)
+        # When the next tracked recipient is due, as a timestamp.
+        self._next_retry = None
+
+    def _one_iteration(self):
+        filecnt = super()._one_iteration()
+        if as_boolean(config.mta.track_delivery_state):
+            filecnt += self._queue_tracked()
+        else:
+            self._next_retry = None
+        return filecnt
+
+    def _queue_tracked(self):
+        # Queue the tracked recipients which are due for another delivery
+        # attempt.  The stored message is shared by all the attempts.
+        store = getUtility(IDeliveryStore)
+        outq = config.switchboards['out']
+        count = 0
+        for delivery, recipients in store.due():
+            stored = delivery.get_message()
+            if stored is None:
+                elog.error('Expiring delivery %s of %s without a message',
+                           delivery.id, delivery.message_id)
+                delivery.expire()
+                continue
+            msg, msgdata = stored
+            msgdata['recipients'] = recipients
+            msgdata['delivery_id'] = delivery.id
+            outq.enqueue(msg, msgdata)
+            count += 1
+        store.evict()
+        next_due = store.next_due()
+        self._next_retry = None if next_due is None else timestamp(next_due)
+        config.db.commit()
+        return count
+
+    def _snooze(self, filecnt):
+        if filecnt or self.sleep_float <= 0:
+            return
+        # Wake up as soon as the next retry is due.
+        due = [self._next_retry] if self._next_retry is not None else []
+        delayed = self.switchboard.delayed_files
+        if len(delayed) > 0:
+            due.append(parse_filebase(delayed[0])[3])
+        self._sleep(min(due) - due_clock() if len(due) > 0 else None)
+
     def _dispose(self, mlist, msg, msgdata):
-        # Move the message to the out queue for another try.
+        # The switchboard only hands us messages once their retry is due, so
+        # move the message to the out queue for another try right away.
+        msgdata.pop('deliver_after', None)
         config.switchboards['out'].enqueue(msg, msgdata)
         return False
-
-    def _snooze(self, filecnt):
-        # We always want to snooze.
-        time.sleep(self.sleep_float)
@@ -21,6 +21,7 @@ import os
 import socket
 import logging
 import unittest
+import threading
 
 from datetime import datetime, timedelta
 from lazr.config import as_timedelta
@@ -28,6 +29,7 @@ from mailman.app.bounces import send_probe
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.interfaces.bounce import BounceContext, IBounceProcessor
+from mailman.interfaces.deliveries import DeliveryStatus, IDeliveryStore
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.member import MemberRole
 from mailman.interfaces.mta import SomeRecipientsFailed
@@ -68,13 +70,15 @@ Message-Id: <first>
         self._msgdata = {}
 
     def test_deliver_after(self):
-        # When the metadata has a deliver_after key in the future, the runner
-        # will re-enqueue the message rather than delivering it.
+        # When the metadata has a deliver_after key in the future, the
+        # message is held back in the queue rather than being delivered.
         deliver_after = now() + timedelta(days=10)
         self._msgdata['deliver_after'] = deliver_after
         self._outq.enqueue(self._msg, self._msgdata,
                            tolist=True, listid='test.example.com')
         self._runner.run()
+        self.assertEqual(self._outq.files, [])
+        self.assertEqual(len(self._outq.delayed_files), 1)
         items = get_queue_messages('out', expected_count=1)
         self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
         self.assertEqual(items[0].msg['message-id'], '<first>')
@@ -271,10 +275,12 @@ Message-Id: <first>
 
 temporary_failures = []
 permanent_failures = []
+retry_after = {}
 
 
 def raise_SomeRecipientsFailed(mlist, msg, msgdata):
-    raise SomeRecipientsFailed(temporary_failures, permanent_failures)
+    raise SomeRecipientsFailed(
+        temporary_failures, permanent_failures, retry_after)
 
 
 class TestSomeRecipientsFailed(unittest.TestCase):
@@ -286,6 +292,7 @@ class TestSomeRecipientsFailed(unittest.TestCase):
         global temporary_failures, permanent_failures
         del temporary_failures[:]
         del permanent_failures[:]
+        retry_after.clear()
         self._processor = getUtility(IBounceProcessor)
         # Push a config where actual delivery is handled by a dummy function.
         # We generally don't care what this does, since we're just testing the
@@ -394,6 +401,10 @@ Message-Id: <first>
                          as_timedelta(config.mta.delivery_retry_period))
         self.assertEqual(items[0].msgdata['deliver_until'], deliver_until)
         self.assertEqual(items[0].msgdata['recipients'], ['cris@example.com'])
+        # The retry is delayed.
+        deliver_after = (datetime(2005, 8, 1, 7, 49, 23) +
+                         as_timedelta(config.mta.delivery_retry_interval))
+        self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
 
     def test_two_temporary_failures(self):
         # The first time there are temporary failures, the message just gets
@@ -412,6 +423,34 @@ Message-Id: <first>
         self.assertEqual(items[0].msgdata['recipients'],
                          ['cris@example.com', 'dave@example.com'])
 
+    def test_temporary_failures_with_retry_times(self):
+        # Recipients at throttled domains come with retry times of their
+        # own.  Each group of recipients gets its own entry in the retry
+        # queue, held back until its retry time.
+        temporary_failures.extend(
+            ['cris@example.com', 'dave@example.org', 'elle@example.org'])
+        later = datetime(2005, 8, 1, 9, 49, 23)
+        retry_after.update({
+            'dave@example.org': later,
+            'elle@example.org': later,
+            })
+        self._outq.enqueue(self._msg, {}, listid='test.example.com')
+        self._runner.run()
+        items = get_queue_messages('retry', expected_count=2)
+        entries = sorted(
+            (item.msgdata['deliver_after'], item.msgdata['recipients'])
+            for item in items)
+        deliver_after = (datetime(2005, 8, 1, 7, 49, 23) +
+                         as_timedelta(config.mta.delivery_retry_interval))
+        self.assertEqual(entries, [
+            (deliver_after, ['cris@example.com']),
+            (later, ['dave@example.org', 'elle@example.org']),
+            ])
+        # Both entries count all the failed recipients towards the progress
+        # being made.
+        for item in items:
+            self.assertEqual(item.msgdata['last_recip_count'], 3)
+
     def test_mixed_failures(self):
         # Some temporary and some permanent failures.
         permanent_failures.append('elle@example.com')
@@ -476,3 +515,251 @@ Message-Id: <first>
         self.assertEqual(
             line[-63:-1],
             'Discarding message with persistent temporary failures: <first>')
+
+
+class TestTrackedDeliveries(unittest.TestCase):
+    """Test keeping the delivery state of temporary failures."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        del temporary_failures[:]
+        del permanent_failures[:]
+        retry_after.clear()
+        config.push('tracked outgoing', """
+       [mta]
+       outgoing: mailman.runners.tests.test_outgoing.raise_SomeRecipientsFailed
+       track_delivery_state: yes
+        """)
+        self.addCleanup(config.pop, 'tracked outgoing')
+        self._mlist = create_list('test@example.com')
+        self._outq = config.switchboards['out']
+        self._runner = make_testable_runner(OutgoingRunner, 'out', run_once)
+        self._store = getUtility(IDeliveryStore)
+        self._processor = getUtility(IBounceProcessor)
+        self._msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Message-Id: <first>
+
+""")
+
+    def _statuses(self, delivery):
+        return sorted((recipient.email, recipient.status, recipient.attempts)
+                      for recipient in delivery.recipients)
+
+    def test_temporary_failures_are_tracked(self):
+        # The temporary failures are recorded in the delivery state store,
+        # instead of putting the message in the retry queue.
+        temporary_failures.extend(['cris@example.com', 'dave@example.org'])
+        permanent_failures.append('elle@example.com')
+        later = now() + timedelta(hours=2)
+        retry_after['dave@example.org'] = later
+        self._outq.enqueue(self._msg, dict(
+            recipients=['bart@example.com', 'cris@example.com',
+                        'dave@example.org', 'elle@example.com']),
+            listid='test.example.com')
+        self._runner.run()
+        get_queue_messages('retry', expected_count=0)
+        deliveries = list(self._store.deliveries)
+        self.assertEqual(len(deliveries), 1)
+        delivery = deliveries[0]
+        self.assertEqual(delivery.list_id, 'test.example.com')
+        self.assertEqual(delivery.message_id, '<first>')
+        self.assertEqual(delivery.deliver_until, now() + as_timedelta(
+            config.mta.delivery_retry_period))
+        self.assertEqual(self._statuses(delivery), [
+            ('cris@example.com', DeliveryStatus.deferred, 1),
+            ('dave@example.org', DeliveryStatus.deferred, 1),
+            ('elle@example.com', DeliveryStatus.failed, 1),
+            ])
+        self.assertEqual(
+            sorted((recipient.email, recipient.retry_after)
+                   for recipient in delivery.recipients
+                   if recipient.status is DeliveryStatus.deferred),
+            [('cris@example.com', now() + as_timedelta(
+                config.mta.delivery_retry_interval)),
+             ('dave@example.org', later)])
+        # Permanent failures are still registered as bounces.
+        events = list(self._processor.unprocessed)
+        self.assertEqual([event.email for event in events],
+                         ['elle@example.com'])
+
+    def test_permanent_failures_are_not_tracked(self):
+        permanent_failures.append('elle@example.com')
+        self._outq.enqueue(self._msg, {}, listid='test.example.com')
+        self._runner.run()
+        self.assertEqual(list(self._store.deliveries), [])
+
+    def test_successful_retry(self):
+        delivery = self._store.add(self._mlist, self._msg, {})
+        delivery.record(['cris@example.com', 'dave@example.com'], [], now())
+        self._store.due()
+        self._outq.enqueue(self._msg, dict(
+            recipients=['cris@example.com', 'dave@example.com'],
+            delivery_id=delivery.id),
+            listid='test.example.com')
+        self._runner.run()
+        self.assertEqual(self._statuses(delivery), [
+            ('cris@example.com', DeliveryStatus.delivered, 2),
+            ('dave@example.com', DeliveryStatus.delivered, 2),
+            ])
+        self.assertIsNone(delivery.get_message())
+
+    def test_partial_retry(self):
+        # Some recipients are delivered to on the retry, so progress is made
+        # and the message is retried for a while longer.
+        delivery = self._store.add(self._mlist, self._msg, {})
+        delivery.record(['cris@example.com', 'dave@example.com'], [], now())
+        self._store.due()
+        factory.fast_forward(days=3)
+        temporary_failures.append('dave@example.com')
+        self._outq.enqueue(self._msg, dict(
+            recipients=['cris@example.com', 'dave@example.com'],
+            delivery_id=delivery.id),
+            listid='test.example.com')
+        self._runner.run()
+        self.assertEqual(self._statuses(delivery), [
+            ('cris@example.com', DeliveryStatus.delivered, 2),
+            ('dave@example.com', DeliveryStatus.deferred, 2),
+            ])
+        self.assertEqual(delivery.deliver_until, now() + as_timedelta(
+            config.mta.delivery_retry_period))
+        get_queue_messages('retry', expected_count=0)
+
+    def test_no_progress_within_retry_period(self):
+        delivery = self._store.add(self._mlist, self._msg, {})
+        delivery.deliver_until = now() + timedelta(days=1)
+        delivery.record(['cris@example.com'], [], now())
+        temporary_failures.append('cris@example.com')
+        self._outq.enqueue(self._msg, dict(
+            recipients=['cris@example.com'], delivery_id=delivery.id),
+            listid='test.example.com')
+        self._runner.run()
+        self.assertEqual(self._statuses(delivery), [
+            ('cris@example.com', DeliveryStatus.deferred, 2),
+            ])
+
+    def test_no_progress_with_expired_retry_period(self):
+        delivery = self._store.add(self._mlist, self._msg, {})
+        delivery.record(['cris@example.com', 'dave@example.com'], [], now())
+        factory.fast_forward(days=1)
+        temporary_failures.append('cris@example.com')
+        self._outq.enqueue(self._msg, dict(
+            recipients=['cris@example.com'], delivery_id=delivery.id),
+            listid='test.example.com')
+        mark = LogFileMark('mailman.smtp')
+        self._runner.run()
+        # All the recipients which are still waiting are given up on.
+        self.assertEqual(self._statuses(delivery), [
+            ('cris@example.com', DeliveryStatus.expired, 2),
+            ('dave@example.com', DeliveryStatus.expired, 1),
+            ])
+        self.assertIsNone(delivery.get_message())
+        self.assertEqual(
+            mark.readline()[-63:-1],
+            'Discarding message with persistent temporary failures: <first>')
+
+
+# Each delivery waits at the barrier until the others have started, so that
+# they can only all complete when they run at the same time.
+barrier = None
+deliveries = []
+
+
+def deliver_concurrently(mlist, msg, msgdata):
+    barrier.wait(10)
+    deliveries.append(
+        (mlist.list_id, msg['message-id'], threading.get_ident()))
+    if msg['message-id'] == '<temporary>':
+        raise SomeRecipientsFailed(['cris@example.com'], [])
+    elif msg['message-id'] == '<permanent>':
+        raise SomeRecipientsFailed([], ['anne@example.com'])
+    elif msg['message-id'] == '<broken>':
+        raise RuntimeError('Delivery is broken')
+
+
+class TestConcurrentDelivery(unittest.TestCase):
+    """Test delivering several messages at the same time."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        del deliveries[:]
+        config.push('concurrent outgoing', """
+        [mta]
+        outgoing: mailman.runners.tests.test_outgoing.deliver_concurrently
+        """)
+        self.addCleanup(config.pop, 'concurrent outgoing')
+        self._mlist = create_list('test@example.com')
+        # Deliveries look the mailing list up again in their own threads, so
+        # it has to be committed.
+        config.db.commit()
+        self._outq = config.switchboards['out']
+        self._processor = getUtility(IBounceProcessor)
+
+    def _enqueue(self, *message_ids):
+        global barrier
+        barrier = threading.Barrier(len(message_ids))
+        for message_id in message_ids:
+            msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Message-Id: {}
+
+""".format(message_id))
+            self._outq.enqueue(msg, {}, listid='test.example.com')
+
+    def _make_runner(self, concurrency):
+        with configuration('runner.out', concurrency=concurrency):
+            return make_testable_runner(OutgoingRunner, 'out')
+
+    def test_sequential_by_default(self):
+        runner = make_testable_runner(OutgoingRunner, 'out')
+        self.assertIsNone(runner._executor)
+
+    def test_concurrent_deliveries(self):
+        self._enqueue('<first>', '<second>', '<third>')
+        self._make_runner(3).run()
+        self.assertEqual(
+            sorted(message_id for list_id, message_id, thread in deliveries),
+            ['<first>', '<second>', '<third>'])
+        self.assertEqual(
+            set(list_id for list_id, message_id, thread in deliveries),
+            {'test.example.com'})
+        self.assertEqual(
+            len(set(thread for list_id, message_id, thread in deliveries)), 3)
+        # Every queue file has been finished.
+        get_queue_messages('out', expected_count=0)
+        self.assertEqual(self._outq.get_files('.bak'), [])
+
+    def test_failures_are_handled_per_message(self):
+        self._enqueue('<temporary>', '<permanent>', '<first>')
+        self._make_runner(3).run()
+        self.assertEqual(len(deliveries), 3)
+        # Only the message with the temporary failure is retried, for the
+        # failing recipient.
+        items = get_queue_messages('retry', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<temporary>')
+        self.assertEqual(items[0].msgdata['recipients'], ['cris@example.com'])
+        # Only the permanent failure is registered as a bounce.
+        events = list(self._processor.unprocessed)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].email, 'anne@example.com')
+        self.assertEqual(events[0].message_id, '<permanent>')
+        self.assertEqual(events[0].list_id, 'test.example.com')
+        get_queue_messages('out', expected_count=0)
+        self.assertEqual(self._outq.get_files('.bak'), [])
+
+    def test_broken_delivery_shunts_only_its_message(self):
+        self._enqueue('<broken>', '<first>')
+        mark = LogFileMark('mailman.error')
+        self._make_runner(2).run()
+        self.assertEqual(len(deliveries), 2)
+        items = get_queue_messages('shunt', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<broken>')
+        self.assertEqual(items[0].msgdata['whichq'], 'out')
+        self.assertIn('Delivery is broken', mark.read())
+        get_queue_messages('out', expected_count=0)
+        get_queue_messages('retry', expected_count=0)
+        self.assertEqual(self._outq.get_files('.bak'), [])
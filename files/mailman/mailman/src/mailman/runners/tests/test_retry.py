@@ -19,13 +19,19 @@
 
 import unittest
 
+from datetime import timedelta
 from mailman.app.lifecycle import create_list
 from mailman.config import config
+from mailman.interfaces.deliveries import DeliveryStatus, IDeliveryStore
+from mailman.model.deliveries import DeliveryStore
 from mailman.runners.retry import RetryRunner
 from mailman.testing.helpers import (
-    get_queue_messages, make_testable_runner,
+    configuration, get_queue_messages, make_testable_runner,
     specialized_message_from_string as message_from_string)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import factory, now
+from unittest.mock import patch
+from zope.component import getUtility
 
 
 class TestRetryRunner(unittest.TestCase):
@@ -50,3 +56,92 @@ Message-Id: <first>
         self._retryq.enqueue(self._msg, self._msgdata)
         self._runner.run()
         get_queue_messages('out', expected_count=1)
+
+    def test_retry_when_due(self):
+        # Messages stay in the retry queue until their retry is due.
+        self._retryq.enqueue(self._msg, self._msgdata,
+                             deliver_after=now() + timedelta(minutes=15))
+        self._runner.run()
+        self.assertEqual(len(self._retryq.delayed_files), 1)
+        self.assertEqual(self._outq.files, [])
+        factory.fast_forward()
+        self._runner.run()
+        items = get_queue_messages('out', expected_count=1)
+        self.assertNotIn('deliver_after', items[0].msgdata)
+        self.assertEqual(self._retryq.delayed_files, [])
+
+    def test_sleep_until_retry_is_due(self):
+        self._retryq.enqueue(self._msg, self._msgdata,
+                             deliver_after=now() + timedelta(seconds=20))
+        self._runner.run()
+        with patch('mailman.runners.retry.Runner._sleep') as sleep:
+            self._runner._snooze(0)
+        limit = sleep.call_args[0][0]
+        self.assertGreater(limit, 0)
+        self.assertLessEqual(limit, 20)
+
+    def test_sleep_without_retries(self):
+        with patch('mailman.runners.retry.Runner._sleep') as sleep:
+            self._runner._snooze(0)
+        sleep.assert_called_once_with(None)
+
+    def test_untracked(self):
+        # Without delivery state tracking, the store is left alone.
+        with patch.object(DeliveryStore, 'due') as due:
+            self._runner.run()
+        self.assertFalse(due.called)
+
+    @configuration('mta', track_delivery_state='yes')
+    def test_sleep_until_tracked_retry_is_due(self):
+        delivery = getUtility(IDeliveryStore).add(
+            self._mlist, self._msg, self._msgdata)
+        delivery.record(['bart@example.com'], [],
+                        now() + timedelta(seconds=20))
+        self._runner.run()
+        with patch('mailman.runners.retry.Runner._sleep') as sleep:
+            self._runner._snooze(0)
+        limit = sleep.call_args[0][0]
+        self.assertGreater(limit, 0)
+        self.assertLessEqual(limit, 20)
+
+    @configuration('mta', track_delivery_state='yes')
+    def test_tracked_recipients_when_due(self):
+        # Recipients tracked in the delivery state store are put in the out
+        # queue once they are due, with the stored message.
+        store = getUtility(IDeliveryStore)
+        delivery = store.add(self._mlist, self._msg, self._msgdata)
+        delivery.record(
+            ['bart@example.com', 'cris@example.com', 'dave@example.com'], [],
+            {'bart@example.com': now() + timedelta(minutes=15),
+             'cris@example.com': now() + timedelta(minutes=30),
+             'dave@example.com': now() + timedelta(days=2)})
+        self._runner.run()
+        get_queue_messages('out', expected_count=0)
+        factory.fast_forward()
+        self._runner.run()
+        items = get_queue_messages('out', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<first>')
+        self.assertEqual(items[0].msgdata['listid'], 'test.example.com')
+        self.assertEqual(items[0].msgdata['recipients'],
+                         ['bart@example.com', 'cris@example.com'])
+        self.assertEqual(items[0].msgdata['delivery_id'], delivery.id)
+        self.assertEqual(
+            sorted((recipient.email, recipient.status)
+                   for recipient in delivery.recipients),
+            [('bart@example.com', DeliveryStatus.queued),
+             ('cris@example.com', DeliveryStatus.queued),
+             ('dave@example.com', DeliveryStatus.deferred)])
+        # They are only queued once.
+        self._runner.run()
+        get_queue_messages('out', expected_count=0)
+
+    @configuration('mta', track_delivery_state='yes')
+    def test_resolved_deliveries_are_evicted(self):
+        store = getUtility(IDeliveryStore)
+        delivery = store.add(self._mlist, self._msg, self._msgdata)
+        delivery.record([], ['bart@example.com'], now())
+        self._runner.run()
+        self.assertEqual(len(list(store.deliveries)), 1)
+        factory.fast_forward()
+        self._runner.run()
+        self.assertEqual(list(store.deliveries), [])
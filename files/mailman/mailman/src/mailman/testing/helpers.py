@@ -27,6 +27,7 @@ import signal
 import socket
 import logging
 import smtplib
+import weakref
 import datetime
 import threading
 
@@ -41,8 +42,11 @@ from mailman.database.transaction import transaction
 from mailman.email.message import Message
 from mailman.interfaces.member import MemberRole
 from mailman.interfaces.messages import IMessageStore
+from mailman.interfaces.recipients import IRecipientCache
 from mailman.interfaces.styles import IStyleManager
 from mailman.interfaces.usermanager import IUserManager
+from mailman.mta.bulk import group_by_mx
+from mailman.mta.connection import connection_pool
 from mailman.runners.digest import DigestRunner
 from mailman.utilities.mailbox import Mailbox
 from public import public
@@ -55,6 +59,9 @@ from zope.component import getUtility
 
 NL = '\n'
 
+# The runners made for the tests, whose queues are closed between tests.
+_testable_runners = weakref.WeakSet()
+
 
 @public
 def make_testable_runner(runner_class, name=None, predicate=None):
@@ -91,7 +98,9 @@ def make_testable_runner(runner_class, name=None, predicate=None):
             else:
                 self._stop = predicate(self)
 
-    return EmptyingRunner(name)
+    runner = EmptyingRunner(name)
+    _testable_runners.add(runner)
+    return runner
 
 
 class _Bag:
@@ -114,7 +123,7 @@ def get_queue_messages(queue_name, sort_on=None, expected_count=None):
     """
     queue = config.switchboards[queue_name]
     messages = []
-    for filebase in queue.files:
+    for filebase in queue.files + queue.delayed_files:
         msg, msgdata = queue.dequeue(filebase)
         messages.append(_Bag(msg=msg, msgdata=msgdata))
         queue.finish(filebase)
@@ -447,12 +456,19 @@ def reset_the_world():
     * Remove all residual queue and digest files
     * Clear the message store
     * Reset the global style manager
+    * Close the pooled SMTP connections
+    * Stop watching the queues of the runners made by make_testable_runner()
 
     This should be as thorough a reset of the system as necessary to keep
     tests isolated.
     """
     # Reset the database between tests.
     config.db._reset()
+    # Stop watching the queues of the tests' runners.
+    for runner in list(_testable_runners):
+        if runner.switchboard is not None:
+            runner.switchboard.close()
+    _testable_runners.clear()
     # Remove any digest files and members.txt file (for the file-recips
     # handler) in the lists' data directories.
     for dirpath, dirnames, filenames in os.walk(config.LIST_DATA_DIR):
@@ -485,6 +501,16 @@ def reset_the_world():
     suffix_file = os.path.join(config.VAR_DIR, LOCAL_FILE_NAME)
     with suppress(FileNotFoundError):
         os.remove(suffix_file)
+    # Close the SMTP connections left open by deliveries.
+    connection_pool.close()
+    # Forget the cached mail exchangers and the throttled domains.
+    group_by_mx.clear()
+    from mailman.mta.throttle import domain_throttle
+    domain_throttle.clear()
+    # Forget the cached recipients and members of the mailing lists.
+    getUtility(IRecipientCache).clear()
+    from mailman.model.roster import member_cache
+    member_cache.clear()
 
 
 @public
@@ -17,6 +17,7 @@
 
 """Fake MTA for testing purposes."""
 
+import hmac
 import socket
 import asyncio
 import smtplib
@@ -24,6 +25,7 @@ import smtplib
 from aiosmtpd.controller import Controller
 from aiosmtpd.handlers import Message as MessageHandler
 from aiosmtpd.smtp import SMTP
+from base64 import b64decode, b64encode
 from mailman.interfaces.mta import IMailTransportAgentLifecycle
 from public import public
 from queue import Empty, Queue
@@ -56,8 +58,14 @@ class ConnectionCountingHandler(MessageHandler):
 
 
 class ConnectionCountingSMTP(SMTP):
+    # The AUTH mechanisms advertised in the EHLO response.
+    auth_mechanisms = 'PLAIN'
+    # Whether SMTPUTF8 is advertised in the EHLO response.
+    smtputf8 = False
+
     def __init__(self, handler, oob_queue, err_queue, *args, **kws):
-        super().__init__(handler, *args, **kws)
+        super().__init__(
+            handler, *args, enable_SMTPUTF8=self.smtputf8, **kws)
         self._auth_response = None
         self._waiting_for_auth_response = False
         self._oob_queue = oob_queue
@@ -92,12 +100,42 @@ class ConnectionCountingSMTP(SMTP):
                 # Send a challenge and set us up to wait for the response.
                 yield from self.push('334 ')
                 self._waiting_for_auth_response = True
+        elif args[0].lower() == 'login':
+            yield from self.push('334 VXNlcm5hbWU6')
+            username = yield from self._auth_line()
+            yield from self.push('334 UGFzc3dvcmQ6')
+            password = yield from self._auth_line()
+            yield from self._auth_result(
+                (username, password) == (b'testuser', b'testpass'))
+        elif args[0].lower() == 'cram-md5':
+            challenge = b'<1896.697170952@example.com>'
+            yield from self.push(
+                '334 ' + b64encode(challenge).decode('ascii'))
+            digest = hmac.new(b'testpass', challenge, 'md5').hexdigest()
+            response = yield from self._auth_line()
+            yield from self._auth_result(
+                response == 'testuser {}'.format(digest).encode('ascii'))
+        else:
+            yield from self.push('571 Bad authentication')
+
+    @asyncio.coroutine
+    def _auth_line(self):
+        line = yield from self._reader.readline()
+        return b64decode(line.strip())
+
+    @asyncio.coroutine
+    def _auth_result(self, success):
+        if success:
+            yield from self.push('235 Ok')
+            # Record the credentials as AUTH PLAIN sends them.
+            self._oob_queue.put('AHRlc3R1c2VyAHRlc3RwYXNz')
         else:
             yield from self.push('571 Bad authentication')
 
     @asyncio.coroutine
     def ehlo_hook(self):
-        yield from self.push('250-AUTH PLAIN')
+        yield from self.push('250-AUTH ' + self.auth_mechanisms)
+        yield from self.push('250-PIPELINING')
 
     @asyncio.coroutine
     def rset_hook(self):
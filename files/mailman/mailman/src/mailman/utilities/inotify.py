@@ -0,0 +1,131 @@
+# Copyright (C) 2017 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Minimal directory watching through the Linux inotify API.
+
+Only the handful of calls needed to watch a flat queue directory are
+supported.  On platforms without inotify, creating a `DirectoryWatcher`
+raises an `OSError` and callers are expected to fall back to scanning.
+"""
+
+import os
+import sys
+import errno
+import ctypes
+import struct
+import ctypes.util
+
+from public import public
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+# Any of these mean the watch is gone or events were lost, so whatever state
+# was built from the event stream can no longer be trusted.
+IN_RESET = IN_DELETE_SELF | IN_MOVE_SELF | IN_Q_OVERFLOW | IN_IGNORED
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        _libc = libc
+    return _libc
+
+
+@public
+class DirectoryWatcher:
+    """Watch a single directory for file system events."""
+
+    def __init__(self, directory, mask=(IN_CLOSE_WRITE | IN_MOVED_FROM |
+                                        IN_MOVED_TO | IN_DELETE)):
+        """Start watching a directory.
+
+        :param directory: The directory to watch.
+        :type directory: str
+        :param mask: The inotify events to watch for.
+        :type mask: int
+        :raises OSError: when inotify is unavailable or the watch cannot be
+            established, e.g. because the per-user instance limit is reached.
+        """
+        self.directory = directory
+        self._fd = None
+        libc = _get_libc()
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        wd = libc.inotify_add_watch(
+            fd, os.fsencode(directory), ctypes.c_uint32(mask))
+        if wd < 0:
+            code = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(code, os.strerror(code), directory)
+        self._fd = fd
+
+    def fileno(self):
+        """The file descriptor, suitable for `select()`."""
+        return self._fd
+
+    def read_events(self):
+        """Return all pending events without blocking.
+
+        :return: A list of 2-tuples of the form (mask, name) where name is the
+            file name relative to the watched directory, or None for events
+            about the directory itself.
+        """
+        events = []
+        while self._fd is not None:
+            try:
+                buf = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = _EVENT.unpack_from(buf, offset)
+                offset += _EVENT.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((mask, os.fsdecode(name) if name else None))
+        return events
+
+    def close(self):
+        """Stop watching."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
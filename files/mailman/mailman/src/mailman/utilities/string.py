@@ -50,6 +50,11 @@ def expand(template, mlist=None, extras=None, template_class=Template):
     :return: The substituted string.
     :rtype: string
     """
+    return template_class(template).safe_substitute(
+        _substitutions(mlist, extras))
+
+
+def _substitutions(mlist, extras):
     substitutions = dict(
         site_email=config.mailman.site_owner,
         )
@@ -68,7 +73,55 @@ def expand(template, mlist=None, extras=None, template_class=Template):
             ))
     if extras is not None:
         substitutions.update(extras)
-    return template_class(template).safe_substitute(substitutions)
+    return substitutions
+
+
+def _escape_braces(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+@public
+def compile_template(template, mlist=None, extras=None, slots=()):
+    """Expand a string template, except for some placeholders.
+
+    This is like `expand()`, but for templates which are expanded many times
+    with only a few substitutions changing.  Everything else is substituted
+    once, up front.
+
+    :param template: A PEP 292 $-string template.
+    :type template: string
+    :param mlist: Optional mailing list.  If given, the standard set of
+        list-specific substitution variables are used automatically.
+    :type mlist: `IMailingList`
+    :param extras: An additional substitutions dictionary.  These are used to
+        augment any standard, list-specific substitutions.
+    :type extras: dict
+    :param slots: The names of the placeholders which are left to fill in.
+        They take precedence over the other substitutions.
+    :type slots: sequence of strings
+    :return: A function which takes the slots as keyword arguments, and
+        returns the substituted string.
+    :rtype: callable
+    """
+    substitutions = _substitutions(mlist, extras)
+    parts = []
+    position = 0
+    for mo in Template.pattern.finditer(template):
+        parts.append(_escape_braces(template[position:mo.start()]))
+        position = mo.end()
+        name = mo.group('named') or mo.group('braced')
+        if name in slots:
+            parts.append('{' + name + '}')
+        elif name in substitutions:
+            parts.append(_escape_braces(str(substitutions[name])))
+        elif mo.group('escaped') is not None:
+            parts.append('$')
+        else:
+            # Like Template.safe_substitute(), leave unknown placeholders and
+            # stray delimiters alone.
+            parts.append(_escape_braces(mo.group()))
+    parts.append(_escape_braces(template[position:]))
+    return EMPTYSTRING.join(parts).format
 
 
 @public
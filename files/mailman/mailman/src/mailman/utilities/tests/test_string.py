@@ -19,6 +19,8 @@
 
 import unittest
 
+from mailman.app.lifecycle import create_list
+from mailman.testing.layers import ConfigLayer
 from mailman.utilities import string
 
 
@@ -28,3 +30,36 @@ class TestString(unittest.TestCase):
 
     def test_wrap_blank_paragraph(self):
         self.assertEqual(string.wrap('\n\n'), '\n\n')
+
+
+class TestCompileTemplate(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+
+    def test_same_as_expand(self):
+        template = ('$listname ${list_id} $$ $missing ${missing} $ {braces} '
+                    '$site_email $bounces $local')
+        extras = dict(bounces='test-bounces', local='anne')
+        fill = string.compile_template(
+            template, self._mlist, dict(bounces='test-bounces'), ('local',))
+        self.assertEqual(fill(local='anne'),
+                         string.expand(template, self._mlist, extras))
+        self.assertEqual(
+            fill(local='anne'),
+            'test@example.com test.example.com $ $missing ${missing} $ '
+            '{braces} noreply@example.com test-bounces anne')
+
+    def test_slots_take_precedence(self):
+        # The list's domain substitution is replaced by the slot.
+        fill = string.compile_template(
+            '${domain}/$domain', self._mlist, slots=('domain',))
+        self.assertEqual(fill(domain='example.org'),
+                         'example.org/example.org')
+
+    def test_braces_in_substitutions(self):
+        self._mlist.display_name = '{Test}'
+        fill = string.compile_template(
+            '$display_name $local', self._mlist, slots=('local',))
+        self.assertEqual(fill(local='{anne}'), '{Test} {anne}')